@@ -1,6 +1,9 @@
 import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
+import sys
+sys.path.append('../../epw_compiler')
+from open_meteo_client import fetch_archive
 
 
 def cdd(df):
@@ -28,9 +31,8 @@ args = parser.parse_args()
 
 lat, lon, start_year, end_year = args.lat, args.lon, args.start_year, args.end_year
     
-df = pd.read_csv(f"https://archive-api.open-meteo.com/v1/archive?latitude={lat}&longitude={lon}&start_date={start_year}-01-01&end_date={end_year}-12-31&daily=temperature_2m_mean&timezone=GMT&format=csv", header=2)
-df['timestamp'] = pd.to_datetime(df['time'])
-df.set_index('timestamp', inplace=True)
+df = fetch_archive(lat, lon, start_year, end_year, ["temperature_2m_mean"], frequency="daily", options={"timezone": "GMT"})
+df = df.rename_axis('timestamp')
 df = df.resample('1D').mean(numeric_only=True)
 df = df[~((df.index.month == 2) & (df.index.day == 29))]
 df['T_db_o[C]'] = df['temperature_2m_mean (°C)']
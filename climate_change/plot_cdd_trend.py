@@ -5,6 +5,9 @@ from influxdb_client import InfluxDBClient
 import matplotlib.pyplot as plt
 import os
 from dotenv import load_dotenv
+import sys
+sys.path.append('../epw_compiler')
+from influx_loader import query_sources
 
 
 load_dotenv()
@@ -42,16 +45,13 @@ def cdd(df):
     return sum_dist
 
 
-for source in [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]:
-    query = f'from(bucket:"{source}")\
-                |> range(start: {start_year-1}-12-31T23:59:00Z, stop: {end_year}-12-31T23:59:59Z)\
-                |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
-                |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
-                |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-        
-    df = query_api.query_data_frame(query)
-    df.index = pd.to_datetime(df['_time'])
-    df.sort_index(inplace=True)
+SOURCES = [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]
+
+# Both sources are read concurrently
+df_sources = query_sources(query_api, SOURCES, station_id, pd.Timestamp(year=start_year, month=1, day=1), pd.Timestamp(year=end_year+1, month=1, day=1))
+
+for source in SOURCES:
+    df = df_sources[source].copy()
 
     df['T_db_o[C]'] = df["T_db[C]"]
     df = df.resample("1D").mean(numeric_only=True)
@@ -3,6 +3,9 @@ import pandas as pd
 from influxdb_client import InfluxDBClient
 import os
 from dotenv import load_dotenv
+import sys
+sys.path.append('../epw_compiler')
+from influx_loader import query_sources
 import matplotlib.pyplot as plt
 plt.rcParams['legend.fontsize'] = 14
 plt.rcParams['axes.labelsize'] = 14
@@ -31,16 +34,13 @@ station_id, start_year, end_year = args.id.upper(), args.start_year, args.end_ye
 
 fig = plt.figure(figsize=(16, 9))
 
-for source in [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]:
-    query = f'from(bucket:"{source}")\
-            |> range(start: {start_year-1}-12-31T23:59:00Z, stop: {end_year}-12-31T23:59:59Z)\
-            |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
-            |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
-            |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-    
-    df = query_api.query_data_frame(query)
-    df.index = pd.to_datetime(df['_time'])
-    df.sort_index(inplace=True)
+SOURCES = [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]
+
+# Both sources are read concurrently
+df_sources = query_sources(query_api, SOURCES, station_id, pd.Timestamp(year=start_year, month=1, day=1), pd.Timestamp(year=end_year+1, month=1, day=1))
+
+for source in SOURCES:
+    df = df_sources[source].copy()
     df = df.resample('Y').mean(numeric_only=True)
     
     years = range(start_year, end_year+1)
@@ -6,7 +6,10 @@ import requests
 import time
 import math
 import os
+import sys
 from dotenv import load_dotenv
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/epw_compiler")
+from open_meteo_client import HOURLY_VARIABLES, GROUND_TEMPS_MEASUREMENT, SOIL_TEMP_FIELDS, CELL_OPTIONS, fetch_archive, snap_to_grid
 
 
 load_dotenv()
@@ -15,6 +18,7 @@ INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
 INFLUXDB_URL = os.getenv('INFLUXDB_URL')
 WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
 OPEN_METEO_BUCKET_NAME = os.getenv('OPEN_METEO_BUCKET_NAME')
+OM_VARIABLES = HOURLY_VARIABLES + ['weathercode']
 
 client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 writer = client.write_api(write_options=SYNCHRONOUS)
@@ -121,15 +125,39 @@ def scrape_and_upload(station_id, start_year, end_year):
     dataPoints = dataPointsTemp + dataPointsHum + dataPointsWindSpeed + dataPointsWindDir + dataPointsDewpt + dataPointsPressureMin + dataPointsPressureMax + dataPointsRain + dataPointsPrecRate + dataPointsRad
     writer.write(bucket=WEATHER_UNDERGROUND_BUCKET_NAME, org=INFLUXDB_ORG, record=dataPoints)
 
-    scrape_om_and_upload(station_id, df['lat'].max(), df['lon'].max(), start_year, end_year)
+    return df['lat'].max(), df['lon'].max()
 
 
-def scrape_om_and_upload(station_id, lat, lon, start_year, end_year):
-    df = pd.read_csv(f"https://archive-api.open-meteo.com/v1/archive?latitude={lat}&longitude={lon}&start_date={start_year}-01-01&end_date={end_year}-12-31&hourly=temperature_2m,relativehumidity_2m,dewpoint_2m,precipitation,weathercode,pressure_msl,windspeed_10m,winddirection_10m,soil_temperature_0_to_7cm,soil_temperature_7_to_28cm,soil_temperature_28_to_100cm,soil_temperature_100_to_255cm,diffuse_radiation&windspeed_unit=ms&format=csv", header=2)
-    df['timestamp'] = pd.to_datetime(df['time'])
-    df.set_index('timestamp', inplace=True)
-    df['lat'] = lat
-    df['lon'] = lon
+def scrape_om_and_upload(stations, start_year, end_year):
+    """Download the Open-Meteo history of each grid cell containing at least
+    one station only once, and upload it to every station of the cell.
+
+    The cell centre is requested with the elevation downscaling disabled, so
+    the series is the grid cell's one, the same for all its stations, and it
+    is tagged with the coordinates of the cell centre.
+
+    :param stations: Dict mapping each station ID to its (lat, lon) coordinates
+    :type stations: dict
+    :param start_year: Start year
+    :type start_year: int
+    :param end_year: End year (included)
+    :type end_year: int
+    """
+    cells = {}
+    for station_id, (lat, lon) in stations.items():
+        cells.setdefault(snap_to_grid(lat, lon), []).append(station_id)
+    print(f"{len(stations)} stations fall into {len(cells)} Open-Meteo grid cells")
+
+    for (cell_lat, cell_lon), station_ids in cells.items():
+        print(f"Scraping Open-Meteo data for cell {cell_lat}, {cell_lon} (stations {', '.join(station_ids)})...")
+        df = fetch_archive(cell_lat, cell_lon, start_year, end_year, OM_VARIABLES, options=CELL_OPTIONS)
+        df = df.rename_axis('timestamp')
+        for station_id in station_ids:
+            upload_om(station_id, cell_lat, cell_lon, df)
+
+
+def upload_om(station_id, lat, lon, df):
+    df = df.assign(lat=lat, lon=lon)
 
     dataPointsTemp = [
         Point(station_id).tag('coords', (lat, lon)).field('T_db[C]', temp).time(time)
@@ -160,14 +188,34 @@ def scrape_om_and_upload(station_id, lat, lon, start_year, end_year):
             for time, lat, lon, temp in zip(df.index, df['lat'], df['lon'], df['precipitation (mm)'])
     ]
     dataPointsWeatherCode = [
-        Point(station_id).tag('coords', (lat, lon)).field('weathercode', temp).time(time)
-            for time, lat, lon, temp in zip(df.index, df['lat'], df['lon'], df['weathercode (wmo code)'])
+        # WMO codes are stored as integers
+        Point(station_id).tag('coords', (lat, lon)).field('weathercode', int(temp)).time(time)
+            for time, lat, lon, temp in zip(df.index, df['lat'], df['lon'], df['weathercode (wmo code)']) if not math.isnan(temp)
     ]
     dataPointsRad = [
         Point(station_id).tag('coords', (lat, lon)).field('GHI[W/m2]', temp).time(time)
             for time, lat, lon, temp in zip(df.index, df['lat'], df['lon'], df['diffuse_radiation (W/m²)'])
     ]
-    dataPoints = dataPointsTemp + dataPointsHum + dataPointsWindSpeed + dataPointsWindDir + dataPointsDewpt + dataPointsPressure + dataPointsRain + dataPointsWeatherCode + dataPointsRad
+    dataPointsSoil = [
+        Point(station_id).tag('coords', (lat, lon)).field(field, temp).time(time)
+            for col, field in SOIL_TEMP_FIELDS.items()
+            for time, lat, lon, temp in zip(df.index, df['lat'], df['lon'], df[col])
+    ]
+    dataPoints = dataPointsTemp + dataPointsHum + dataPointsWindSpeed + dataPointsWindDir + dataPointsDewpt + dataPointsPressure + dataPointsRain + dataPointsWeatherCode + dataPointsRad + dataPointsSoil
+    writer.write(bucket=OPEN_METEO_BUCKET_NAME, org=INFLUXDB_ORG, record=dataPoints)
+
+    upload_ground_temps_rollup(station_id, lat, lon, df)
+
+
+def upload_ground_temps_rollup(station_id, lat, lon, df):
+    # Monthly means of the soil temperatures, one point per month and layer, so that
+    # the EPW header compiler can read the GROUND TEMPERATURES line with a single small query
+    df_mon = df[list(SOIL_TEMP_FIELDS)].resample('MS').mean()
+    dataPoints = [
+        Point(GROUND_TEMPS_MEASUREMENT).tag('station', station_id).tag('coords', (lat, lon)).field(field, temp).time(time)
+            for col, field in SOIL_TEMP_FIELDS.items()
+            for time, temp in zip(df_mon.index, df_mon[col])
+    ]
     writer.write(bucket=OPEN_METEO_BUCKET_NAME, org=INFLUXDB_ORG, record=dataPoints)
 
 
@@ -190,7 +238,12 @@ if __name__ == "__main__":
         input.strip()
         input.replace(" ", "")
         station_ids = input.split(",")
+        stations = {}
         for id in station_ids:
             print(f"Scraping data from station {id}...")
-            scrape_and_upload(id, start_year, end_year)
-        f.close()
\ No newline at end of file
+            coords = scrape_and_upload(id, start_year, end_year)
+            if coords is not None:
+                stations[id] = coords
+        f.close()
+
+    scrape_om_and_upload(stations, start_year, end_year)
\ No newline at end of file
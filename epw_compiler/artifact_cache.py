@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+REPO_ROOT = os.path.abspath(f"{os.path.dirname(os.path.abspath(__file__))}/..")
+CACHE_DIR = f"{REPO_ROOT}/artifact_cache"
+ATTRS_KEY = b"attrs"
+
+
+def hash_parts(*parts):
+    """Hash any JSON-serializable inputs (values which are not serializable
+    are converted to strings) into a cache key.
+
+    :return: Hexadecimal SHA-256 digest
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def code_version():
+    """Hash the source of the running script and of all the modules of this
+    repository it has imported, so that any code change invalidates the cache.
+
+    :return: Hexadecimal SHA-256 digest
+    :rtype: str
+    """
+    paths = {os.path.abspath(sys.argv[0])}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.abspath(path).startswith(REPO_ROOT):
+            paths.add(os.path.abspath(path))
+    h = hashlib.sha256()
+    for path in sorted(p for p in paths if p.endswith(".py") and os.path.exists(p)):
+        h.update(os.path.relpath(path, REPO_ROOT).encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def influx_watermark(query_api, bucket, station_id, start, end):
+    """Summarize the data of a station (or of all the stations of a bucket)
+    in a time range, so that any new or rewritten point changes the cache key.
+
+    :param query_api: InfluxDB query API
+    :type query_api: class:`influxdb_client.QueryApi`
+    :param bucket: Bucket name
+    :type bucket: str
+    :param station_id: Weather station ID (measurement), None for all the stations
+    :type station_id: str
+    :param start: Start of the range
+    :type start: class:`pandas.Timestamp`
+    :param end: End of the range (excluded)
+    :type end: class:`pandas.Timestamp`
+    :return: Number of points and time of the last point of each series
+    :rtype: dict
+    """
+    query = f'from(bucket:"{bucket}")\
+            |> range(start: {start - pd.Timedelta(minutes=1):%Y-%m-%dT%H:%M:%SZ}, stop: {end - pd.Timedelta(seconds=1):%Y-%m-%dT%H:%M:%SZ})'
+    if station_id is not None:
+        query = f'{query} |> filter(fn: (r) => r["_measurement"] == "{station_id}")'
+    # One table per series (field and tags)
+    counts = sorted((r.get_measurement(), r.get_field(), r.get_value()) for t in query_api.query(f"{query} |> count()") for r in t.records)
+    last = sorted((r.get_measurement(), r.get_field(), str(r.get_time())) for t in query_api.query(f"{query} |> last()") for r in t.records)
+    return {"bucket": bucket, "count": counts, "last": last}
+
+
+def save_frame(df, path):
+    # df.attrs are kept in the Parquet schema metadata
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    table = table.replace_schema_metadata({**table.schema.metadata, ATTRS_KEY: json.dumps(df.attrs, default=str)})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def load_frame(path):
+    table = pq.read_table(path, memory_map=True)
+    df = table.to_pandas()
+    df.attrs = json.loads(table.schema.metadata.get(ATTRS_KEY, b"{}"))
+    return df
+
+
+def cached_frame(stage, key, build, cache_dir=CACHE_DIR, refresh=False):
+    """Return the DataFrame of a pipeline stage from the cache, building and
+    caching it if the key is not there yet.
+
+    :param stage: Stage name
+    :type stage: str
+    :param key: Cache key of the stage inputs
+    :type key: str
+    :param build: Function with no arguments which builds the DataFrame
+    :type build: function
+    :param cache_dir: Cache directory, defaults to CACHE_DIR
+    :type cache_dir: str, optional
+    :param refresh: Flag to rebuild the stage even if it is cached, defaults to False
+    :type refresh: bool, optional
+    :return: DataFrame (df.attrs are preserved)
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    path = f"{cache_dir}/{stage}/{key}.parquet"
+    if not refresh and os.path.exists(path):
+        print(f"{stage}: inputs unchanged, using cached result")
+        return load_frame(path)
+    df = build()
+    save_frame(df, path)
+    return df
+
+
+def cached_value(stage, key, build, cache_dir=CACHE_DIR, refresh=False):
+    """Same as cached_frame, for JSON-serializable values."""
+    path = f"{cache_dir}/{stage}/{key}.json"
+    if not refresh and os.path.exists(path):
+        print(f"{stage}: inputs unchanged, using cached result")
+        with open(path) as f:
+            return json.load(f)
+    value = build()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(f"{path}.tmp", path)
+    return value
+
+
+def cached_files(stage, key, outputs, build, cache_dir=CACHE_DIR, refresh=False):
+    """Restore the output files of a pipeline stage from the cache, running
+    the stage and caching its outputs if the key is not there yet.
+
+    :param stage: Stage name
+    :type stage: str
+    :param key: Cache key of the stage inputs
+    :type key: str
+    :param outputs: Paths of the files written by the stage
+    :type outputs: list
+    :param build: Function with no arguments which writes the output files
+    :type build: function
+    :param cache_dir: Cache directory, defaults to CACHE_DIR
+    :type cache_dir: str, optional
+    :param refresh: Flag to run the stage even if it is cached, defaults to False
+    :type refresh: bool, optional
+    :return: True if the outputs were restored from the cache
+    :rtype: bool
+    """
+    entry = f"{cache_dir}/{stage}/{key}"
+    if not refresh and all(os.path.exists(f"{entry}/{os.path.basename(o)}") for o in outputs):
+        for o in outputs:
+            shutil.copyfile(f"{entry}/{os.path.basename(o)}", o)
+        print(f"{stage}: inputs unchanged, restored {', '.join(outputs)} from cache")
+        return True
+    build()
+    tmp_entry = f"{entry}.tmp"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+    for o in outputs:
+        shutil.copyfile(o, f"{tmp_entry}/{os.path.basename(o)}")
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp_entry, entry)
+    return False
@@ -3,7 +3,7 @@ import scipy.stats
 import math
 import re
 import pytz
-from tzwhere import tzwhere
+from timezone_lookup import get_tzwhere
 
 
 def t_dew_point(t_db, rh):
@@ -471,7 +471,7 @@ def compile_weather_data(df, lon, lat):
     return weather_df
 
 def get_timezone(lat, lon):
-    zone = tzwhere.tzwhere()
+    zone = get_tzwhere()
     return zone.tzNameAt(lat, lon)
 
 def get_dt(date, timezone):
@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+
+
+STRATEGIES = ["same_hour", "linear", "climatological"]
+WIND_DIR_PARAM = "wind_dir[o]"
+
+
+def carry(matrix, reverse=False):
+    # Carry the last valid value forward along the first axis (backward if reverse)
+    if reverse:
+        return carry(matrix[::-1])[::-1]
+    valid = ~np.isnan(matrix)
+    idx = np.where(valid, np.arange(len(matrix)).reshape(-1, *([1] * (matrix.ndim - 1))), 0)
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    filled = np.take_along_axis(matrix, idx, axis=0)
+    return np.where(valid | np.maximum.accumulate(valid, axis=0), filled, np.nan)
+
+
+def fill_same_hour(values):
+    # Day x hour view: fill with the previous (then the next) valid value at the same hour of the day
+    matrix = values.reshape(-1, 24, values.shape[1])
+    matrix = carry(matrix)
+    matrix = np.where(np.isnan(matrix), carry(matrix, reverse=True), matrix)
+    return matrix.reshape(values.shape)
+
+
+def fill_linear(values, circular=None):
+    # Circular columns (directions in degrees) are interpolated on their sine and cosine, so that a gap
+    # between 350° and 10° is filled around 0° and not around 180°
+    filled = values.copy()
+    x = np.arange(len(values))
+    for col in range(values.shape[1]):
+        valid = ~np.isnan(values[:, col])
+        if not valid.any():
+            continue
+        if circular is not None and circular[col]:
+            rad = np.deg2rad(values[valid, col])
+            angles = np.rad2deg(np.arctan2(np.interp(x, x[valid], np.sin(rad)), np.interp(x, x[valid], np.cos(rad)))) % 360
+            filled[:, col] = np.where(valid, values[:, col], angles)
+        else:
+            filled[:, col] = np.interp(x, x[valid], values[valid, col])
+    return filled
+
+
+def fill_climatological(values, index):
+    # Day x hour view: fill with the mean of the same hour of the day in the same calendar month
+    n_cols = values.shape[1]
+    matrix = values.reshape(-1, 24, n_cols)
+    months = index.month.values[::24] - 1
+    valid = ~np.isnan(matrix)
+    sums = np.zeros((12, 24, n_cols))
+    counts = np.zeros((12, 24, n_cols))
+    np.add.at(sums, months, np.where(valid, matrix, 0))
+    np.add.at(counts, months, valid)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return np.where(valid, matrix, means[months]).reshape(values.shape)
+
+
+def gap_lengths(missing):
+    """Compute, for every missing value, the length of the gap (run of
+    consecutive missing hours) it belongs to.
+
+    :param missing: Boolean array with shape (hours, variables)
+    :type missing: class:`numpy.ndarray`
+    :return: Integer array with the same shape, 0 where values are not missing
+    :rtype: class:`numpy.ndarray`
+    """
+    n_hours, n_cols = missing.shape
+    starts = missing & ~np.vstack([np.zeros((1, n_cols), dtype=bool), missing[:-1]])
+    run_ids = np.cumsum(starts, axis=0)
+    # Unique id of every gap across all variables
+    ids = np.where(missing, run_ids + np.arange(n_cols) * (n_hours + 1), 0)
+    lengths = np.bincount(ids.ravel())
+    lengths[0] = 0
+    return lengths[ids]
+
+
+def gap_report(index, columns, missing, lengths, filled):
+    """Summarize the gaps of every variable in every year.
+
+    :return: DataFrame indexed by (year, variable) with the number of missing
+        hours, the longest gap in hours, the number of hours left missing and
+        the percentage of hours of the year which were filled
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    years = index.year.values
+    bounds = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+    hours = np.diff(np.r_[bounds, len(years)])
+    n_missing = np.add.reduceat(missing, bounds, axis=0)
+    n_filled = np.add.reduceat(missing & filled, bounds, axis=0)
+    # Columns with several levels (e.g. source and variable) keep all of them in the report index
+    if not isinstance(columns, pd.MultiIndex):
+        columns = pd.MultiIndex.from_arrays([columns], names=["variable"])
+    n_years, n_cols = len(bounds), len(columns)
+    index = pd.MultiIndex(
+        levels=[years[bounds]] + list(columns.levels),
+        codes=[np.repeat(np.arange(n_years), n_cols)] + [np.tile(codes, n_years) for codes in columns.codes],
+        names=["year"] + list(columns.names)
+    )
+    return pd.DataFrame({
+        "missing": n_missing.ravel(),
+        "longest_gap[h]": np.maximum.reduceat(lengths, bounds, axis=0).ravel(),
+        "unfilled": (n_missing - n_filled).ravel(),
+        "filled[%]": (100 * n_filled / hours[:, None]).ravel(),
+    }, index=index)
+
+
+def fill_gaps(df, start, end, strategy="same_hour", max_gap=None, wind_dir_param=WIND_DIR_PARAM):
+    """Align a DataFrame to an hourly range and fill its gaps.
+
+    :param df: DataFrame with an hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param start: First timestamp of the range (midnight)
+    :type start: str or class:`pandas.Timestamp`
+    :param end: End of the range (midnight, excluded)
+    :type end: str or class:`pandas.Timestamp`
+    :param strategy: "same_hour" (previous, then next, value at the same hour
+        of the day), "linear" (linear interpolation, on the sine and cosine for
+        the wind direction) or "climatological" (mean
+        of the same hour of the day in the same calendar month), defaults to "same_hour"
+    :type strategy: str, optional
+    :param max_gap: Length in hours of the longest gap to be filled, longer
+        gaps are left missing, defaults to None (no limit)
+    :type max_gap: int, optional
+    :param wind_dir_param: Wind direction column (last level of the columns), defaults to "wind_dir[o]"
+    :type wind_dir_param: str, optional
+    :return: Tuple made of (filled DataFrame, gap report by year and variable)
+    :rtype: tuple
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown gap filling strategy {strategy}, choose one of {STRATEGIES}")
+
+    hourly_range = pd.date_range(start=start, end=end, freq="H", inclusive="left", name=df.index.name)
+    df = df.reindex(hourly_range)
+    values = df.values.astype(float)
+    missing = np.isnan(values)
+    lengths = gap_lengths(missing)
+
+    if strategy == "same_hour":
+        filled = fill_same_hour(values)
+    elif strategy == "linear":
+        variables = df.columns.get_level_values(-1)
+        filled = fill_linear(values, circular=variables == wind_dir_param)
+    else:
+        filled = fill_climatological(values, hourly_range)
+    if max_gap is not None:
+        filled = np.where(lengths > max_gap, np.nan, filled)
+
+    report = gap_report(hourly_range, df.columns, missing, lengths, ~np.isnan(filled))
+    return pd.DataFrame(filled, index=hourly_range, columns=df.columns), report
+
+
+def reject_poor_years(df, report, max_filled, variables=None):
+    """Mask the years in which any of the variables had more than max_filled
+    percent of its hours filled.
+
+    :param df: Filled DataFrame, as returned by fill_gaps
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param report: Gap report, as returned by fill_gaps
+    :type report: class:`pandas.core.frame.DataFrame`
+    :param max_filled: Maximum percentage of filled hours
+    :type max_filled: float
+    :param variables: Variables to be checked, defaults to None (all)
+    :type variables: list, optional
+    :return: Tuple made of (DataFrame with the rejected years set to NaN, rejected years)
+    :rtype: tuple
+    """
+    filled = report["filled[%]"].unstack("variable")
+    if variables is not None:
+        filled = filled[[v for v in variables if v in filled.columns]]
+    rejected = list(filled.index[(filled > max_filled).any(axis=1)])
+    df = df.copy()
+    df.loc[df.index.year.isin(rejected)] = np.nan
+    return df, rejected
@@ -7,6 +7,8 @@ from influxdb_client import InfluxDBClient
 import ast
 from wu_data_cleaner import clean_data
 from epw_data_compiler import compile_epw_data
+from influx_loader import apply_qc_flags
+from artifact_cache import code_version, hash_parts, influx_watermark, cached_frame, cached_value, cached_files
 import os
 from dotenv import load_dotenv
 
@@ -16,6 +18,7 @@ INFLUXDB_ORG = os.getenv('INFLUXDB_ORG')
 INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
 INFLUXDB_URL = os.getenv('INFLUXDB_URL')
 WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
+OPEN_METEO_BUCKET_NAME = os.getenv('OPEN_METEO_BUCKET_NAME')
 
 client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 query_api = client.query_api()
@@ -188,6 +191,26 @@ def convert_to_epw(
         print("SAVING TO:", f'{epw_filename}.epw')
 
 
+def query_station(station_id, start_year, end_year):
+    query = f'from(bucket:"{WEATHER_UNDERGROUND_BUCKET_NAME}")\
+        |> range(start: {start_year-1}-12-31T23:59:00Z, stop: {end_year}-12-31T23:59:59Z)\
+        |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
+        |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
+        |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+
+    df = query_api.query_data_frame(query)
+    df.index = pd.to_datetime(df['_time'])
+    df.sort_index(inplace=True)
+
+    df['lat'] = df.apply(lambda row: ast.literal_eval(row.coords)[0], axis=1)
+    df['lon'] = df.apply(lambda row: ast.literal_eval(row.coords)[1], axis=1)
+    lat = df['lat'].max()
+    lon = df['lon'].max()
+    
+    df.drop(columns=['result', 'table', '_start', '_stop', '_time', 'coords', '_measurement', 'lat', 'lon'], inplace=True)
+    return apply_qc_flags(df), lat, lon
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--id", help="Weather station ID", required=True)
@@ -210,38 +233,61 @@ def parse_args():
         "--comment1", help="1st comment line (optional)", default="")
     parser.add_argument(
         "--comment2", help="2nd comment line (optional)", default="")
+    parser.add_argument(
+        "--local_design_conditions", help="Compute the design conditions from the station's own history instead of using the closest ASHRAE station", action="store_true")
+    parser.add_argument(
+        "--history_start_year", type=int, help="Start year of the history used for the local design conditions (default=year-9)")
+    parser.add_argument(
+        "--ground_model", help="Compute the ground temperatures with the soil temperature model instead of Open-Meteo data", action="store_true")
+    parser.add_argument(
+        "--refresh_cache", help="Regenerate all the stages, even if their inputs did not change", action="store_true")
     args = parser.parse_args()
-    return args.id.upper(), args.year, args.city, args.country, args.state, args.source, args.leap, args.dst_start_date, args.dst_end_date, args.start_weekday, args.comment1, args.comment2
+    return args.id.upper(), args.year, args.city, args.country, args.state, args.source, args.leap, args.dst_start_date, args.dst_end_date, args.start_weekday, args.comment1, args.comment2, args.local_design_conditions, args.history_start_year, args.ground_model, args.refresh_cache
 
 
 if __name__ == "__main__":
-    station_id, year, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2 = parse_args()
+    station_id, year, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2, local_design_conditions, history_start_year, ground_model, refresh_cache = parse_args()
 
-    query = f'from(bucket:"{WEATHER_UNDERGROUND_BUCKET_NAME}")\
-        |> range(start: {year-1}-12-31T23:59:00Z, stop: {year}-12-31T23:59:59Z)\
-        |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
-        |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
-        |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+    # Every stage is cached, keyed by its inputs: the data in InfluxDB, the parameters and the code
+    version = code_version()
+    year_start, year_end = pd.Timestamp(year=year, month=1, day=1), pd.Timestamp(year=year+1, month=1, day=1)
 
-    df = query_api.query_data_frame(query)
-    df.index = pd.to_datetime(df['_time'])
-    df.sort_index(inplace=True)
+    def build_data():
+        df, lat, lon = query_station(station_id, year, year)
+        df = clean_data(df, year)
+        df.attrs = {"lat": float(lat), "lon": float(lon)}
+        return df
 
-    df['lat'] = df.apply(lambda row: ast.literal_eval(row.coords)[0], axis=1)
-    df['lon'] = df.apply(lambda row: ast.literal_eval(row.coords)[1], axis=1)
-    lat = df['lat'].max()
-    lon = df['lon'].max()
-    
-    df.drop(columns=['result', 'table', '_start', '_stop', '_time', 'coords', '_measurement', 'lat', 'lon'], inplace=True)
+    data_key = hash_parts("epw_data", station_id, year, influx_watermark(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, station_id, year_start, year_end), version)
+    df = cached_frame("epw_data", data_key, build_data, refresh=refresh_cache)
+    lat, lon = df.attrs["lat"], df.attrs["lon"]
 
-    df = clean_data(df, year)
-    
-    header = compile_header(
-        df, city, country, lat, lon, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2
+    design_conditions_df = None
+    history_key = None
+    if local_design_conditions:
+        history_start_year = history_start_year or year-9
+
+        def build_history():
+            design_conditions_df, _, _ = query_station(station_id, history_start_year, year)
+            design_conditions_df.index = design_conditions_df.index.tz_localize(None)
+            design_conditions_df['P_atm[hPa]'] = (design_conditions_df['P_atm_min[hPa]'] + design_conditions_df['P_atm_max[hPa]']) / 2
+            return design_conditions_df
+
+        history_watermark = influx_watermark(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, station_id, pd.Timestamp(year=history_start_year, month=1, day=1), year_end)
+        history_key = hash_parts("design_history", station_id, history_start_year, year, history_watermark, version)
+        design_conditions_df = cached_frame("design_history", history_key, build_history, refresh=refresh_cache)
+
+    header_key = hash_parts(
+        "epw_header", data_key, history_key, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2, ground_model,
+        influx_watermark(query_api, OPEN_METEO_BUCKET_NAME, station_id, year_start, year_end), version
     )
+    header = cached_value("epw_header", header_key, lambda: compile_header(
+        df, city, country, lat, lon, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2,
+        design_conditions_df=design_conditions_df, use_model_for_ground=ground_model, station_id=station_id, query_api=query_api, ground_temps_bucket=OPEN_METEO_BUCKET_NAME
+    ), refresh=refresh_cache)
 
-    convert_to_epw(
+    cached_files("epw", hash_parts("epw", data_key, header_key), [f"{station_id}.epw"], lambda: convert_to_epw(
         df=compile_epw_data(df, lat, lon),
         header=header,
         station_id=station_id
-    )      
\ No newline at end of file
+    ), refresh=refresh_cache)
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+import pytz
+from datetime import datetime
+from timezone_lookup import get_tzwhere
+
+
+P_ATM_STD = 1013.25  # standard atmospheric pressure in hPa
+COINCIDENT_BIN = 0.5  # half-width of the bin used to compute mean coincident values
+RETURN_PERIODS = [5, 10, 20, 50]
+
+
+def get_standard_tz_offset(lat, lon):
+    zone = get_tzwhere()
+    timezone = pytz.timezone(zone.tzNameAt(lat, lon))
+    # January offset, i.e. without daylight saving time
+    return timezone.utcoffset(datetime(2001, 1, 15)).total_seconds() / 3600
+
+
+def sat_vapour_pressure(t):
+    # Saturation vapour pressure in hPa (Bolton 1980)
+    return 6.112 * np.exp((17.67 * t) / (t + 243.5))
+
+
+def humidity_ratio(t_dp, p_atm):
+    # Humidity ratio in g/kg of dry air
+    e = sat_vapour_pressure(t_dp)
+    return 621.945 * e / (p_atm - e)
+
+
+def wet_bulb(t_db, rh):
+    # Stull (2011) formula, the same used in compute_pdec_cdh_res.py
+    return (
+        t_db * np.arctan(0.151977 * np.sqrt(rh + 8.313659))
+        + np.arctan(t_db + rh)
+        - np.arctan(rh - 1.676331)
+        + 0.00391838 * np.sqrt(rh ** 3) * np.arctan(0.023101 * rh)
+        - 4.686035
+    )
+
+
+def enthalpy(t_db, hr):
+    # Moist air enthalpy in kJ/kg of dry air
+    return 1.006 * t_db + hr / 1000 * (2501 + 1.86 * t_db)
+
+
+def design_values(x, y, levels):
+    """Compute the percentiles of x and the mean coincident values of y.
+
+    :param x: Design variable
+    :type x: class:`numpy.ndarray`
+    :param y: Coincident variable
+    :type y: class:`numpy.ndarray`
+    :param levels: Percentiles to be computed (0-100)
+    :type levels: List[float]
+    :return: Tuple made of (percentiles of x, mean coincident values of y)
+    :rtype: tuple
+    """
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[valid], y[valid]
+    if len(x) == 0:
+        return np.full(len(levels), np.nan), np.full(len(levels), np.nan)
+    p = np.percentile(x, levels)
+    coincident = np.abs(x[None, :] - p[:, None]) <= COINCIDENT_BIN
+    with np.errstate(invalid='ignore'):
+        mean_y = (coincident @ y) / coincident.sum(axis=1)
+    return p, mean_y
+
+
+def coincident_wind(ws, wd, mask):
+    # Mean coincident wind speed and prevailing coincident wind direction (10° sectors)
+    ws, wd = ws[mask], wd[mask]
+    wd = wd[~np.isnan(wd)]
+    mcws = np.nanmean(ws) if len(ws) > 0 else np.nan
+    if len(wd) == 0:
+        return mcws, np.nan
+    sectors = np.bincount((np.rint(wd / 10).astype(int)) % 36, minlength=36)
+    return mcws, sectors.argmax() * 10
+
+
+def compute_design_conditions(df, tz=0):
+    """Compute the ASHRAE-like climatic design conditions from an hourly
+    weather history.
+
+    :param df: DataFrame with an UTC timestamp index and at least "T_db[C]",
+        "T_dp[C]", "RH[%]", "v_air[m/s]" and "wind_dir[o]" columns
+        ("P_atm[hPa]" is optional), possibly spanning several years
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param tz: Standard time zone offset in hours, defaults to 0
+    :type tz: float, optional
+    :return: Design conditions, with the same keys as the ASHRAE Meteo API
+    :rtype: dict
+    """
+    df = df.resample("1H").mean(numeric_only=True)
+    t_db = df["T_db[C]"].values
+    t_dp = df["T_dp[C]"].values
+    rh = df["RH[%]"].values
+    ws = df["v_air[m/s]"].values
+    wd = df["wind_dir[o]"].values
+    p_atm = df["P_atm[hPa]"].fillna(P_ATM_STD).values if "P_atm[hPa]" in df.columns else np.full(len(df), P_ATM_STD)
+    t_wb = wet_bulb(t_db, rh)
+    hr = humidity_ratio(t_dp, p_atm)
+    h = enthalpy(t_db, hr)
+    p_mean = np.nanmean(p_atm)
+
+    months = df.index.month.values
+    t_mon = df["T_db[C]"].groupby(months).mean()
+    coldest_month = int(t_mon.idxmin())
+    hottest_month = int(t_mon.idxmax())
+
+    data = {"coldest_month": coldest_month, "hottest_month": hottest_month}
+
+    # Heating and humidification (99.6% and 99%)
+    heating_db = np.nanpercentile(t_db, [0.4, 1])
+    data["heating_DB_99.6"], data["heating_DB_99"] = heating_db
+    hum_dp, hum_mcdb = design_values(t_dp, t_db, [0.4, 1])
+    hum_hr = humidity_ratio(hum_dp, p_mean)
+    for idx, lvl in enumerate(["99.6", "99"]):
+        data[f"humidification_DP/MCDB_and_HR_{lvl}_DP"] = hum_dp[idx]
+        data[f"humidification_DP/MCDB_and_HR_{lvl}_HR"] = hum_hr[idx]
+    data["humidification_DP/MCDB_and_HR_99.6_MCDB"] = hum_mcdb[0]
+    data["humidification_DP/MCDB_and_HR_99_MSDB"] = hum_mcdb[1]
+
+    cold = months == coldest_month
+    cold_ws, cold_mcdb = design_values(ws[cold], t_db[cold], [99.6, 99])
+    for idx, lvl in enumerate(["0.4", "1"]):
+        data[f"coldest_month_WS/MSDB_{lvl}_WS"] = cold_ws[idx]
+        data[f"coldest_month_WS/MSDB_{lvl}_MCDB"] = cold_mcdb[idx]
+    data["MCWS/PCWD_to_99.6_DB_MCWS"], data["MCWS/PCWD_to_99.6_DB_PCWD"] = coincident_wind(ws, wd, t_db <= heating_db[0])
+
+    # Cooling, evaporation, dehumidification and enthalpy (0.4%, 1% and 2%)
+    daily = df["T_db[C]"].resample("1D").agg(["min", "max"])
+    hot_days = daily[daily.index.month == hottest_month]
+    data["hottest_month_DB_range"] = (hot_days["max"] - hot_days["min"]).mean()
+
+    levels = [99.6, 99, 98]
+    cool_db, cool_mcwb = design_values(t_db, t_wb, levels)
+    evap_wb, evap_mcdb = design_values(t_wb, t_db, levels)
+    dehum_dp, dehum_mcdb = design_values(t_dp, t_db, levels)
+    dehum_hr = humidity_ratio(dehum_dp, p_mean)
+    enth, enth_mcdb = design_values(h, t_db, levels)
+    for idx, lvl in enumerate(["0.4", "1", "2"]):
+        data[f"cooling_DB_MCWB_{lvl}_DB"] = cool_db[idx]
+        data[f"cooling_DB_MCWB_{lvl}_MCWB"] = cool_mcwb[idx]
+        data[f"evaporation_WB_MCDB_{lvl}_WB"] = evap_wb[idx]
+        data[f"evaporation_WB_MCDB_{lvl}_MCDB"] = evap_mcdb[idx]
+        data[f"dehumidification_DP/MCDB_and_HR_{lvl}_DP"] = dehum_dp[idx]
+        data[f"dehumidification_DP/MCDB_and_HR_{lvl}_HR"] = dehum_hr[idx]
+        data[f"dehumidification_DP/MCDB_and_HR_{lvl}_MCDB"] = dehum_mcdb[idx]
+        data[f"enthalpy_MCDB_{lvl}_enth"] = enth[idx]
+        data[f"enthalpy_MCDB_{lvl}_MCDB"] = enth_mcdb[idx]
+    data["MCWS_PCWD_to_0.4_DB_MCWS"], data["MCWS_PCWD_to_0.4_DB_PCWD"] = coincident_wind(ws, wd, t_db >= cool_db[0])
+
+    # Yearly average number of hours between 8 a.m. and 4 p.m. (local time) with 12.8 < DB < 20.6
+    local_hours = (df.index.hour.values + tz) % 24
+    office_hours = (local_hours >= 8) & (local_hours < 16) & (t_db > 12.8) & (t_db < 20.6)
+    n_years = max(len(np.unique(df.index.year[~np.isnan(t_db)])), 1)
+    data["hours_8_to_4_and_12.8/20.6"] = office_hours.sum() / n_years
+
+    # Extremes
+    extreme_ws = np.nanpercentile(ws, [99, 97.5, 95])
+    data["extreme_annual_WS_1"], data["extreme_annual_WS_2.5"], data["extreme_annual_WS_5"] = extreme_ws
+    data["extreme_max_WB"] = np.nanmax(t_wb)
+
+    yearly = df["T_db[C]"].groupby(df.index.year).agg(["min", "max"]).dropna()
+    mean_min, mean_max = yearly["min"].mean(), yearly["max"].mean()
+    std_min, std_max = yearly["min"].std(), yearly["max"].std()
+    data["extreme_annual_DB_mean_min"], data["extreme_annual_DB_mean_max"] = mean_min, mean_max
+    data["extreme_annual_DB_standard_deviation_min"], data["extreme_annual_DB_standard_deviation_max"] = std_min, std_max
+
+    # Gumbel distribution, as in ASHRAE Handbook - Fundamentals (2009), chapter 14
+    n = np.array(RETURN_PERIODS)
+    f = -(np.sqrt(6) / np.pi) * (0.5772 + np.log(np.log(n / (n - 1))))
+    for idx, period in enumerate(RETURN_PERIODS):
+        data[f"n-year_return_period_values_of_extreme_DB_{period}_min"] = mean_min - f[idx] * std_min
+        data[f"n-year_return_period_values_of_extreme_DB_{period}_max"] = mean_max + f[idx] * std_max
+
+    return {
+        k: v if k in ["coldest_month", "hottest_month"] or np.isnan(v) else round(float(v), 1)
+        for k, v in data.items()
+    }
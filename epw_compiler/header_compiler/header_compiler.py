@@ -2,10 +2,16 @@ import pandas as pd
 import requests
 import json
 import os
-from math import radians, cos, sin, asin, sqrt, inf
+import sys
+from math import radians, cos, sin, asin, sqrt, inf, isnan
 import argparse
 from datetime import datetime as dt
 from datetime import date, timedelta
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../../soil_temp_and_cooling_systems")
+from soil_model import monthly_ground_temps
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/..")
+from open_meteo_client import GROUND_TEMPS_MEASUREMENT, SOIL_TEMP_FIELDS
+from header_compiler.design_conditions import compute_design_conditions, get_standard_tz_offset
 
 
 EARTH_R = 6371e3
@@ -73,7 +79,19 @@ def get_design_conditions(wmo):
     decoded_data = res.text.encode().decode('utf-8-sig')
     data = json.loads(decoded_data)["meteo_stations"][0]
     tz = data["time_zone"]
-    return tz, f'DESIGN CONDITIONS,1,Climate Design Data 2009 ASHRAE Handbook,,Heating,{data["coldest_month"]},{data["heating_DB_99.6"]},{data["heating_DB_99"]},{data["humidification_DP/MCDB_and_HR_99.6_DP"]},{data["humidification_DP/MCDB_and_HR_99.6_HR"]},{data["humidification_DP/MCDB_and_HR_99.6_MCDB"]},{data["humidification_DP/MCDB_and_HR_99_DP"]},{data["humidification_DP/MCDB_and_HR_99_HR"]},{data["humidification_DP/MCDB_and_HR_99_MSDB"]},{data["coldest_month_WS/MSDB_0.4_WS"]},{data["coldest_month_WS/MSDB_0.4_MCDB"]},{data["coldest_month_WS/MSDB_1_WS"]},{data["coldest_month_WS/MSDB_1_MCDB"]},{data["MCWS/PCWD_to_99.6_DB_MCWS"]},{data["MCWS/PCWD_to_99.6_DB_PCWD"]},Cooling,{data["hottest_month"]},{data["hottest_month_DB_range"]},{data["cooling_DB_MCWB_0.4_DB"]},{data["cooling_DB_MCWB_0.4_MCWB"]},{data["cooling_DB_MCWB_1_DB"]},{data["cooling_DB_MCWB_1_MCWB"]},{data["cooling_DB_MCWB_2_DB"]},{data["cooling_DB_MCWB_2_MCWB"]},{data["evaporation_WB_MCDB_0.4_WB"]},{data["evaporation_WB_MCDB_0.4_MCDB"]},{data["evaporation_WB_MCDB_1_WB"]},{data["evaporation_WB_MCDB_1_MCDB"]},{data["evaporation_WB_MCDB_2_WB"]},{data["evaporation_WB_MCDB_2_MCDB"]},{data["MCWS_PCWD_to_0.4_DB_MCWS"]},{data["MCWS_PCWD_to_0.4_DB_PCWD"]},{data["dehumidification_DP/MCDB_and_HR_0.4_DP"]},{data["dehumidification_DP/MCDB_and_HR_0.4_HR"]},{data["dehumidification_DP/MCDB_and_HR_0.4_MCDB"]},{data["dehumidification_DP/MCDB_and_HR_1_DP"]},{data["dehumidification_DP/MCDB_and_HR_1_HR"]},{data["dehumidification_DP/MCDB_and_HR_1_MCDB"]},{data["dehumidification_DP/MCDB_and_HR_2_DP"]},{data["dehumidification_DP/MCDB_and_HR_2_HR"]},{data["dehumidification_DP/MCDB_and_HR_2_MCDB"]},{data["enthalpy_MCDB_0.4_enth"]},{data["enthalpy_MCDB_0.4_MCDB"]},{data["enthalpy_MCDB_1_enth"]},{data["enthalpy_MCDB_1_MCDB"]},{data["enthalpy_MCDB_2_enth"]},{data["enthalpy_MCDB_2_MCDB"]},{data["hours_8_to_4_and_12.8/20.6"]},Extremes,{data["extreme_annual_WS_1"]},{data["extreme_annual_WS_2.5"]},{data["extreme_annual_WS_5"]},{data["extreme_max_WB"]},{data["extreme_annual_DB_mean_min"]},{data["extreme_annual_DB_mean_max"]},{data["extreme_annual_DB_standard_deviation_min"]},{data["extreme_annual_DB_standard_deviation_max"]},{data["n-year_return_period_values_of_extreme_DB_5_min"]},{data["n-year_return_period_values_of_extreme_DB_5_max"]},{data["n-year_return_period_values_of_extreme_DB_10_min"]},{data["n-year_return_period_values_of_extreme_DB_10_max"]},{data["n-year_return_period_values_of_extreme_DB_20_min"]},{data["n-year_return_period_values_of_extreme_DB_20_max"]},{data["n-year_return_period_values_of_extreme_DB_50_min"]},{data["n-year_return_period_values_of_extreme_DB_50_max"]}'
+    return tz, format_design_conditions(data)
+
+
+def format_design_conditions(data, source="Climate Design Data 2009 ASHRAE Handbook"):
+    data = {k: "" if isinstance(v, float) and isnan(v) else v for k, v in data.items()}
+    return f'DESIGN CONDITIONS,1,{source},,Heating,{data["coldest_month"]},{data["heating_DB_99.6"]},{data["heating_DB_99"]},{data["humidification_DP/MCDB_and_HR_99.6_DP"]},{data["humidification_DP/MCDB_and_HR_99.6_HR"]},{data["humidification_DP/MCDB_and_HR_99.6_MCDB"]},{data["humidification_DP/MCDB_and_HR_99_DP"]},{data["humidification_DP/MCDB_and_HR_99_HR"]},{data["humidification_DP/MCDB_and_HR_99_MSDB"]},{data["coldest_month_WS/MSDB_0.4_WS"]},{data["coldest_month_WS/MSDB_0.4_MCDB"]},{data["coldest_month_WS/MSDB_1_WS"]},{data["coldest_month_WS/MSDB_1_MCDB"]},{data["MCWS/PCWD_to_99.6_DB_MCWS"]},{data["MCWS/PCWD_to_99.6_DB_PCWD"]},Cooling,{data["hottest_month"]},{data["hottest_month_DB_range"]},{data["cooling_DB_MCWB_0.4_DB"]},{data["cooling_DB_MCWB_0.4_MCWB"]},{data["cooling_DB_MCWB_1_DB"]},{data["cooling_DB_MCWB_1_MCWB"]},{data["cooling_DB_MCWB_2_DB"]},{data["cooling_DB_MCWB_2_MCWB"]},{data["evaporation_WB_MCDB_0.4_WB"]},{data["evaporation_WB_MCDB_0.4_MCDB"]},{data["evaporation_WB_MCDB_1_WB"]},{data["evaporation_WB_MCDB_1_MCDB"]},{data["evaporation_WB_MCDB_2_WB"]},{data["evaporation_WB_MCDB_2_MCDB"]},{data["MCWS_PCWD_to_0.4_DB_MCWS"]},{data["MCWS_PCWD_to_0.4_DB_PCWD"]},{data["dehumidification_DP/MCDB_and_HR_0.4_DP"]},{data["dehumidification_DP/MCDB_and_HR_0.4_HR"]},{data["dehumidification_DP/MCDB_and_HR_0.4_MCDB"]},{data["dehumidification_DP/MCDB_and_HR_1_DP"]},{data["dehumidification_DP/MCDB_and_HR_1_HR"]},{data["dehumidification_DP/MCDB_and_HR_1_MCDB"]},{data["dehumidification_DP/MCDB_and_HR_2_DP"]},{data["dehumidification_DP/MCDB_and_HR_2_HR"]},{data["dehumidification_DP/MCDB_and_HR_2_MCDB"]},{data["enthalpy_MCDB_0.4_enth"]},{data["enthalpy_MCDB_0.4_MCDB"]},{data["enthalpy_MCDB_1_enth"]},{data["enthalpy_MCDB_1_MCDB"]},{data["enthalpy_MCDB_2_enth"]},{data["enthalpy_MCDB_2_MCDB"]},{data["hours_8_to_4_and_12.8/20.6"]},Extremes,{data["extreme_annual_WS_1"]},{data["extreme_annual_WS_2.5"]},{data["extreme_annual_WS_5"]},{data["extreme_max_WB"]},{data["extreme_annual_DB_mean_min"]},{data["extreme_annual_DB_mean_max"]},{data["extreme_annual_DB_standard_deviation_min"]},{data["extreme_annual_DB_standard_deviation_max"]},{data["n-year_return_period_values_of_extreme_DB_5_min"]},{data["n-year_return_period_values_of_extreme_DB_5_max"]},{data["n-year_return_period_values_of_extreme_DB_10_min"]},{data["n-year_return_period_values_of_extreme_DB_10_max"]},{data["n-year_return_period_values_of_extreme_DB_20_min"]},{data["n-year_return_period_values_of_extreme_DB_20_max"]},{data["n-year_return_period_values_of_extreme_DB_50_min"]},{data["n-year_return_period_values_of_extreme_DB_50_max"]}'
+
+
+def get_local_design_conditions(df, lat, lon):
+    # Offline alternative to get_design_conditions, computed from the station's own hourly history
+    tz = get_standard_tz_offset(lat, lon)
+    start_year, end_year = df.index[0].year, df.index[-1].year
+    return tz, format_design_conditions(compute_design_conditions(df, tz), f"Computed from station data {start_year}-{end_year}")
 
 
 def get_te_periods(df, year):
@@ -194,41 +212,76 @@ def get_location_data(city, state, country, source, wmo, lat, lon, tz):
     return f"LOCATION,{city},{state},{country},{source},{wmo},{lat},{lon},{tz},{elevation}"
 
 
-def get_ground_temps(df, lat, lon, start_date, end_date, use_source=False):
-    if use_source:
-        df = df.resample("1M").mean()
-        soil_temps = "GROUND TEMPERATURES,4"
-        depths = ["0.04", "0.18", "0.64", "1.77"]
-        for idx, depth in enumerate(df[['soil_temperature_0_to_7cm (°C)', 'soil_temperature_7_to_28cm (°C)', 'soil_temperature_28_to_100cm (°C)', 'soil_temperature_100_to_255cm (°C)']]):
-            soil_temps += f",{depths[idx]},,,"
-            for val in df[[depth]].values:
-                soil_temps += f",{round(val[0], 2)}"
-        return soil_temps
-    else:
-        df = pd.read_csv(
-            f"https://archive-api.open-meteo.com/v1/archive?latitude={lat}&longitude={lon}&start_date={start_date}&end_date={end_date}&hourly=soil_temperature_0_to_7cm,soil_temperature_7_to_28cm,soil_temperature_28_to_100cm,soil_temperature_100_to_255cm&timezone=Europe%2FBerlin&format=csv", header=2)
-        df.index = pd.to_datetime(df['time'])
-        df.drop(columns=['time'], inplace=True)
-        df = df.resample("1M").mean()
-        soil_temps = "GROUND TEMPERATURES,4"
-        depths = ["0.04", "0.18", "0.64", "1.77"]
-        for idx, depth in enumerate(df):
-            soil_temps += f",{depths[idx]},,,"
-            for val in df[[depth]].values:
-                soil_temps += f",{round(val[0], 2)}"
-        return soil_temps
+GROUND_TEMPS_DEPTHS = ["0.04", "0.18", "0.64", "1.77"]
+GROUND_TEMPS_FIELDS = list(SOIL_TEMP_FIELDS.values())
+
 
+def format_ground_temps(df):
+    soil_temps = f"GROUND TEMPERATURES,{len(df.columns)}"
+    for idx, depth in enumerate(df):
+        soil_temps += f",{GROUND_TEMPS_DEPTHS[idx]},,,"
+        for val in df[[depth]].values:
+            soil_temps += f",{round(val[0], 2)}"
+    return soil_temps
 
-def compile_header(df, city, country, lat, lon, state="", source="", leap=False, dst_start_date="0", dst_end_date="0", start_weekday="Monday", comment1="", comment2="", use_source_for_ground=False):
+
+def query_ground_temps_rollup(query_api, bucket, station_id, start_date, end_date):
+    query = f'from(bucket:"{bucket}")\
+        |> range(start: {start_date}T00:00:00Z, stop: {end_date}T23:59:59Z)\
+        |> filter(fn: (r) => r["_measurement"] == "{GROUND_TEMPS_MEASUREMENT}" and r["station"] == "{station_id}")\
+        |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+
+    df = query_api.query_data_frame(query)
+    if df.empty or not set(GROUND_TEMPS_FIELDS).issubset(df.columns):
+        return None
+    # One row per calendar month, averaged over the years of the range; a partial
+    # rollup falls back to the Open-Meteo download
+    df.index = pd.to_datetime(df['_time'])
+    df = df[GROUND_TEMPS_FIELDS].groupby(df.index.month).mean()
+    if len(df) < 12 or df.isna().any().any():
+        return None
+    return df
+
+
+def get_ground_temps(df, lat, lon, start_date, end_date, use_source=False, station_id=None, query_api=None, bucket=None):
+    if use_source:
+        df = df.resample("1M").mean()
+        return format_ground_temps(df[list(SOIL_TEMP_FIELDS)])
+    if station_id is not None and query_api is not None:
+        # Monthly rollup written at ingest time by data_scraper_and_uploader.py
+        df = query_ground_temps_rollup(query_api, bucket, station_id, start_date, end_date)
+        if df is not None:
+            return format_ground_temps(df)
+    df = pd.read_csv(
+        f"https://archive-api.open-meteo.com/v1/archive?latitude={lat}&longitude={lon}&start_date={start_date}&end_date={end_date}&hourly=soil_temperature_0_to_7cm,soil_temperature_7_to_28cm,soil_temperature_28_to_100cm,soil_temperature_100_to_255cm&timezone=Europe%2FBerlin&format=csv", header=2)
+    df.index = pd.to_datetime(df['time'])
+    df.drop(columns=['time'], inplace=True)
+    df = df.resample("1M").mean()
+    return format_ground_temps(df)
+
+
+def get_model_ground_temps(df):
+    # Offline alternative to get_ground_temps, based on the Labs soil temperature model
+    temps = monthly_ground_temps(df, depths=[float(d) for d in GROUND_TEMPS_DEPTHS])
+    return format_ground_temps(pd.DataFrame(temps.T))
+
+
+def compile_header(df, city, country, lat, lon, state="", source="", leap=False, dst_start_date="0", dst_end_date="0", start_weekday="Monday", comment1="", comment2="", design_conditions_df=None, use_source_for_ground=False, use_model_for_ground=False, station_id=None, query_api=None, ground_temps_bucket=None):
     start_date = df.index[0].strftime("%Y-%m-%d")
     end_date = df.index[-1].strftime("%Y-%m-%d")
 
     wmo = find_closest_wmo_station((lat, lon))
-    tz, design_conditions = get_design_conditions(wmo)
+    if design_conditions_df is not None:
+        tz, design_conditions = get_local_design_conditions(design_conditions_df, lat, lon)
+    else:
+        tz, design_conditions = get_design_conditions(wmo)
     te_periods = get_te_periods(df, dt.fromisoformat(start_date).year)
     location_data = get_location_data(
         city, state, country, source, wmo, lat, lon, tz)
-    ground_temps = get_ground_temps(df, lat, lon, start_date, end_date, use_source=use_source_for_ground)
+    if use_model_for_ground:
+        ground_temps = get_model_ground_temps(df)
+    else:
+        ground_temps = get_ground_temps(df, lat, lon, start_date, end_date, use_source=use_source_for_ground, station_id=station_id, query_api=query_api, bucket=ground_temps_bucket)
 
     isLeap = "Yes" if leap else "No"
     holidays_dst_data = f"HOLIDAYS/DAYLIGHT SAVINGS,{isLeap},{dst_start_date},{dst_end_date},0"
@@ -0,0 +1,80 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+INFLUX_META_COLUMNS = ['result', 'table', '_start', '_stop', '_time', 'coords', '_measurement']
+QC_PREFIX = 'qc_'  # Quality flag fields, written by uhi_effect/spatial_qc.py
+
+
+def apply_qc_flags(df):
+    """Mask the values flagged by the spatial quality control and drop the
+    flag columns (the hourly mean of a flag is positive if any of its points
+    was flagged).
+
+    :param df: DataFrame with one column per field, flags included
+    :type df: class:`pandas.core.frame.DataFrame`
+    :return: DataFrame without the flag columns, NaN where a value was flagged
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    qc_columns = [c for c in df.columns if isinstance(c, str) and c.startswith(QC_PREFIX)]
+    for c in qc_columns:
+        field = c[len(QC_PREFIX):]
+        if field in df.columns:
+            df[field] = df[field].mask(df[c] > 0)
+    return df.drop(columns=qc_columns)
+
+
+def query_source(query_api, bucket, station_id, start, end):
+    """Query the hourly means of all the fields of a station from a bucket.
+
+    :param query_api: InfluxDB query API
+    :type query_api: class:`influxdb_client.QueryApi`
+    :param bucket: Bucket name
+    :type bucket: str
+    :param station_id: Weather station ID (measurement)
+    :type station_id: str
+    :param start: Start of the range
+    :type start: class:`pandas.Timestamp`
+    :param end: End of the range (excluded)
+    :type end: class:`pandas.Timestamp`
+    :return: DataFrame with a (naive UTC) timestamp index and one column per field
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    query = f'from(bucket:"{bucket}")\
+            |> range(start: {start - pd.Timedelta(minutes=1):%Y-%m-%dT%H:%M:%SZ}, stop: {end - pd.Timedelta(seconds=1):%Y-%m-%dT%H:%M:%SZ})\
+            |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
+            |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
+            |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+
+    df = query_api.query_data_frame(query)
+    if df.empty:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='timestamp'))
+    df.index = pd.to_datetime(df['_time'])
+    df.index = df.index.tz_localize(None)
+    df.sort_index(inplace=True)
+
+    df.drop(columns=[c for c in INFLUX_META_COLUMNS if c in df.columns], inplace=True)
+    return apply_qc_flags(df).rename_axis('timestamp')
+
+
+def query_sources(query_api, buckets, station_id, start, end):
+    """Query the same station from several buckets concurrently and align the
+    results on a shared hourly index.
+
+    :param query_api: InfluxDB query API
+    :type query_api: class:`influxdb_client.QueryApi`
+    :param buckets: Bucket names
+    :type buckets: list
+    :param station_id: Weather station ID (measurement)
+    :type station_id: str
+    :param start: Start of the range
+    :type start: class:`pandas.Timestamp`
+    :param end: End of the range (excluded)
+    :type end: class:`pandas.Timestamp`
+    :return: DataFrame with (source, variable) columns
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+        dfs = list(executor.map(lambda bucket: query_source(query_api, bucket, station_id, start, end), buckets))
+    df = pd.concat(dict(zip(buckets, dfs)), axis=1, names=['source', 'variable']).sort_index()
+    return df.rename_axis('timestamp')
@@ -0,0 +1,179 @@
+import io
+import os
+import time
+import requests
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+CACHE_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/../om_cache"
+HOURLY_VARIABLES = [
+    "temperature_2m",
+    "relativehumidity_2m",
+    "dewpoint_2m",
+    "precipitation",
+    "pressure_msl",
+    "windspeed_10m",
+    "winddirection_10m",
+    "soil_temperature_0_to_7cm",
+    "soil_temperature_7_to_28cm",
+    "soil_temperature_28_to_100cm",
+    "soil_temperature_100_to_255cm",
+    "diffuse_radiation"
+]
+HOURLY_OPTIONS = {"windspeed_unit": "ms"}
+# Downscaling to the DEM elevation of the requested point disabled, so that the series is the one of the whole grid cell
+CELL_OPTIONS = {**HOURLY_OPTIONS, "elevation": "nan"}
+# Monthly soil temperature rollup written at ingest time and read by the EPW header compiler
+GROUND_TEMPS_MEASUREMENT = "ground_temperatures"
+SOIL_TEMP_FIELDS = {
+    "soil_temperature_0_to_7cm (°C)": "T_soil_0_7cm[C]",
+    "soil_temperature_7_to_28cm (°C)": "T_soil_7_28cm[C]",
+    "soil_temperature_28_to_100cm (°C)": "T_soil_28_100cm[C]",
+    "soil_temperature_100_to_255cm (°C)": "T_soil_100_255cm[C]"
+}
+GRID_RESOLUTION = 0.1  # ERA5-Land grid spacing in degrees
+MAX_WORKERS = 4
+RETRIES = 3
+
+
+def snap_to_grid(lat, lon, resolution=GRID_RESOLUTION):
+    """Snap coordinates to the centre of the reanalysis grid cell containing
+    them. Requested at the cell centre with CELL_OPTIONS, all the points of a
+    cell share the same series, requests and cache entries.
+
+    :param lat: Latitude
+    :type lat: float
+    :param lon: Longitude
+    :type lon: float
+    :param resolution: Grid spacing in degrees, defaults to GRID_RESOLUTION
+    :type resolution: float, optional
+    :return: Tuple made of (lat, lon) of the cell centre
+    :rtype: tuple
+    """
+    return round(round(lat / resolution) * resolution, 4), round(round(lon / resolution) * resolution, 4)
+
+
+def cache_path(cache_dir, lat, lon, year, frequency, options):
+    # The request options (units, time zone) change the values, so they are part of the key
+    variant = "_".join([frequency] + [f"{k}-{v}" for k, v in sorted(options.items())])
+    return f"{cache_dir}/{lat}_{lon}/{variant}/{year}.parquet"
+
+
+def variable_name(column):
+    # CSV columns are named after the variable followed by its unit, e.g. "temperature_2m (°C)"
+    return column.split(" ")[0]
+
+
+def fetch_year(lat, lon, year, variables, frequency="hourly", options=None, retries=RETRIES):
+    """Download one year of the Open-Meteo archive.
+
+    :param lat: Latitude
+    :type lat: float
+    :param lon: Longitude
+    :type lon: float
+    :param year: Year
+    :type year: int
+    :param variables: Open-Meteo variables
+    :type variables: list
+    :param frequency: "hourly" or "daily", defaults to "hourly"
+    :type frequency: str, optional
+    :param options: Additional request parameters (e.g. units), defaults to None
+    :type options: dict, optional
+    :param retries: Number of attempts, defaults to 3
+    :type retries: int, optional
+    :return: DataFrame with a "time" index and one column per variable
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    # The archive does not contain future dates
+    end_date = min(date(year, 12, 31), date.today())
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "start_date": f"{year}-01-01",
+        "end_date": f"{end_date:%Y-%m-%d}",
+        frequency: ",".join(variables),
+        "format": "csv",
+        **(options or {})
+    }
+    for attempt in range(retries):
+        try:
+            res = requests.get(ARCHIVE_URL, params=params, timeout=120)
+            res.raise_for_status()
+            break
+        except requests.exceptions.RequestException as e:
+            if attempt == retries - 1:
+                raise
+            print(f"Open-Meteo request for {lat}, {lon}, {year} failed ({e}), retrying")
+            time.sleep(2 ** attempt)
+
+    df = pd.read_csv(
+        io.StringIO(res.text),
+        header=2,
+        usecols=lambda c: variable_name(c) in ["time"] + variables,
+        dtype=defaultdict(lambda: "float64", time="str")
+    )
+    df.index = pd.to_datetime(df.pop("time"))
+    return df
+
+
+def fetch_archive(lat, lon, start_year, end_year, variables=HOURLY_VARIABLES, frequency="hourly", options=HOURLY_OPTIONS, cache_dir=CACHE_DIR, max_workers=MAX_WORKERS):
+    """Read the Open-Meteo archive of a location, one request per year.
+
+    The complete years are kept in a local Parquet archive (one file per
+    location and year), so only the years which are not there yet are
+    downloaded, concurrently. The current year is never cached.
+
+    :param lat: Latitude
+    :type lat: float
+    :param lon: Longitude
+    :type lon: float
+    :param start_year: Start year
+    :type start_year: int
+    :param end_year: End year (included)
+    :type end_year: int
+    :param variables: Open-Meteo variables, defaults to HOURLY_VARIABLES
+    :type variables: list, optional
+    :param frequency: "hourly" or "daily", defaults to "hourly"
+    :type frequency: str, optional
+    :param options: Additional request parameters, defaults to HOURLY_OPTIONS
+    :type options: dict, optional
+    :param cache_dir: Directory of the local archive, defaults to CACHE_DIR
+    :type cache_dir: str, optional
+    :param max_workers: Number of concurrent requests, defaults to 4
+    :type max_workers: int, optional
+    :return: DataFrame with a "time" index and the Open-Meteo CSV columns
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    years = range(start_year, end_year+1)
+    current_year = date.today().year
+    chunks = {}
+    download_variables = variables
+    for year in years:
+        path = cache_path(cache_dir, lat, lon, year, frequency, options)
+        if year < current_year and os.path.exists(path):
+            df = pd.read_parquet(path)
+            if set(variables) <= set(variable_name(c) for c in df.columns):
+                chunks[year] = df
+            else:
+                # Download the union of the cached and requested variables, so the cache keeps growing
+                download_variables = list(dict.fromkeys(download_variables + [variable_name(c) for c in df.columns]))
+
+    def fetch(year):
+        df = fetch_year(lat, lon, year, download_variables, frequency, options)
+        if year < current_year:
+            path = cache_path(cache_dir, lat, lon, year, frequency, options)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_parquet(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        return df
+
+    missing = [y for y in years if y not in chunks]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunks.update(zip(missing, executor.map(fetch, missing)))
+
+    df = pd.concat([chunks[y] for y in years])
+    return df[[c for c in df.columns if variable_name(c) in variables]]
@@ -0,0 +1,8 @@
+from functools import lru_cache
+from tzwhere import tzwhere
+
+
+@lru_cache(maxsize=None)
+def get_tzwhere():
+    # Loading the time zone polygons takes seconds, so the instance is built once per process
+    return tzwhere.tzwhere()
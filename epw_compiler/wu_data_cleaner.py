@@ -1,6 +1,7 @@
 import argparse
 import math
 import pandas as pd
+from gap_filler import fill_gaps
 
 
 def parse_args():
@@ -29,28 +30,11 @@ def compute_rain_type(prec_total, prec_rate):
         return 63
 
 
-def clean_data(df, year):
+def clean_data(df, year, strategy="same_hour", max_gap=None):
     df = df.resample("1H").mean(numeric_only=True)
     df.index = df.index.tz_localize(None)
 
-    # Set the desired time range
-    start_date = f'{year}-01-01 00:00:00'
-    end_date = f'{year}-12-31 23:59:59'
-
-    # Create a DateTimeIndex with hourly frequency
-    hourly_range = pd.date_range(start=start_date, end=end_date, freq='H')
-
-    # Create an empty DataFrame with the DateTimeIndex
-    df_filled = pd.DataFrame(index=hourly_range)
-
-    # Merge the empty DataFrame with your original data
-    df_merged = df_filled.merge(df, left_index=True, right_index=True, how='left')
-
-    # Forward-fill missing values with previous value at the same hour
-    df_filled = df_merged.groupby([df_merged.index.hour]).ffill()
-
-    # Backward-fill remaining missing values
-    df = df_filled.groupby([df_merged.index.hour]).bfill()
+    df, _ = fill_gaps(df, f'{year}-01-01', f'{year+1}-01-01', strategy=strategy, max_gap=max_gap)
 
     df_clean = pd.DataFrame(
         {
@@ -1,23 +1,10 @@
 import pandas as pd
-from math import exp, sqrt, pi, cos
 import argparse
-
-def estimate_surf_temp_amplitude(df: pd.DataFrame):
-    df_mon = df.resample('M').mean(numeric_only=True)
-    return 0.5*(df_mon.loc['1970-07-31', 'T_db[C]'] - df_mon.loc['1970-01-31', 'T_db[C]']) + 1.1
-
-def estimate_yearly_mean_surf_temp(df: pd.DataFrame):
-    df_year = df.resample('Y').mean(numeric_only=True)
-    return df_year.loc['1970-12-31', 'T_db[C]'] + 1.7
-
-def estimate_phase_const(df: pd.DataFrame):
-    min_sol_rad = df['GHI[W/m2]'].idxmin()
-    day_min_rad = (min_sol_rad.timestamp()/3600) // 24
-    day_min_temp = day_min_rad + 46
-    return day_min_temp if day_min_temp <= 364 else day_min_temp - 365
-
-def labs_exp_hourly(alpha_hourly: float, h: float, t_hours: int, surf_temp_amplitude: float, yearly_mean_surf_temp: float, phase_const: float):
-    return yearly_mean_surf_temp - surf_temp_amplitude*exp(-h*sqrt(pi/(365*24*alpha_hourly)))*cos((2*pi/(365*24))*(t_hours-phase_const-(h/2)*sqrt(365*24/(pi*alpha_hourly))))
+import sys
+sys.path.append('../tmy_compiler')
+from tmy_artifacts import load_tmy
+from soil_model import day_of_year, surface_params
+from cooling_sweep import eahx_cdh_res, degree_hours
 
 def cdh_res_eahx(df, var1, var2, var3, diffus = 6.177*(10**(-7)), depth = 2.5, eff= 0.8, thresholds=[18, 21, 24, 26]):
         """Compute CDH_res considering EAHX technology.
@@ -43,22 +30,10 @@ def cdh_res_eahx(df, var1, var2, var3, diffus = 6.177*(10**(-7)), depth = 2.5, e
         :rtype: float
         """
         df = df.resample("1H").mean(numeric_only=True)
-        
-        df["soilT"] = df.index.map(lambda t: labs_exp_hourly(diffus*3600, depth, (t.timestamp()//3600), var2, var1, var3))
-        df["t_treat"] = df['T_db_o[C]'] - eff*(df['T_db_o[C]'] - df['soilT'])
-
-        my_dict = {}
-        for th in thresholds:
 
-            df["dist ttreat-tbase"] = df["t_treat"] - th
-            df["dist tamb-tbase"] = df["T_db_o[C]"] - th
-            df["dist tamb-ttreat"] = df["T_db_o[C]"] - df["t_treat"]
-
-            sum_dist =  df["dist ttreat-tbase"].where(df["dist ttreat-tbase"]>0).sum()
-
-            my_dict[str(th)+"°C"] = sum_dist
-
-        return my_dict
+        # The phase constant is in days, so the hours are expressed as fractional days of the year
+        cdh_res = eahx_cdh_res(df['T_db_o[C]'].to_numpy(), day_of_year(df.index), [depth], [diffus], [eff], thresholds, (var2, var1, var3))
+        return {str(th)+"°C": cdh_res[0, 0, 0, i] for i, th in enumerate(thresholds)}
 
 def cdh(df, thresholds=[18, 21, 24, 26]):
     """Compute Cooling Degree Hours
@@ -73,25 +48,16 @@ def cdh(df, thresholds=[18, 21, 24, 26]):
     :rtype: dict
     """
     df = df.resample("1H").mean(numeric_only=True)
-    
-    my_dict = {}
-    for th in thresholds:
-        df[str(th)+"°C"] = df["T_db_o[C]"]-th
-        sum_dist = df[str(th)+"°C"].where(df[str(th)+"°C"]>0).sum()
-        my_dict[str(th)+"°C"] = sum_dist
-
-    return my_dict
+    cdh_base = degree_hours(df["T_db_o[C]"].to_numpy(), thresholds)
+    return {str(th)+"°C": cdh_base[i] for i, th in enumerate(thresholds)}
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--file", help="Path of the TMY file", required=True)
+parser.add_argument("-f", "--file", help="Path of the TMY file (parquet or csv format)", required=True)
 args = parser.parse_args()
 
-df = pd.read_csv(args.file)
+df, _ = load_tmy(args.file)
 df['T_db_o[C]'] = df['T_db[C]']
-df.index = pd.to_datetime(df['timestamp'])
-surf_temp_amplitude = estimate_surf_temp_amplitude(df)
-yearly_mean_surf_temp = estimate_yearly_mean_surf_temp(df)
-phase_const = estimate_phase_const(df)
+surf_temp_amplitude, yearly_mean_surf_temp, phase_const = surface_params(df)
 print("CDH for different temperature setpoints")
 print("EAHX: ", cdh_res_eahx(df, yearly_mean_surf_temp, surf_temp_amplitude, phase_const))
 print("Baseline: ", cdh(df))
\ No newline at end of file
@@ -0,0 +1,172 @@
+import pandas as pd
+import numpy as np
+import argparse
+import sys
+sys.path.append('../tmy_compiler')
+sys.path.append('../epw_compiler')
+from tmy_artifacts import load_tmy
+from header_compiler.design_conditions import wet_bulb
+from soil_model import DIFFS, labs_exp, day_of_year, surface_params
+
+DEPTHS = [1, 1.5, 2, 2.5, 3, 4, 5]
+EFFS = [0.5, 0.6, 0.7, 0.8, 0.9]
+THRESHOLDS = [18, 21, 24, 26]
+
+
+def degree_hours(t, thresholds):
+    """Sum the hourly exceedances of each base temperature, ignoring the
+    missing hours.
+
+    :param t: Hourly temperatures with shape (..., hours)
+    :type t: class:`numpy.ndarray`
+    :param thresholds: Base temperatures
+    :type thresholds: List[float]
+    :return: Degree hours with shape (..., thresholds)
+    :rtype: class:`numpy.ndarray`
+    """
+    # One pass per threshold in a reused buffer keeps the memory at the size of t (fmax turns NaN into 0)
+    t = np.asarray(t)
+    buffer = np.empty_like(t)
+    sums = []
+    for th in thresholds:
+        np.subtract(t, th, out=buffer)
+        np.fmax(buffer, 0, out=buffer)
+        sums.append(buffer.sum(axis=-1, dtype=np.float64))
+    return np.stack(sums, axis=-1)
+
+
+def eahx_cdh_res(t_db, t_days, depths, diffus, effs, thresholds, params):
+    """Residual cooling degree hours of an EAHX for every combination of
+    efficiency, soil diffusivity, depth and base temperature.
+
+    :param t_db: Hourly outdoor dry-bulb temperature in °C
+    :type t_db: class:`numpy.ndarray`
+    :param t_days: 0-based (fractional) day of the year of each hour
+    :type t_days: class:`numpy.ndarray`
+    :param depths: Soil depths of the EAHX tubes in meters
+    :type depths: List[float]
+    :param diffus: Soil thermal diffusivities in m2/s
+    :type diffus: List[float]
+    :param effs: EAHX efficiencies
+    :type effs: List[float]
+    :param thresholds: Base temperatures
+    :type thresholds: List[float]
+    :param params: Amplitude, yearly mean and phase constant of the soil surface temperature, as returned by soil_model.surface_params
+    :type params: tuple
+    :return: CDH_res_EAHX with shape (effs, diffus, depths, thresholds)
+    :rtype: class:`numpy.ndarray`
+    """
+    soil_t = labs_exp(
+        np.asarray(diffus, dtype=float)[:, None, None]*3600*24,
+        np.asarray(depths, dtype=float)[None, :, None],
+        np.asarray(t_days, dtype=float)[None, None, :],
+        *params
+    )
+    # The treated air temperatures of all the combinations are the largest array, so they are kept in float32
+    eff = np.asarray(effs, dtype=np.float32)[:, None, None, None]
+    t_db = np.asarray(t_db, dtype=np.float32)
+    t_treat = t_db - eff*(t_db - soil_t[None].astype(np.float32))
+    return degree_hours(t_treat, thresholds)
+
+
+def pdec_cdh_res(t_db, rh, effs, thresholds):
+    """Residual cooling degree hours of a PDEC system for every combination
+    of efficiency and base temperature.
+
+    :param t_db: Hourly outdoor dry-bulb temperature in °C
+    :type t_db: class:`numpy.ndarray`
+    :param rh: Hourly outdoor relative humidity in %
+    :type rh: class:`numpy.ndarray`
+    :param effs: PDEC efficiencies
+    :type effs: List[float]
+    :param thresholds: Base temperatures
+    :type thresholds: List[float]
+    :return: CDH_res_PDEC with shape (effs, thresholds)
+    :rtype: class:`numpy.ndarray`
+    """
+    eff = np.asarray(effs, dtype=float)[:, None]
+    t_treat = t_db - eff*(t_db - wet_bulb(t_db, rh))
+    return degree_hours(t_treat, thresholds)
+
+
+def tidy(cdh_res, cdh_base, axes):
+    # One row per combination, with the baseline CDH of its base temperature and the share removed by the system
+    index = pd.MultiIndex.from_product(list(axes.values()), names=list(axes))
+    df = pd.DataFrame({"CDH_res[°Ch]": cdh_res.reshape(-1)}, index=index).reset_index()
+    df["CDH[°Ch]"] = np.tile(cdh_base, len(df) // len(cdh_base))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        df["reduction[%]"] = 100*(1 - df["CDH_res[°Ch]"] / df["CDH[°Ch]"])
+    return df
+
+
+def sweep_eahx(df, depths=DEPTHS, diffus=list(DIFFS.values()), effs=EFFS, thresholds=THRESHOLDS):
+    """Sweep the design space of an EAHX on an hourly weather series.
+
+    :param df: DataFrame with a timestamp index and "T_db[C]" and "GHI[W/m2]"
+        columns, covering one year (e.g. a TMY)
+    :type df: class:`pandas.core.frame.DataFrame`
+    :return: Tidy table with one row per combination of efficiency, diffusivity, depth and base temperature
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    params = surface_params(df)
+    df = df.resample("1H").mean(numeric_only=True)
+    t_db = df["T_db[C]"].to_numpy()
+    cdh_res = eahx_cdh_res(t_db, day_of_year(df.index), depths, diffus, effs, thresholds, params)
+    return tidy(cdh_res, degree_hours(t_db, thresholds), {
+        "efficiency": effs,
+        "diffusivity[m2/s]": diffus,
+        "depth[m]": depths,
+        "T_base[C]": thresholds,
+    })
+
+
+def sweep_pdec(df, effs=EFFS, thresholds=THRESHOLDS):
+    """Sweep the efficiency of a PDEC system on an hourly weather series.
+
+    :param df: DataFrame with a timestamp index and "T_db[C]" and "RH[%]" columns
+    :type df: class:`pandas.core.frame.DataFrame`
+    :return: Tidy table with one row per combination of efficiency and base temperature
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    df = df.resample("1H").mean(numeric_only=True)
+    t_db = df["T_db[C]"].to_numpy()
+    cdh_res = pdec_cdh_res(t_db, df["RH[%]"].to_numpy(), effs, thresholds)
+    return tidy(cdh_res, degree_hours(t_db, thresholds), {
+        "efficiency": effs,
+        "T_base[C]": thresholds,
+    })
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", help="Path of the TMY file (parquet or csv format)", required=True)
+    parser.add_argument("--system", help="Cooling system to be assessed (default=both)", choices=["eahx", "pdec", "both"], default="both")
+    parser.add_argument("--depths", help="Space separated soil depths in meters of the EAHX tubes (default=1 1.5 2 2.5 3 4 5)", type=float, nargs='+', default=DEPTHS)
+    parser.add_argument("--soils", help=f"Space separated soil types ({', '.join(DIFFS)}) or thermal diffusivities in m2/s (default=all the soil types)", nargs='+', default=list(DIFFS))
+    parser.add_argument("--effs", help="Space separated efficiencies (default=0.5 0.6 0.7 0.8 0.9)", type=float, nargs='+', default=EFFS)
+    parser.add_argument("--thresholds", help="Space separated base temperatures in °C (default=18 21 24 26)", type=float, nargs='+', default=THRESHOLDS)
+    parser.add_argument("--csv", help="Path prefix of the csv files with the results (e.g. results/milan writes results/milan_eahx.csv)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    df, _ = load_tmy(args.file)
+    pd.set_option("display.width", 200)
+
+    results = {}
+    if args.system in ("eahx", "both"):
+        diffus = [DIFFS[s] if s in DIFFS else float(s) for s in args.soils]
+        results["eahx"] = sweep_eahx(df, args.depths, diffus, args.effs, args.thresholds)
+        # Soil types are reported by name when given by name
+        names = {DIFFS[s]: s for s in args.soils if s in DIFFS}
+        results["eahx"].insert(2, "soil", results["eahx"]["diffusivity[m2/s]"].map(names))
+    if args.system in ("pdec", "both"):
+        results["pdec"] = sweep_pdec(df, args.effs, args.thresholds)
+
+    for system, result in results.items():
+        print(f"{system.upper()}: {len(result)} combinations, lowest CDH_res per base temperature")
+        print(result.loc[result.groupby("T_base[C]")["CDH_res[°Ch]"].idxmin()].round({"CDH_res[°Ch]": 1, "CDH[°Ch]": 1, "reduction[%]": 1}).to_string(index=False))
+        if args.csv:
+            result.to_csv(f"{args.csv}_{system}.csv", index=False)
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from datetime import date
+
+DIFFS = {
+    'wet_clay': 6.177e-7,
+    'dry_clay': 4.891e-7,
+    'limestone': 1.907e-7,
+    'sand': 4.944e-7,
+}
+EPW_DEPTHS = [0.04, 0.18, 0.64, 1.77]
+# 0-based day of the year of the 15th of each month, used as representative day
+MID_MONTH_DAYS = np.array([date(1970, m, 15).timetuple().tm_yday - 1 for m in range(1, 13)])
+
+
+def estimate_surf_temp_amplitude(df: pd.DataFrame):
+    t_mon = df['T_db[C]'].groupby(df.index.month).mean()
+    return 0.5*(t_mon[7] - t_mon[1]) + 1.1
+
+def estimate_yearly_mean_surf_temp(df: pd.DataFrame):
+    return df['T_db[C]'].mean() + 1.7
+
+def estimate_phase_const(df: pd.DataFrame):
+    day_min_rad = df['GHI[W/m2]'].idxmin().dayofyear - 1
+    day_min_temp = day_min_rad + 46
+    return day_min_temp if day_min_temp <= 364 else day_min_temp - 365
+
+def labs_exp(alpha_daily, h, t_days, surf_temp_amplitude: float, yearly_mean_surf_temp: float, phase_const: float):
+    """Labs (Kusuda) soil temperature model, evaluated element-wise on
+    broadcastable arrays of depths and days.
+
+    :param alpha_daily: soil thermal diffusivity in m2/day
+    :type alpha_daily: float or class:`numpy.ndarray`
+    :param h: depth in meters
+    :type h: float or class:`numpy.ndarray`
+    :param t_days: 0-based day of the year
+    :type t_days: float or class:`numpy.ndarray`
+    :return: Soil temperature in °C
+    :rtype: class:`numpy.ndarray`
+    """
+    alpha_daily, h, t_days = np.asarray(alpha_daily), np.asarray(h), np.asarray(t_days)
+    return yearly_mean_surf_temp - surf_temp_amplitude*np.exp(-h*np.sqrt(np.pi/(365*alpha_daily)))*np.cos((2*np.pi/365)*(t_days-phase_const-(h/2)*np.sqrt(365/(np.pi*alpha_daily))))
+
+def surface_params(df: pd.DataFrame):
+    # Amplitude, yearly mean and phase constant of the soil surface temperature, in the order of the labs_exp arguments
+    return estimate_surf_temp_amplitude(df), estimate_yearly_mean_surf_temp(df), estimate_phase_const(df)
+
+def day_of_year(index: pd.DatetimeIndex):
+    # 0-based (fractional) day of the year of each timestamp
+    return (index.dayofyear - 1).to_numpy() + (index.hour + index.minute/60).to_numpy()/24
+
+def soil_temp_grid(df: pd.DataFrame, t_days, depths=EPW_DEPTHS, diffus=DIFFS['wet_clay']):
+    """Evaluate the Labs model of the soil below an hourly weather series on
+    the whole diffusivity x depth x time grid, with a single broadcast call.
+
+    :param df: DataFrame with a timestamp index and "T_db[C]" and "GHI[W/m2]"
+        columns, covering at least one full year
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param t_days: 0-based (fractional) days of the year, e.g. from day_of_year
+    :type t_days: class:`numpy.ndarray`
+    :param depths: ground depths in meters, defaults to the EPW depths
+    :type depths: List[float], optional
+    :param diffus: soil thermal diffusivities in m2/s (e.g. list(DIFFS.values())), defaults to 6.177*10^-7 (wet clay)
+    :type diffus: float or List[float], optional
+    :return: Soil temperatures in °C with shape (diffusivities, depths, times),
+        without the diffusivity axis when diffus is a float
+    :rtype: class:`numpy.ndarray`
+    """
+    alpha_daily = np.asarray(diffus, dtype=float)*3600*24
+    temps = labs_exp(
+        alpha_daily.reshape(-1, 1, 1),
+        np.asarray(depths, dtype=float)[None, :, None],
+        np.asarray(t_days, dtype=float)[None, None, :],
+        *surface_params(df)
+    )
+    return temps[0] if alpha_daily.ndim == 0 else temps
+
+def monthly_ground_temps(df: pd.DataFrame, depths=EPW_DEPTHS, diffus=DIFFS['wet_clay']):
+    """Compute the monthly ground temperatures of an hourly weather series.
+
+    :param df: DataFrame with a timestamp index and "T_db[C]" and "GHI[W/m2]"
+        columns, covering at least one full year
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param depths: ground depths in meters, defaults to the EPW depths
+    :type depths: List[float], optional
+    :param diffus: soil thermal diffusivity in m2/s, defaults to 6.177*10^-7 (wet clay)
+    :type diffus: float, optional
+    :return: Ground temperatures on the 15th of each month, with shape (depths, 12)
+    :rtype: class:`numpy.ndarray`
+    """
+    return soil_temp_grid(df, MID_MONTH_DAYS, depths, diffus)
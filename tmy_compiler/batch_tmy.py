@@ -0,0 +1,289 @@
+import numpy as np
+import pandas as pd
+import argparse
+from influxdb_client import InfluxDBClient
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from dotenv import load_dotenv
+from iso_tmy import CLIMATE_PARAMS, iso_tmy, iso_tmy_sources
+from mean_tmy import mean_tmy
+from tmy_artifacts import OPEN_METEO_SOURCE, tmy_metadata, save_tmy
+sys.path.append('../epw_compiler')
+from gap_filler import STRATEGIES, fill_gaps, reject_poor_years
+from influx_loader import query_sources
+from open_meteo_client import fetch_archive
+
+
+load_dotenv()
+INFLUXDB_ORG = os.getenv('INFLUXDB_ORG')
+INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
+INFLUXDB_URL = os.getenv('INFLUXDB_URL')
+WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
+OPEN_METEO_BUCKET_NAME = os.getenv('OPEN_METEO_BUCKET_NAME')
+
+client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+query_api = client.query_api()
+
+SOURCES = [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]
+METHODS = {"ISO": ["ISO"], "mean": ["mean"], "both": ["ISO", "mean"]}
+TMY_COLUMNS = [
+    "v_air[m/s]",
+    "wind_dir[o]",
+    "T_db[C]",
+    "T_dp[C]",
+    "RH[%]",
+    "P_atm[hPa]",
+    "rain[mm]",
+    "GHI[W/m2]"
+]
+OM_COLUMNS = {
+    'temperature_2m (°C)': 'T_db[C]',
+    'relativehumidity_2m (%)': 'RH[%]',
+    'windspeed_10m (m/s)': 'v_air[m/s]',
+    'winddirection_10m (°)': 'wind_dir[o]',
+    'dewpoint_2m (°C)': 'T_dp[C]',
+    'pressure_msl (hPa)': 'P_atm[hPa]',
+    'precipitation (mm)': 'rain[mm]',
+    'diffuse_radiation (W/m²)': 'GHI[W/m2]'
+}
+OM_TMY_COLUMNS = TMY_COLUMNS + [
+    "soil_temperature_0_to_7cm (°C)",
+    "soil_temperature_7_to_28cm (°C)",
+    "soil_temperature_28_to_100cm (°C)",
+    "soil_temperature_100_to_255cm (°C)"
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    sites = parser.add_mutually_exclusive_group(required=True)
+    sites.add_argument("--ids", help="Space separated weather station IDs", nargs='+')
+    sites.add_argument("-f", "--filename", help="Filename of the list of weather station IDs as a comma separated list")
+    sites.add_argument("--grid", help="Open-Meteo grid, as LAT_MIN LAT_MAX LON_MIN LON_MAX (included)", nargs=4, type=float)
+    parser.add_argument("--resolution", help="Spacing of the grid points in degrees (default=0.1)", type=float, default=0.1)
+    parser.add_argument("--start_year", help="Start year", type=int, required=True)
+    parser.add_argument("--end_year", help="End year", type=int, required=True)
+    parser.add_argument("--method", help="TMY generation method", choices=list(METHODS), default="both")
+    parser.add_argument("--gap_strategy", help="Gap filling strategy (stations only)", choices=STRATEGIES, default="same_hour")
+    parser.add_argument("--max_gap", help="Longest gap to be filled in hours, longer gaps are left missing (optional)", type=int)
+    parser.add_argument("--max_filled", help="Reject the years with more than this percentage of filled hours in any TMY column (optional)", type=float)
+    parser.add_argument("--workers", help="Number of processes generating the TMYs (default=number of CPUs)", type=int, default=os.cpu_count())
+    parser.add_argument("--load_workers", help="Number of sites downloaded concurrently (default=4)", type=int, default=4)
+    parser.add_argument("--out_dir", help="Output directory (default=current directory)", default=".")
+    parser.add_argument("--csv", help="Flag to also output the TMY files in csv format", action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def grid_points(lat_min, lat_max, lon_min, lon_max, resolution):
+    lats = np.round(np.arange(lat_min, lat_max + resolution / 2, resolution), 4)
+    lons = np.round(np.arange(lon_min, lon_max + resolution / 2, resolution), 4)
+    return [(float(lat), float(lon)) for lat in lats for lon in lons]
+
+
+def load_station(station_id, start_year, end_year, gap_strategy, max_gap, max_filled):
+    """Read the history of a station from both sources and fill its gaps.
+
+    :return: DataFrame with a gap-filled hourly timestamp index and (source, variable) columns
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    start, end = pd.Timestamp(year=start_year, month=1, day=1), pd.Timestamp(year=end_year+1, month=1, day=1)
+    df = query_sources(query_api, SOURCES, station_id, start, end)
+    df, report = fill_gaps(df, start, end, strategy=gap_strategy, max_gap=max_gap)
+    if max_filled is not None:
+        df = pd.concat({source: reject_poor_years(df[source], report.xs(source, level='source'), max_filled, TMY_COLUMNS)[0] for source in SOURCES}, axis=1)
+    return df[[(source, c) for source in SOURCES for c in TMY_COLUMNS]]
+
+
+def load_point(lat, lon, start_year, end_year):
+    """Download the Open-Meteo history of a grid point.
+
+    :return: DataFrame with an hourly timestamp index
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    df = fetch_archive(lat, lon, start_year, end_year)
+    return df.rename(columns=OM_COLUMNS).rename_axis('timestamp')[OM_TMY_COLUMNS]
+
+
+def share_frame(df):
+    """Copy the index and values of a DataFrame to shared memory blocks, so
+    that the worker processes can read them without pickling the data.
+
+    :param df: DataFrame with a timestamp index and float columns
+    :type df: class:`pandas.core.frame.DataFrame`
+    :return: Tuple made of (shared memory blocks, descriptor passed to attach_frame)
+    :rtype: tuple
+    """
+    index = df.index.values.astype("datetime64[ns]").view(np.int64)
+    values = np.ascontiguousarray(df.values, dtype=np.float64)
+    blocks = []
+    for array in (index, values):
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+    descriptor = {
+        "index": (blocks[0].name, index.shape),
+        "values": (blocks[1].name, values.shape),
+        "index_name": df.index.name,
+        "columns": list(df.columns),
+        "column_names": list(df.columns.names)
+    }
+    return blocks, descriptor
+
+
+def attach_block(name):
+    # Only the parent owns (and unlinks) the blocks, so the workers must not register them with the resource
+    # tracker, which would report them as leaked or unlink them while other workers still use them
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach_frame(descriptor):
+    # The DataFrame is a view of the shared memory, no data is copied
+    blocks = [attach_block(descriptor[k][0]) for k in ("index", "values")]
+    index = np.ndarray(descriptor["index"][1], dtype=np.int64, buffer=blocks[0].buf)
+    values = np.ndarray(descriptor["values"][1], dtype=np.float64, buffer=blocks[1].buf)
+    columns = descriptor["columns"]
+    columns = pd.MultiIndex.from_tuples(columns, names=descriptor["column_names"]) if isinstance(columns[0], tuple) else pd.Index(columns, name=descriptor["column_names"][0])
+    df = pd.DataFrame(values, index=pd.DatetimeIndex(index.view("datetime64[ns]"), name=descriptor["index_name"]), columns=columns, copy=False)
+    return blocks, df
+
+
+def site_tmys(df, site, methods, start_year, end_year):
+    # Station sites have (source, variable) columns, grid points only the Open-Meteo ones
+    if isinstance(site, str):
+        if "ISO" in methods:
+            for source, (final_df, typical_years) in iso_tmy_sources(df, SOURCES).items():
+                yield f"{site}_ISO_TMY_{source}_{start_year}_{end_year}", final_df, tmy_metadata("ISO", source, start_year, end_year, station_id=site, typical_years=typical_years)
+        if "mean" in methods:
+            for source in SOURCES:
+                yield f"{site}_mean_TMY_{source}_{start_year}_{end_year}", mean_tmy(df[source], TMY_COLUMNS), tmy_metadata("mean", source, start_year, end_year, station_id=site)
+    else:
+        lat, lon = site
+        if "ISO" in methods:
+            final_df, typical_years = iso_tmy(df)
+            yield f"{lat}_{lon}_ISO_TMY_{start_year}_{end_year}", final_df, tmy_metadata("ISO", OPEN_METEO_SOURCE, start_year, end_year, lat=lat, lon=lon, typical_years=typical_years)
+        if "mean" in methods:
+            yield f"{lat}_{lon}_mean_TMY_{start_year}_{end_year}", mean_tmy(df, OM_TMY_COLUMNS), tmy_metadata("mean", OPEN_METEO_SOURCE, start_year, end_year, lat=lat, lon=lon)
+
+
+def generate_site(site, descriptor, methods, start_year, end_year, out_dir, csv):
+    """Generate the TMYs of a site in a worker process, reading its history
+    from shared memory. Each output file is written atomically (see save_tmy).
+
+    :return: Tuple made of (output filenames, CPU time in seconds)
+    :rtype: tuple
+    """
+    t0 = time.process_time()
+    blocks, df = attach_frame(descriptor)
+    try:
+        outputs = []
+        for filename, final_df, metadata in site_tmys(df, site, methods, start_year, end_year):
+            save_tmy(final_df, f"{out_dir}/{filename}", metadata, csv=csv)
+            outputs.append(filename)
+    finally:
+        # The views of the shared memory must be released before closing it
+        del df
+        for block in blocks:
+            block.close()
+    return outputs, time.process_time() - t0
+
+
+def run_batch(sites, load, methods, start_year, end_year, out_dir, csv, workers, load_workers):
+    """Download the sites' histories in a thread pool and, as soon as each one
+    is ready, generate its TMYs in a process pool.
+
+    :param sites: Station IDs or (lat, lon) tuples
+    :type sites: list
+    :param load: Function taking a site and returning its history
+    :type load: function
+    :return: DataFrame with the load time, CPU time, hours and outputs of each site (NaN for failed sites)
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    def timed_load(site):
+        t0 = time.perf_counter()
+        return load(site), time.perf_counter() - t0
+
+    stats = pd.DataFrame(index=pd.Index([str(s) for s in sites], name="site"), columns=["load[s]", "cpu[s]", "hours", "outputs"], dtype=object)
+    blocks = {}
+    try:
+        with ThreadPoolExecutor(max_workers=load_workers) as loader, ProcessPoolExecutor(max_workers=workers) as pool:
+            loads = {loader.submit(timed_load, site): site for site in sites}
+            jobs = {}
+            for future in as_completed(loads):
+                site = loads[future]
+                try:
+                    df, load_time = future.result()
+                except Exception as e:
+                    print(f"{site}: failed to load the history ({e})")
+                    continue
+                stats.loc[str(site), ["load[s]", "hours"]] = [load_time, len(df)]
+                blocks[site], descriptor = share_frame(df)
+                jobs[pool.submit(generate_site, site, descriptor, methods, start_year, end_year, out_dir, csv)] = site
+
+            for future in as_completed(jobs):
+                site = jobs[future]
+                try:
+                    outputs, cpu_time = future.result()
+                    stats.loc[str(site), ["cpu[s]", "outputs"]] = [cpu_time, len(outputs)]
+                    print(f"{site}: saved {', '.join(outputs)}")
+                except Exception as e:
+                    print(f"{site}: failed to generate the TMYs ({e})")
+                finally:
+                    release_blocks(blocks.pop(site))
+    finally:
+        # The blocks of the sites not processed yet (e.g. after an interruption) are released too
+        for site_blocks in blocks.values():
+            release_blocks(site_blocks)
+    return stats
+
+
+def release_blocks(blocks):
+    # Only the parent process unlinks the shared memory, once the worker using it is done
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def print_summary(stats, wall_time, workers):
+    done = stats["outputs"].notna()
+    cpu_time, hours = stats["cpu[s]"][done].sum(), stats["hours"][done].sum()
+    print("\nBATCH SUMMARY")
+    print(f"Sites: {done.sum()} of {len(stats)} completed, {int(stats['outputs'][done].sum())} TMY files saved")
+    print(f"Wall time: {wall_time:.1f} s ({done.sum() / wall_time * 60:.1f} sites/min, {hours / wall_time:,.0f} hourly records/s)")
+    print(f"Download time: {stats['load[s]'].sum():.1f} s, generation CPU time: {cpu_time:.1f} s on {workers} processes")
+    if not done.all():
+        print(f"Failed sites: {', '.join(stats.index[~done])}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start_year, end_year, methods = args.start_year, args.end_year, METHODS[args.method]
+
+    if args.grid is not None:
+        sites = grid_points(*args.grid, args.resolution)
+        load = lambda site: load_point(*site, start_year, end_year)
+    else:
+        if args.filename is not None:
+            with open(args.filename) as f:
+                station_ids = [s.strip() for s in f.read().split(",") if s.strip()]
+        else:
+            station_ids = args.ids
+        sites = [s.upper() for s in station_ids]
+        load = lambda site: load_station(site, start_year, end_year, args.gap_strategy, args.max_gap, args.max_filled)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    print(f"Generating {args.method} TMYs for {len(sites)} sites with {args.workers} processes...")
+    t0 = time.perf_counter()
+    stats = run_batch(sites, load, methods, start_year, end_year, args.out_dir, args.csv, args.workers, args.load_workers)
+    print_summary(stats, time.perf_counter() - t0, args.workers)
@@ -2,6 +2,7 @@ import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from tmy_artifacts import open_tmy
 plt.rcParams['legend.fontsize'] = 14
 plt.rcParams['axes.labelsize'] = 14
 plt.rcParams['axes.titlesize'] = 18
@@ -16,14 +17,8 @@ args = parser.parse_args()
 
 station_id, start_year, end_year = args.id.upper(), args.start_year, args.end_year
 
-mt = pd.read_csv(f'{station_id}_mean_TMY_WeatherUnderground_{start_year}_{end_year}.csv')
-t = pd.read_csv(f'{station_id}_ISO_TMY_WeatherUnderground_{start_year}_{end_year}.csv')
-
-mt['timestamp'] = pd.to_datetime(mt['timestamp'])
-t['timestamp'] = pd.to_datetime(mt['timestamp'])
-
-mt.set_index('timestamp', inplace=True)
-t.set_index('timestamp', inplace=True)
+mt, _ = open_tmy(station_id=station_id, source='WeatherUnderground', method='mean', start_year=start_year, end_year=end_year)
+t, _ = open_tmy(station_id=station_id, source='WeatherUnderground', method='ISO', start_year=start_year, end_year=end_year)
 
 mt = mt.resample('D').mean()
 mt = mt.interpolate(method='linear')
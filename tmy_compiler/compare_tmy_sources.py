@@ -2,6 +2,7 @@ import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from tmy_artifacts import open_tmy
 
 
 parser = argparse.ArgumentParser()
@@ -61,19 +62,17 @@ def cdh(df, thresholds=[18, 21, 24, 26, 28]):
         return my_dict
 
 
-df_t = pd.read_csv(f'{station_id}_ISO_TMY_WeatherUnderground_{start_year}_{end_year}.csv')
-df_t["timestamp"] = pd.to_datetime(df_t["timestamp"])
-df_t['T_db_o[C]'] = df_t["T_db[C]"]
-df_mt = pd.read_csv(f'{station_id}_mean_TMY_WeatherUnderground_{start_year}_{end_year}.csv')
-df_mt["timestamp"] = pd.to_datetime(df_mt["timestamp"])
-df_mt['T_db_o[C]'] = df_mt["T_db[C]"]
+def load(source, method):
+    df, _ = open_tmy(station_id=station_id, source=source, method=method, start_year=start_year, end_year=end_year)
+    df = df.reset_index()
+    df['T_db_o[C]'] = df["T_db[C]"]
+    return df
 
-df_t_om = pd.read_csv(f'{station_id}_ISO_TMY_OpenMeteo_{start_year}_{end_year}.csv')
-df_t_om["timestamp"] = pd.to_datetime(df_t_om["timestamp"])
-df_t_om['T_db_o[C]'] = df_t_om["T_db[C]"]
-df_mt_om = pd.read_csv(f'{station_id}_mean_TMY_OpenMeteo_{start_year}_{end_year}.csv')
-df_mt_om["timestamp"] = pd.to_datetime(df_mt_om["timestamp"])
-df_mt_om['T_db_o[C]'] = df_mt_om["T_db[C]"]
+
+df_t = load('WeatherUnderground', 'ISO')
+df_mt = load('WeatherUnderground', 'mean')
+df_t_om = load('OpenMeteo', 'ISO')
+df_mt_om = load('OpenMeteo', 'mean')
 
 hdh_t = hdh(df_t)
 hdh_mt = hdh(df_mt)
@@ -0,0 +1,120 @@
+import numpy as np
+import os
+from datetime import date
+from iso_tmy import CLIMATE_PARAMS, FS_PARAMS, WIND_PARAM, N_CANDIDATES, daily_cube, cdf, typical_years_idx
+
+
+def store_path(store_dir, name, source):
+    return f"{store_dir}/{name}_{source}.npz"
+
+
+def empty_store(climate_params=CLIMATE_PARAMS):
+    return {
+        "params": np.array(climate_params),
+        "years": np.array([], dtype=int),
+        "filled": np.array([]),
+        "cube": np.empty((len(climate_params), 12, 0, 31)),
+        "f": np.empty((len(climate_params), 12, 0, 31)),
+    }
+
+
+def load_store(path, climate_params=CLIMATE_PARAMS):
+    """Load the Finkelstein-Schafer statistics store of a station and source.
+
+    The store keeps, for every year, the daily means of each month (the
+    distributions the F_S statistics are built on), their per-year
+    cumulative distributions, which do not change when new years are added,
+    and the highest percentage of filled hours of its climate parameters,
+    so that the years too poor for a run are rejected without reading them again.
+
+    :param path: Path of the store file (.npz)
+    :type path: str
+    :param climate_params: Climate parameters, defaults to CLIMATE_PARAMS
+    :type climate_params: list, optional
+    :return: Store as a dict of arrays (empty if the file does not exist)
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return empty_store(climate_params)
+    with np.load(path) as data:
+        store = {k: data[k] for k in data.files}
+    if list(store["params"]) != list(climate_params):
+        print(f"{path} was built for different climate parameters, rebuilding it")
+        return empty_store(climate_params)
+    if "filled" not in store:
+        print(f"{path} has no record of the filled hours, rebuilding it")
+        return empty_store(climate_params)
+    return store
+
+
+def save_store(path, store):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(tmp_path, **store)
+    os.replace(tmp_path, path)
+
+
+def missing_years(store, start_year, end_year):
+    # The current year is always considered missing, as it is not complete yet
+    return [y for y in range(start_year, end_year+1) if y not in store["years"] or y >= date.today().year]
+
+
+def update_store(store, df, report):
+    """Add the years contained in the hourly DataFrame to the store, replacing
+    the years which are already present.
+
+    :param store: Store, as returned by load_store
+    :type store: dict
+    :param df: DataFrame with a gap-filled hourly timestamp index, containing
+        only the new years
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param report: Gap report of df, as returned by gap_filler.fill_gaps
+    :type report: class:`pandas.core.frame.DataFrame`
+    :return: Updated store
+    :rtype: dict
+    """
+    new_years, new_cube = daily_cube(df, list(store["params"]))
+    filled = report["filled[%]"].unstack("variable")
+    new_filled = filled[[p for p in store["params"] if p in filled.columns]].max(axis=1).reindex(new_years).to_numpy()
+    keep = ~np.isin(store["years"], new_years)
+    years = np.concatenate([store["years"][keep], new_years])
+    order = np.argsort(years)
+    return {
+        "params": store["params"],
+        "years": years[order],
+        "filled": np.concatenate([store["filled"][keep], new_filled])[order],
+        "cube": np.concatenate([store["cube"][:, :, keep], new_cube], axis=2)[:, :, order],
+        "f": np.concatenate([store["f"][:, :, keep], cdf(new_cube)], axis=2)[:, :, order],
+    }
+
+
+def rejected_years(store, start_year, end_year, max_filled=None):
+    # Years of the period with more than max_filled percent of filled hours in any climate parameter
+    if max_filled is None:
+        return []
+    period = (store["years"] >= start_year) & (store["years"] <= end_year)
+    return list(store["years"][period & (store["filled"] > max_filled)])
+
+
+def select_from_store(store, start_year, end_year, max_filled=None, fs_params=FS_PARAMS, wind_param=WIND_PARAM, n_candidates=N_CANDIDATES):
+    """Select the typical year of each month over a period, using only the
+    statistics kept in the store.
+
+    :param max_filled: Reject the years with more than this percentage of
+        filled hours in any climate parameter, defaults to None (no rejection)
+    :type max_filled: float, optional
+    :return: Typical year of each month (January first)
+    :rtype: class:`numpy.ndarray`
+    """
+    period = (store["years"] >= start_year) & (store["years"] <= end_year)
+    period &= ~np.isin(store["years"], rejected_years(store, start_year, end_year, max_filled))
+    years = store["years"][period]
+    idx = typical_years_idx(
+        store["cube"][:, :, period],
+        store["f"][:, :, period],
+        climate_params=list(store["params"]),
+        fs_params=fs_params,
+        wind_param=wind_param,
+        n_candidates=n_candidates
+    )
+    return years[idx]
@@ -1,9 +1,16 @@
 import pandas as pd
-import numpy as np
 import argparse
 from influxdb_client import InfluxDBClient
 import os
+import sys
 from dotenv import load_dotenv
+from iso_tmy import CLIMATE_PARAMS, iso_tmy_sources, iso_tmy_ensemble, assemble_tmy
+from fs_store import store_path, load_store, save_store, missing_years, update_store, rejected_years, select_from_store
+sys.path.append('../epw_compiler')
+from gap_filler import STRATEGIES, fill_gaps, reject_poor_years
+from influx_loader import query_source, query_sources
+from artifact_cache import code_version, hash_parts, influx_watermark, cached_frame, cached_files
+from tmy_artifacts import tmy_metadata, member_filename, save_tmy
 
 
 load_dotenv()
@@ -20,116 +27,89 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--id", help="Weather station ID", required=True)
 parser.add_argument("--start_year", help="Start year", type=int, required=True)
 parser.add_argument("--end_year", help="End year", type=int, required=True)
+parser.add_argument("--store", help="Directory of the Finkelstein-Schafer statistics store, used to update the TMY incrementally (optional)")
+parser.add_argument("--gap_strategy", help="Gap filling strategy", choices=STRATEGIES, default="same_hour")
+parser.add_argument("--max_gap", help="Longest gap to be filled in hours, longer gaps are left missing (optional)", type=int)
+parser.add_argument("--max_filled", help="Reject the years with more than this percentage of filled hours in any climate parameter (optional)", type=float)
+parser.add_argument("--csv", help="Flag to also output the TMY file in csv format", action="store_true")
+parser.add_argument("--members", help="Number of alternative TMYs (ensemble members) to be generated from the ranked candidate years (default=1)", type=int, default=1)
+parser.add_argument("--refresh_cache", help="Regenerate the TMY files, even if their inputs did not change", action="store_true")
 args = parser.parse_args()
-
-station_id, start_year, end_year = args.id.upper(), args.start_year, args.end_year
-
-for source in [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]:
-    query = f'from(bucket:"{source}")\
-            |> range(start: {start_year-1}-12-31T23:59:00Z, stop: {end_year}-12-31T23:59:59Z)\
-            |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
-            |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
-            |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-
-    df = query_api.query_data_frame(query)
-    df.index = pd.to_datetime(df['_time'])
-    df.index = df.index.tz_localize(None)
-    df.sort_index(inplace=True)
-
-    df.drop(columns=['result', 'table', '_start', '_stop', '_time', 'coords', '_measurement'], inplace=True)
-
-    # Set the desired time range
-    start_date = f'{start_year}-01-01 00:00:00'
-    end_date = f'{end_year}-12-31 23:59:59'
-
-    # Create a DateTimeIndex with hourly frequency
-    hourly_range = pd.date_range(start=start_date, end=end_date, freq='H')
-
-    # Create an empty DataFrame with the DateTimeIndex
-    df_filled = pd.DataFrame(index=hourly_range)
-
-    # Merge the empty DataFrame with your original data
-    df_merged = df_filled.merge(df, left_index=True, right_index=True, how='left')
-
-    # Forward-fill missing values with previous value at the same hour
-    df_filled = df_merged.groupby([df_merged.index.hour]).ffill()
-
-    # Backward-fill remaining missing values
-    df_filled = df_filled.groupby([df_merged.index.hour]).bfill()
-
-    df = df_filled.rename_axis('timestamp')
-
-    df2 = df
-
-    climate_params = [
-        "T_db[C]", 
-        "GHI[W/m2]",
-        "RH[%]",
-        "v_air[m/s]"
-    ]
-    df = df[climate_params]
-
-    df = df.resample("1D").mean()
-
-    df["month"] = df.index.month
-    df["year"] = df.index.year
-    df["PHI"] = np.nan
-    df["F"] = np.nan
-
-    df_fs = df.resample("1M").mean()
-    df_fs = df_fs[["year", "month", "v_air[m/s]"]]
-    for cp in climate_params:
-        df_fs[f"F_S_{cp}"] = np.nan 
-
-    for cp in climate_params:
-        dfs_by_month = df.groupby(pd.Grouper(key="month"))
-        # groups to a list of dataframes with list comprehension
-        dfs_by_month = [group.sort_values(f'{cp}')
-                        for _, group in dfs_by_month]
-        for df_by_month in dfs_by_month:
-            df_by_month["PHI"] = [i/(len(df_by_month+1))
-                                for i in range(1, len(df_by_month)+1)]
-            df = df.combine_first(df_by_month[["PHI"]])
-
-        dfs_by_year = df.groupby(pd.Grouper(freq="Y"))
-        dfs_by_year = [group for _, group in dfs_by_year]
-        for df_by_year in dfs_by_year:
-            dfs_by_month = df_by_year.groupby(pd.Grouper(key="month"))
-            dfs_by_month = [group.sort_values(f'{cp}')
-                            for _, group in dfs_by_month]
-            for df_by_month in dfs_by_month:
-                df_by_month["F"] = [i/(len(df_by_month+1))
-                                    for i in range(1, len(df_by_month)+1)]
-                df = df.combine_first(df_by_month[["F"]])
-
-        dfs_by_month_year = df.groupby(pd.Grouper(freq="M"))
-        dfs_by_month_year = [(key, group) for key, group in dfs_by_month_year]
-
-        for key, df_by_month_year in dfs_by_month_year:
-            val = abs(df_by_month_year["F"] - df_by_month_year["PHI"]).resample("1M").sum().iloc()[0]
-            df_fs.loc[key][f"F_S_{cp}"] = val
-            
-    df_fs["F_S_tot"] = df_fs[f"F_S_{climate_params[0]}"] + df_fs[f"F_S_{climate_params[1]}"] + df_fs[f"F_S_{climate_params[2]}"]
-    df_fs_by_month = df_fs.groupby(pd.Grouper(key="month"))
-    df_fs_by_month = [group.sort_values(f'F_S_tot')
-                    for _, group in df_fs_by_month]
-
-    typical_months = []
-    for d in df_fs_by_month:
-        d = d.iloc[:3]
-        d["windspeedDev"] = abs(d["v_air[m/s]"] - d["v_air[m/s]"].mean())
-        d = d.sort_values("windspeedDev")
-        typical_months.append(d.index[0])
-
-    df = df2
-    dfs_typical = []
-    for ts in typical_months:
-        dfs_typical.append(df[(df.index.year == ts.year) & (df.index.month == ts.month)])
-    for idx, d in enumerate(dfs_typical):
-        if (idx == 0):
-            final_df = d
+if args.members > 1 and args.store is not None:
+    parser.error("--members cannot be used with --store")
+if args.members > args.end_year - args.start_year + 1:
+    parser.error("--members cannot be greater than the number of years")
+
+station_id, start_year, end_year, store_dir = args.id.upper(), args.start_year, args.end_year, args.store
+gap_strategy, max_gap, max_filled, csv, refresh_cache, n_members = args.gap_strategy, args.max_gap, args.max_filled, args.csv, args.refresh_cache, args.members
+
+SOURCES = [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]
+
+def query_hourly(source, start, end):
+    df = query_source(query_api, source, station_id, start, end)
+    return fill_gaps(df, start, end, strategy=gap_strategy, max_gap=max_gap)
+
+def query_years(source, years):
+    # Each year is gap filled on its own, so that a typical month read again later is filled
+    # exactly as it was when the statistics of its year were added to the store
+    filled = [query_hourly(source, pd.Timestamp(year=y, month=1, day=1), pd.Timestamp(year=y+1, month=1, day=1)) for y in years]
+    return pd.concat([df for df, _ in filled]), pd.concat([report for _, report in filled])
+
+def reject_years(df, report, source):
+    if max_filled is None:
+        return df
+    df, rejected = reject_poor_years(df, report, max_filled, CLIMATE_PARAMS)
+    if rejected:
+        print(f"{station_id} ({source}): rejecting years {rejected}, more than {max_filled}% of their hours were filled")
+    return df
+
+def generate():
+    if store_dir is None:
+        # Both sources are read concurrently, then gap filled and processed together
+        df = cached_frame("tmy_history", history_key, lambda: query_sources(query_api, SOURCES, station_id, start, end), refresh=refresh_cache)
+        df, report = fill_gaps(df, start, end, strategy=gap_strategy, max_gap=max_gap)
+        df = pd.concat({source: reject_years(df[source], report.xs(source, level='source'), source) for source in SOURCES}, axis=1)
+        if n_members > 1:
+            # All the members and the candidate table come from the same statistics
+            results = {source: iso_tmy_ensemble(df[source], n_members) for source in SOURCES}
         else:
-            final_df = pd.concat([final_df, d])
-    final_df.index = final_df.index.map(lambda x: x.replace(year = 1970))
-    final_df = final_df.resample("1H").mean()
-    final_df.to_csv(f"{station_id}_ISO_TMY_{source}_{start_year}_{end_year}.csv", index=True)
+            results = {source: ([tmy], None) for source, tmy in iso_tmy_sources(df, SOURCES).items()}
+    else:
+        results = {}
+        for source in SOURCES:
+            path = store_path(store_dir, station_id, source)
+            store = load_store(path)
+            years = missing_years(store, start_year, end_year)
+            if years:
+                # Only the years which are not in the store yet are read from the hourly history
+                df, report = query_years(source, years)
+                store = update_store(store, df, report)
+                save_store(path, store)
+            # The statistics of the poor years are kept in the store, and their rejection depends only on max_filled
+            rejected = rejected_years(store, start_year, end_year, max_filled)
+            if rejected:
+                print(f"{station_id} ({source}): rejecting years {rejected}, more than {max_filled}% of their hours were filled")
+            typical_years = select_from_store(store, start_year, end_year, max_filled)
+            # Only the typical years are read again, each one gap filled as a whole before its months are taken
+            df = query_years(source, sorted(set(typical_years)))[0]
+            results[source] = ([(assemble_tmy(df, typical_years), typical_years)], None)
+
+    for source, (members, table) in results.items():
+        filename = f"{station_id}_ISO_TMY_{source}_{start_year}_{end_year}"
+        for member, (final_df, typical_years) in enumerate(members, 1):
+            metadata = tmy_metadata("ISO", source, start_year, end_year, station_id=station_id, typical_years=typical_years, member=member)
+            save_tmy(final_df, member_filename(filename, member), metadata, csv=csv)
+        if table is not None:
+            table.to_csv(f"{filename}_candidates.csv")
+
+
+# The TMY files are cached, keyed by the data in InfluxDB, the parameters and the code
+version = code_version()
+start, end = pd.Timestamp(year=start_year, month=1, day=1), pd.Timestamp(year=end_year+1, month=1, day=1)
+watermarks = [influx_watermark(query_api, source, station_id, start, end) for source in SOURCES]
+history_key = hash_parts("tmy_history", station_id, start_year, end_year, watermarks, version)
+filenames = [f"{station_id}_ISO_TMY_{source}_{start_year}_{end_year}" for source in SOURCES]
+outputs = [f"{member_filename(f, m)}.{ext}" for f in filenames for m in range(1, n_members+1) for ext in (["parquet", "csv"] if csv else ["parquet"])]
+if n_members > 1:
+    outputs += [f"{f}_candidates.csv" for f in filenames]
+cached_files("iso_tmy", hash_parts("iso_tmy", history_key, gap_strategy, max_gap, max_filled, n_members, store_dir), outputs, generate, refresh=refresh_cache)
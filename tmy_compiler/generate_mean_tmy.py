@@ -1,10 +1,15 @@
 import pandas as pd
-import numpy as np
 import argparse
-import scipy
 from influxdb_client import InfluxDBClient
 import os
+import sys
 from dotenv import load_dotenv
+from mean_tmy import mean_tmy
+sys.path.append('../epw_compiler')
+from gap_filler import STRATEGIES, fill_gaps, reject_poor_years
+from influx_loader import query_sources
+from artifact_cache import code_version, hash_parts, influx_watermark, cached_frame, cached_files
+from tmy_artifacts import tmy_metadata, save_tmy
 
 
 load_dotenv()
@@ -21,67 +26,51 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--id", help="Weather station ID", required=True)
 parser.add_argument("--start_year", help="Start year", type=int, required=True)
 parser.add_argument("--end_year", help="End year", type=int, required=True)
+parser.add_argument("--gap_strategy", help="Gap filling strategy", choices=STRATEGIES, default="same_hour")
+parser.add_argument("--max_gap", help="Longest gap to be filled in hours, longer gaps are left missing (optional)", type=int)
+parser.add_argument("--max_filled", help="Reject the years with more than this percentage of filled hours in any TMY column (optional)", type=float)
+parser.add_argument("--csv", help="Flag to also output the TMY file in csv format", action="store_true")
+parser.add_argument("--refresh_cache", help="Regenerate the TMY files, even if their inputs did not change", action="store_true")
 args = parser.parse_args()
 
 station_id, start_year, end_year = args.id.upper(), args.start_year, args.end_year
-
-def mode_std(x):
-    mode_array = scipy.stats.mode(x, keepdims=True)[0]
-    if len(mode_array) == 0:
-        return np.nan
-    elif np.isnan(mode_array):
-        return np.nan
-    else:
-        return mode_array[0]
-
-for source in [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]:
-    query = f'from(bucket:"{source}")\
-            |> range(start: {start_year-1}-12-31T23:59:00Z, stop: {end_year}-12-31T23:59:59Z)\
-            |> filter(fn: (r) => r["_measurement"] == "{station_id}")\
-            |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
-            |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-
-    df = query_api.query_data_frame(query)
-    df.index = pd.to_datetime(df['_time'])
-    df.index = df.index.tz_localize(None)
-    df.sort_index(inplace=True)
-
-    df.drop(columns=['result', 'table', '_start', '_stop', '_time', 'coords', '_measurement'], inplace=True)
-
-    # Set the desired time range
-    start_date = f'{start_year}-01-01 00:00:00'
-    end_date = f'{end_year}-12-31 23:59:59'
-
-    # Create a DateTimeIndex with hourly frequency
-    hourly_range = pd.date_range(start=start_date, end=end_date, freq='H')
-
-    # Create an empty DataFrame with the DateTimeIndex
-    df_filled = pd.DataFrame(index=hourly_range)
-
-    # Merge the empty DataFrame with your original data
-    df_merged = df_filled.merge(df, left_index=True, right_index=True, how='left')
-
-    # Forward-fill missing values with previous value at the same hour
-    df_filled = df_merged.groupby([df_merged.index.hour]).ffill()
-
-    # Backward-fill remaining missing values
-    df_filled = df_filled.groupby([df_merged.index.hour]).bfill()
-
-    df = df_filled.rename_axis('timestamp')
-
-    df.drop(df.index[df.index.month.isin([2]) & df.index.day.isin([29])], inplace=True)
-
-    resample_dict = {
-        "v_air[m/s]": "mean",
-        "wind_dir[o]": lambda x: mode_std(x),
-        "T_db[C]": "mean",
-        "T_dp[C]": "mean",
-        "RH[%]": "mean",
-        "P_atm[hPa]": "mean",
-        "rain[mm]": "mean",
-        "GHI[W/m2]": "mean"
-    }
-    df = df.groupby('{:%m-%d %H}'.format).agg(resample_dict)
-    
-    df.index = pd.to_datetime(df.index.map(lambda x: "1970-" + x + ":00:00"))
-    df.to_csv(f"{station_id}_mean_TMY_{source}_{start_year}_{end_year}.csv", index=True)
\ No newline at end of file
+gap_strategy, max_gap, max_filled, csv, refresh_cache = args.gap_strategy, args.max_gap, args.max_filled, args.csv, args.refresh_cache
+
+TMY_COLUMNS = [
+    "v_air[m/s]",
+    "wind_dir[o]",
+    "T_db[C]",
+    "T_dp[C]",
+    "RH[%]",
+    "P_atm[hPa]",
+    "rain[mm]",
+    "GHI[W/m2]"
+]
+
+SOURCES = [WEATHER_UNDERGROUND_BUCKET_NAME, OPEN_METEO_BUCKET_NAME]
+
+def generate():
+    # Both sources are read concurrently, then gap filled together
+    df_sources = cached_frame("tmy_history", history_key, lambda: query_sources(query_api, SOURCES, station_id, start, end), refresh=refresh_cache)
+    df_sources, report = fill_gaps(df_sources, start, end, strategy=gap_strategy, max_gap=max_gap)
+
+    for source in SOURCES:
+        df = df_sources[source]
+
+        if max_filled is not None:
+            df, rejected = reject_poor_years(df, report.xs(source, level='source'), max_filled, TMY_COLUMNS)
+            if rejected:
+                print(f"{station_id} ({source}): rejecting years {rejected}, more than {max_filled}% of their hours were filled")
+
+        df = mean_tmy(df, TMY_COLUMNS)
+        metadata = tmy_metadata("mean", source, start_year, end_year, station_id=station_id)
+        save_tmy(df, f"{station_id}_mean_TMY_{source}_{start_year}_{end_year}", metadata, csv=csv)
+
+
+# The TMY files are cached, keyed by the data in InfluxDB, the parameters and the code
+version = code_version()
+start, end = pd.Timestamp(year=start_year, month=1, day=1), pd.Timestamp(year=end_year+1, month=1, day=1)
+watermarks = [influx_watermark(query_api, source, station_id, start, end) for source in SOURCES]
+history_key = hash_parts("tmy_history", station_id, start_year, end_year, watermarks, version)
+outputs = [f"{station_id}_mean_TMY_{source}_{start_year}_{end_year}.{ext}" for source in SOURCES for ext in (["parquet", "csv"] if csv else ["parquet"])]
+cached_files("mean_tmy", hash_parts("mean_tmy", history_key, gap_strategy, max_gap, max_filled), outputs, generate, refresh=refresh_cache)
@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+CLIMATE_PARAMS = [
+    "T_db[C]",
+    "GHI[W/m2]",
+    "RH[%]",
+    "v_air[m/s]"
+]
+FS_PARAMS = CLIMATE_PARAMS[:3]
+WIND_PARAM = "v_air[m/s]"
+N_CANDIDATES = 3
+
+
+def daily_cube(df, climate_params=CLIMATE_PARAMS):
+    """Compute the daily means of the climate parameters and lay them out as a
+    parameter x month x year x day-of-month array (missing days are NaN).
+
+    :param df: DataFrame with an hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param climate_params: Columns to be used, defaults to CLIMATE_PARAMS
+    :type climate_params: list, optional
+    :return: Tuple made of (years, cube)
+    :rtype: tuple
+    """
+    df_daily = df[climate_params].resample("1D").mean()
+    years = np.unique(df_daily.index.year)
+    cube = np.full((len(climate_params), 12, len(years), 31), np.nan)
+    year_idx = np.searchsorted(years, df_daily.index.year)
+    cube[:, df_daily.index.month - 1, year_idx, df_daily.index.day - 1] = df_daily.values.T
+    return years, cube
+
+
+def cdf(values):
+    """Compute the empirical cumulative distribution function K/(N+1) of every
+    value along the last axis, ranking the values with a single argsort.
+
+    :param values: Array of values, NaN are ignored
+    :type values: class:`numpy.ndarray`
+    :return: Array of cumulative frequencies with the same shape (NaN where values are NaN)
+    :rtype: class:`numpy.ndarray`
+    """
+    missing = np.isnan(values)
+    order = np.argsort(values, axis=-1, kind="stable")
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(1, values.shape[-1] + 1), values.shape), axis=-1)
+    n = (~missing).sum(axis=-1, keepdims=True)
+    return np.where(missing, np.nan, ranks / (n + 1))
+
+
+def fs_statistics(cube, f=None):
+    """Compute the Finkelstein-Schafer statistic of every parameter, month and
+    year, as defined by UNI EN ISO 15927-04:2005.
+
+    :param cube: Daily means, as returned by daily_cube
+    :type cube: class:`numpy.ndarray`
+    :param f: Cumulative distribution of each month in each year (cdf of cube),
+        computed if not given
+    :type f: class:`numpy.ndarray`, optional
+    :return: Array of F_S values with shape (parameters, 12, years), NaN for months without data
+    :rtype: class:`numpy.ndarray`
+    """
+    n_params, _, n_years, n_days = cube.shape
+    # Cumulative distribution of each month in each year
+    if f is None:
+        f = cdf(cube)
+    # Long-term cumulative distribution of each calendar month, pooling all years
+    phi = cdf(cube.reshape(n_params, 12, n_years * n_days)).reshape(cube.shape)
+    fs = np.nansum(np.abs(f - phi), axis=-1)
+    return np.where(np.isnan(cube).all(axis=-1), np.nan, fs)
+
+
+def monthly_means(cube):
+    n = (~np.isnan(cube)).sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nansum(cube, axis=-1) / n
+
+
+def rank_years(fs_tot, wind, n_candidates=N_CANDIDATES):
+    """Rank the years of each month: first the n_candidates years with the
+    lowest total F_S, ordered by the deviation of their mean wind speed from
+    the candidates' mean, then the remaining years by total F_S.
+
+    :param fs_tot: Total F_S with shape (12, years)
+    :type fs_tot: class:`numpy.ndarray`
+    :param wind: Monthly mean wind speed with shape (12, years)
+    :type wind: class:`numpy.ndarray`
+    :param n_candidates: Number of candidate years per month, defaults to 3
+    :type n_candidates: int, optional
+    :return: Tuple made of (year indexes sorted by rank, wind speed deviation), both with shape (12, years)
+    :rtype: tuple
+    """
+    by_fs = np.argsort(np.where(np.isnan(fs_tot), np.inf, fs_tot), axis=1, kind="stable")
+    candidates = by_fs[:, :n_candidates]
+    wind_mean = monthly_means(np.take_along_axis(wind, candidates, axis=1))
+    wind_dev = np.abs(wind - wind_mean[:, None])
+    wind_candidates = np.take_along_axis(wind_dev, candidates, axis=1)
+    best = np.argsort(np.where(np.isnan(wind_candidates), np.inf, wind_candidates), axis=1, kind="stable")
+    order = np.concatenate([np.take_along_axis(candidates, best, axis=1), by_fs[:, n_candidates:]], axis=1)
+    return order, wind_dev
+
+
+def select_typical_years(fs_tot, wind, n_candidates=N_CANDIDATES):
+    """Select the typical year of each month: among the n_candidates years with
+    the lowest total F_S, the one whose mean wind speed is the closest to the
+    candidates' mean.
+
+    :param fs_tot: Total F_S with shape (12, years)
+    :type fs_tot: class:`numpy.ndarray`
+    :param wind: Monthly mean wind speed with shape (12, years)
+    :type wind: class:`numpy.ndarray`
+    :param n_candidates: Number of candidate years per month, defaults to 3
+    :type n_candidates: int, optional
+    :return: Index of the typical year of each month
+    :rtype: class:`numpy.ndarray`
+    """
+    return rank_years(fs_tot, wind, n_candidates)[0][:, 0]
+
+
+def candidate_table(years, fs_tot, wind, n_candidates=N_CANDIDATES):
+    """Build the ranked table of the candidate years of each month.
+
+    :param years: Years of the statistics
+    :type years: class:`numpy.ndarray`
+    :return: DataFrame indexed by (month, rank), rank 1 being the typical year, with the
+        year, its total F_S, mean wind speed and wind speed deviation, and whether it
+        was among the n_candidates years with the lowest total F_S
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    order, wind_dev = rank_years(fs_tot, wind, n_candidates)
+    n_years = len(years)
+    return pd.DataFrame({
+        "year": years[order].ravel(),
+        "F_S_tot": np.take_along_axis(fs_tot, order, axis=1).ravel(),
+        "wind_mean[m/s]": np.take_along_axis(wind, order, axis=1).ravel(),
+        "wind_dev[m/s]": np.take_along_axis(wind_dev, order, axis=1).ravel(),
+        "candidate": np.tile(np.arange(n_years) < n_candidates, 12)
+    }, index=pd.MultiIndex.from_product([range(1, 13), range(1, n_years + 1)], names=["month", "rank"]))
+
+
+def ranking_statistics(cube, f=None, climate_params=CLIMATE_PARAMS, fs_params=FS_PARAMS, wind_param=WIND_PARAM):
+    # Total F_S and monthly mean wind speed, with shape (12, years)
+    fs = fs_statistics(cube, f)
+    fs_tot = fs[[climate_params.index(cp) for cp in fs_params]].sum(axis=0)
+    wind = monthly_means(cube[climate_params.index(wind_param)])
+    return fs_tot, wind
+
+
+def typical_years_idx(cube, f=None, climate_params=CLIMATE_PARAMS, fs_params=FS_PARAMS, wind_param=WIND_PARAM, n_candidates=N_CANDIDATES):
+    fs_tot, wind = ranking_statistics(cube, f, climate_params, fs_params, wind_param)
+    return select_typical_years(fs_tot, wind, n_candidates)
+
+
+def assemble_tmy(df, typical_years):
+    """Concatenate the typical months into a TMY referenced to the year 1970.
+
+    :param df: DataFrame with an hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param typical_years: Typical year of each month (January first)
+    :type typical_years: list
+    :return: TMY DataFrame
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    keys = np.array(typical_years) * 100 + np.arange(1, 13)
+    final_df = df[np.isin(df.index.year * 100 + df.index.month, keys)]
+    final_df = final_df[~((final_df.index.month == 2) & (final_df.index.day == 29))]
+    final_df.index = pd.to_datetime(pd.DataFrame({
+        "year": 1970,
+        "month": final_df.index.month,
+        "day": final_df.index.day,
+        "hour": final_df.index.hour
+    }))
+    final_df = final_df.rename_axis("timestamp")
+    return final_df.resample("1H").mean()
+
+
+def iso_tmy(df, climate_params=CLIMATE_PARAMS, fs_params=FS_PARAMS, wind_param=WIND_PARAM, n_candidates=N_CANDIDATES):
+    """Generate a TMY according to UNI EN ISO 15927-04:2005.
+
+    :param df: DataFrame with a gap-filled hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :return: Tuple made of (TMY DataFrame, typical year of each month)
+    :rtype: tuple
+    """
+    years, cube = daily_cube(df, climate_params)
+    typical_years = years[typical_years_idx(cube, climate_params=climate_params, fs_params=fs_params, wind_param=wind_param, n_candidates=n_candidates)]
+    return assemble_tmy(df, typical_years), typical_years
+
+
+def iso_tmy_periods(df, periods, climate_params=CLIMATE_PARAMS, fs_params=FS_PARAMS, wind_param=WIND_PARAM, n_candidates=N_CANDIDATES, max_workers=None):
+    """Generate one TMY according to UNI EN ISO 15927-04:2005 for each
+    reference period, computing the daily means and the per-year cumulative
+    distributions only once for the whole history.
+
+    :param df: DataFrame with a gap-filled hourly timestamp index, covering all the periods
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param periods: List of (start year, end year) tuples, end year included
+    :type periods: list
+    :param max_workers: Number of threads used for the months selection, defaults to None
+    :type max_workers: int, optional
+    :return: Dict mapping each period to a tuple made of (TMY DataFrame, typical year of each month)
+    :rtype: dict
+    """
+    years, cube = daily_cube(df, climate_params)
+    # The cumulative distribution of a month in a given year does not depend on the period
+    f = cdf(cube)
+
+    def select(period):
+        in_period = (years >= period[0]) & (years <= period[1])
+        idx = typical_years_idx(cube[:, :, in_period], f[:, :, in_period], climate_params, fs_params, wind_param, n_candidates)
+        return years[in_period][idx]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        selections = list(executor.map(select, periods))
+    return {period: (assemble_tmy(df, typical_years), typical_years) for period, typical_years in zip(periods, selections)}
+
+
+def iso_tmy_sources(df, sources, climate_params=CLIMATE_PARAMS, fs_params=FS_PARAMS, wind_param=WIND_PARAM, n_candidates=N_CANDIDATES):
+    """Generate one TMY according to UNI EN ISO 15927-04:2005 for each source,
+    computing the daily means and the cumulative distributions of all the
+    sources together.
+
+    :param df: DataFrame with a gap-filled hourly timestamp index and (source, variable) columns
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param sources: Sources (first level of the columns)
+    :type sources: list
+    :return: Dict mapping each source to a tuple made of (TMY DataFrame, typical year of each month)
+    :rtype: dict
+    """
+    columns = [(source, cp) for source in sources for cp in climate_params]
+    years, cube = daily_cube(df, columns)
+    fs = fs_statistics(cube)
+    results = {}
+    for source in sources:
+        fs_tot = fs[[columns.index((source, cp)) for cp in fs_params]].sum(axis=0)
+        wind = monthly_means(cube[columns.index((source, wind_param))])
+        typical_years = years[select_typical_years(fs_tot, wind, n_candidates)]
+        results[source] = (assemble_tmy(df[source], typical_years), typical_years)
+    return results
+
+
+def iso_tmy_ensemble(df, n_members, climate_params=CLIMATE_PARAMS, fs_params=FS_PARAMS, wind_param=WIND_PARAM, n_candidates=N_CANDIDATES):
+    """Generate an ensemble of alternative TMYs from the same statistics: the
+    k-th member is made of the k-th ranked year of each month (see rank_years),
+    so the first member is the TMY of UNI EN ISO 15927-04:2005.
+
+    :param df: DataFrame with a gap-filled hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param n_members: Number of members, at most the number of years with data
+        (e.g. not rejected for having too many filled hours) in every month
+    :type n_members: int
+    :raises ValueError: If there are not enough years with data for n_members members
+    :return: Tuple made of (list of (TMY DataFrame, typical year of each month) tuples, candidate table)
+    :rtype: tuple
+    """
+    years, cube = daily_cube(df, climate_params)
+    fs_tot, wind = ranking_statistics(cube, None, climate_params, fs_params, wind_param)
+    # The years without statistics are ranked last, but they would make members without data
+    n_valid = np.isfinite(fs_tot).sum(axis=1).min()
+    if n_members > n_valid:
+        raise ValueError(f"Cannot generate {n_members} members, only {n_valid} years have data in every month")
+    table = candidate_table(years, fs_tot, wind, n_candidates)
+    ranked_years = table["year"].unstack("rank").values
+    members = [(assemble_tmy(df, ranked_years[:, k]), ranked_years[:, k]) for k in range(n_members)]
+    return members, table
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+
+HOURS_PER_YEAR = 8760
+WIND_DIR_PARAM = "wind_dir[o]"
+
+
+def hour_of_year(index):
+    """Compute the 0-based hour of a non-leap year of every timestamp, so that
+    the same calendar hour gets the same key in leap and non-leap years (the
+    timestamps of 29 February must be removed beforehand).
+
+    :param index: Hourly timestamps
+    :type index: class:`pandas.DatetimeIndex`
+    :return: Integer keys between 0 and 8759
+    :rtype: class:`numpy.ndarray`
+    """
+    day_of_year = index.dayofyear.values - 1 - (index.is_leap_year & (index.month > 2))
+    return day_of_year * 24 + index.hour.values
+
+
+def year_hour_matrix(df, columns):
+    """Reshape an hourly DataFrame into a year x hour-of-year x column array
+    (missing hours are NaN), dropping 29 February.
+
+    :param df: DataFrame with an hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param columns: Columns to be used
+    :type columns: list
+    :return: Array with shape (years, 8760, columns)
+    :rtype: class:`numpy.ndarray`
+    """
+    df = df[~((df.index.month == 2) & (df.index.day == 29))]
+    years, year_idx = np.unique(df.index.year, return_inverse=True)
+    matrix = np.full((len(years), HOURS_PER_YEAR, len(columns)), np.nan)
+    matrix[year_idx, hour_of_year(df.index)] = df[columns].values
+    return matrix
+
+
+def binned_mode(directions, bin_width=1):
+    """Compute the most frequent direction of every hour of the year over all
+    years, with directions binned on the circle (360° falls in the 0° bin).
+
+    :param directions: Array of directions in degrees with shape (years, hours)
+    :type directions: class:`numpy.ndarray`
+    :param bin_width: Width of the direction bins in degrees, defaults to 1
+    :type bin_width: int, optional
+    :return: Mode of each hour, NaN where there are no values
+    :rtype: class:`numpy.ndarray`
+    """
+    n_bins = int(round(360 / bin_width))
+    n_hours = directions.shape[1]
+    valid = ~np.isnan(directions)
+    bins = np.rint(directions[valid] / bin_width).astype(int) % n_bins
+    hours = np.broadcast_to(np.arange(n_hours), directions.shape)[valid]
+    counts = np.bincount(hours * n_bins + bins, minlength=n_hours * n_bins).reshape(n_hours, n_bins)
+    return np.where(valid.any(axis=0), counts.argmax(axis=1) * bin_width, np.nan)
+
+
+def mean_tmy(df, columns, wind_dir_param=WIND_DIR_PARAM):
+    """Generate a TMY by averaging every hour of the year over all years (the
+    wind direction is the most frequent one instead).
+
+    :param df: DataFrame with a gap-filled hourly timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param columns: Columns to be averaged
+    :type columns: list
+    :param wind_dir_param: Wind direction column, defaults to "wind_dir[o]"
+    :type wind_dir_param: str, optional
+    :return: TMY DataFrame referenced to the year 1970
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    matrix = year_hour_matrix(df, columns)
+    n = (~np.isnan(matrix)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tmy = np.nansum(matrix, axis=0) / n
+    if wind_dir_param in columns:
+        dir_idx = columns.index(wind_dir_param)
+        tmy[:, dir_idx] = binned_mode(matrix[:, :, dir_idx])
+    index = pd.date_range("1970-01-01", periods=HOURS_PER_YEAR, freq="H", name="timestamp")
+    return pd.DataFrame(tmy, index=index, columns=columns)
@@ -2,6 +2,9 @@ import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import sys
+sys.path.append('..')
+from tmy_artifacts import load_tmy
 plt.rcParams['legend.fontsize'] = 14
 plt.rcParams['axes.labelsize'] = 14
 plt.rcParams['axes.titlesize'] = 18
@@ -9,7 +12,7 @@ plt.rcParams['xtick.labelsize'] = 14
 plt.rcParams['ytick.labelsize'] = 14
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--files", help="Space separated filenames of the TMY files to be compared", nargs='+', required=True)
+parser.add_argument("--files", help="Space separated filenames of the TMY files to be compared (parquet or csv format)", nargs='+', required=True)
 args = parser.parse_args()
 
 tmy_files = args.files
@@ -17,13 +20,14 @@ tmy_files = args.files
 fig, ax = plt.subplots(figsize=(16, 9))
 
 for f in tmy_files:
-    df = pd.read_csv(f)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df.set_index('timestamp', inplace=True)
+    df, metadata = load_tmy(f)
     df = df.resample('D').mean()
     df = df.interpolate(method='linear')
 
-    label = f.split('_')[-2] + '-' + f.split('_')[-1].split('.')[0]
+    if metadata:
+        label = f"{metadata['start_year']}-{metadata['end_year']}"
+    else:
+        label = f.split('_')[-2] + '-' + f.split('_')[-1].split('.')[0]
     plt.plot(df.index, df['T_db[C]'], label=label)
 
 plt.xlabel('Timestamp')
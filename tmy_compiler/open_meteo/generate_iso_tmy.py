@@ -1,12 +1,17 @@
 import pandas as pd
-import numpy as np
 import argparse
 import math
 import sys
+from datetime import date
 sys.path.append('../../epw_compiler')
 from header_compiler.header_compiler import compile_header
 from epw_data_compiler import compile_epw_data
 from generate_epw import convert_to_epw
+from open_meteo_client import fetch_archive
+from artifact_cache import code_version, hash_parts, cached_files
+sys.path.append('..')
+from tmy_artifacts import OPEN_METEO_SOURCE, tmy_metadata, member_filename, save_tmy
+from iso_tmy import iso_tmy_periods, iso_tmy_ensemble
 
 
 parser = argparse.ArgumentParser()
@@ -14,7 +19,12 @@ parser.add_argument("--lat", help="Latitude", type=float, required=True)
 parser.add_argument("--lon", help="Longitude", type=float, required=True)
 parser.add_argument("--start_year", help="Start year", type=int, required=True)
 parser.add_argument("--end_year", help="End year", type=int, required=True)
+parser.add_argument("--periods", help="Space separated reference periods (e.g. 1951-1980 1961-1990), within start and end year, for which a TMY is generated (optional)", nargs='+')
+parser.add_argument("--window", help="Length in years of the sliding reference periods, within start and end year, for which a TMY is generated (optional)", type=int)
+parser.add_argument("--step", help="Step in years between sliding reference periods (default=1)", type=int, default=1)
 parser.add_argument("--epw", help="Flag to output TMY file in EPW format", action="store_true")
+parser.add_argument("--csv", help="Flag to output TMY file in csv format", action="store_true")
+parser.add_argument("--members", help="Number of alternative TMYs (ensemble members) to be generated for each period from the ranked candidate years (default=1)", type=int, default=1)
 parser.add_argument("--city", help="City", default="Unknown")
 parser.add_argument(
     "--country", help="Country code (e.g. ITA)", default="Unknown")
@@ -33,9 +43,15 @@ parser.add_argument(
     "--comment1", help="1st comment line (optional)", default="")
 parser.add_argument(
     "--comment2", help="2nd comment line (optional)", default="")
+parser.add_argument(
+    "--local_design_conditions", help="Compute the design conditions from the downloaded history instead of using the closest ASHRAE station", action="store_true")
+parser.add_argument(
+    "--ground_model", help="Compute the ground temperatures with the soil temperature model instead of Open-Meteo data", action="store_true")
+parser.add_argument("--refresh_cache", help="Regenerate the TMY files, even if their inputs did not change", action="store_true")
 args = parser.parse_args()
 
-lat, lon, start_year, end_year, epw, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2 = args.lat, args.lon, args.start_year, args.end_year, args.epw, args.city, args.country, args.state, args.source, args.leap, args.dst_start_date, args.dst_end_date, args.start_weekday, args.comment1, args.comment2
+lat, lon, start_year, end_year, periods, window, step, epw, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2, local_design_conditions, ground_model = args.lat, args.lon, args.start_year, args.end_year, args.periods, args.window, args.step, args.epw, args.city, args.country, args.state, args.source, args.leap, args.dst_start_date, args.dst_end_date, args.start_weekday, args.comment1, args.comment2, args.local_design_conditions, args.ground_model
+csv, refresh_cache, n_members = args.csv, args.refresh_cache, args.members
 
 
 def abs_humidity_from_T_and_rh(T, rh):
@@ -50,23 +66,24 @@ def compute_rain_type(prec_total):
         return 61
     
 
-def to_epw(df):
+def to_epw(df, df_history, epw_filename):
     df['abs_humidity[g/m3]'] = [abs_humidity_from_T_and_rh(T, rh) for T, rh in zip(df['T_db[C]'], df['RH[%]'])]
     df['rain_type[int]'] = [compute_rain_type(prec_total) for prec_total in df['rain[mm]']]
 
     header = compile_header(
-        df, city, country, lat, lon, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2, use_source_for_ground=True
+        df, city, country, lat, lon, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2,
+        design_conditions_df=df_history if local_design_conditions else None, use_source_for_ground=True, use_model_for_ground=ground_model
     )
 
     convert_to_epw(
         df=compile_epw_data(df, lat, lon),
         header=header,
-        epw_filename=f"{lat}_{lon}_ISO_TMY_{start_year}_{end_year}"
+        epw_filename=epw_filename
     )
 
 
 def scrape_om(lat, lon, start_year, end_year):
-    df = pd.read_csv(f"https://archive-api.open-meteo.com/v1/archive?latitude={lat}&longitude={lon}&start_date={start_year}-01-01&end_date={end_year}-12-31&hourly=temperature_2m,relativehumidity_2m,dewpoint_2m,precipitation,pressure_msl,windspeed_10m,winddirection_10m,soil_temperature_0_to_7cm,soil_temperature_7_to_28cm,soil_temperature_28_to_100cm,soil_temperature_100_to_255cm,diffuse_radiation&windspeed_unit=ms&format=csv", header=2)
+    df = fetch_archive(lat, lon, start_year, end_year)
 
     df['T_db[C]'] = df['temperature_2m (°C)']
     df['RH[%]'] = df['relativehumidity_2m (%)']
@@ -77,97 +94,55 @@ def scrape_om(lat, lon, start_year, end_year):
     df['rain[mm]'] = df['precipitation (mm)']
     df['GHI[W/m2]'] = df['diffuse_radiation (W/m²)']
     
-    df.drop(columns=['time', 'temperature_2m (°C)', 'relativehumidity_2m (%)', 'windspeed_10m (m/s)', 'winddirection_10m (°)', 'dewpoint_2m (°C)', 'pressure_msl (hPa)', 'precipitation (mm)', 'diffuse_radiation (W/m²)'], inplace=True)
+    df = df.rename_axis('timestamp')
+    df.drop(columns=['temperature_2m (°C)', 'relativehumidity_2m (%)', 'windspeed_10m (m/s)', 'winddirection_10m (°)', 'dewpoint_2m (°C)', 'pressure_msl (hPa)', 'precipitation (mm)', 'diffuse_radiation (W/m²)'], inplace=True)
     return df
 
 
-df = scrape_om(lat, lon, start_year, end_year)
-
-if (start_year < 1970):
-    start_date = f'1970-01-01 00:00:00'
-    end_date = f'{end_year+(1970-start_year)}-12-31 23:59:59'
+if periods is not None:
+    try:
+        periods = [tuple(int(y) for y in p.split('-')) for p in periods]
+    except ValueError:
+        parser.error("--periods must be given as start-end years (e.g. 1951-1980)")
+    for period in periods:
+        if len(period) != 2 or period[0] > period[1] or period[0] < start_year or period[1] > end_year:
+            parser.error(f"Period {'-'.join(str(y) for y in period)} is not a start-end range within start and end year")
+elif window is not None:
+    if window < 1 or window > end_year - start_year + 1:
+        parser.error("--window must be between 1 and the number of years between start and end year")
+    if step < 1:
+        parser.error("--step must be at least 1")
+    periods = [(y, y+window-1) for y in range(start_year, end_year-window+2, step)]
 else:
-    start_date = f'{start_year}-01-01 00:00:00'
-    end_date = f'{end_year}-12-31 23:59:59'
-
-df.index = pd.date_range(start=start_date, end=end_date, freq='H')
-df.index = df.index.tz_localize(None)
-df = df.rename_axis('timestamp')
-
-df2 = df
-
-climate_params = [
-    "T_db[C]", 
-    "GHI[W/m2]",
-    "RH[%]",
-    "v_air[m/s]"
-]
-df = df[climate_params]
-
-df = df.resample("1D").mean()
-
-df["month"] = df.index.month
-df["year"] = df.index.year
-df["PHI"] = np.nan
-df["F"] = np.nan
-
-df_fs = df.resample("1M").mean()
-df_fs = df_fs[["year", "month", "v_air[m/s]"]]
-for cp in climate_params:
-    df_fs[f"F_S_{cp}"] = np.nan 
-
-for cp in climate_params:
-    dfs_by_month = df.groupby(pd.Grouper(key="month"))
-    # groups to a list of dataframes with list comprehension
-    dfs_by_month = [group.sort_values(f'{cp}')
-                    for _, group in dfs_by_month]
-    for df_by_month in dfs_by_month:
-        df_by_month["PHI"] = [i/(len(df_by_month+1))
-                            for i in range(1, len(df_by_month)+1)]
-        df = df.combine_first(df_by_month[["PHI"]])
-
-    dfs_by_year = df.groupby(pd.Grouper(freq="Y"))
-    dfs_by_year = [group for _, group in dfs_by_year]
-    for df_by_year in dfs_by_year:
-        dfs_by_month = df_by_year.groupby(pd.Grouper(key="month"))
-        dfs_by_month = [group.sort_values(f'{cp}')
-                        for _, group in dfs_by_month]
-        for df_by_month in dfs_by_month:
-            df_by_month["F"] = [i/(len(df_by_month+1))
-                                for i in range(1, len(df_by_month)+1)]
-            df = df.combine_first(df_by_month[["F"]])
-
-    dfs_by_month_year = df.groupby(pd.Grouper(freq="M"))
-    dfs_by_month_year = [(key, group) for key, group in dfs_by_month_year]
-
-    for key, df_by_month_year in dfs_by_month_year:
-        val = abs(df_by_month_year["F"] - df_by_month_year["PHI"]).resample("1M").sum().iloc()[0]
-        df_fs.loc[key][f"F_S_{cp}"] = val
-        
-df_fs["F_S_tot"] = df_fs[f"F_S_{climate_params[0]}"] + df_fs[f"F_S_{climate_params[1]}"] + df_fs[f"F_S_{climate_params[2]}"]
-df_fs_by_month = df_fs.groupby(pd.Grouper(key="month"))
-df_fs_by_month = [group.sort_values(f'F_S_tot')
-                for _, group in df_fs_by_month]
-
-typical_months = []
-for d in df_fs_by_month:
-    d = d.iloc[:3]
-    d["windspeedDev"] = abs(d["v_air[m/s]"] - d["v_air[m/s]"].mean())
-    d = d.sort_values("windspeedDev")
-    typical_months.append(d.index[0])
-
-df = df2
-dfs_typical = []
-for ts in typical_months:
-    dfs_typical.append(df[(df.index.year == ts.year) & (df.index.month == ts.month)])
-for idx, d in enumerate(dfs_typical):
-    if (idx == 0):
-        final_df = d
-    else:
-        final_df = pd.concat([final_df, d])
-final_df.index = final_df.index.map(lambda x: x.replace(year = 1970))
-final_df = final_df.resample("1H").mean()
-final_df.to_csv(f"{lat}_{lon}_ISO_TMY_{start_year}_{end_year}.csv", index=True)
+    periods = [(start_year, end_year)]
+if n_members > min(e - s + 1 for s, e in periods):
+    parser.error("--members cannot be greater than the number of years of a period")
+
+def generate():
+    df = scrape_om(lat, lon, start_year, end_year)
 
-if epw:
-    to_epw(final_df)
+    if n_members > 1:
+        # All the members and the candidate table of a period come from the same statistics
+        tmys = {(s, e): iso_tmy_ensemble(df[(df.index.year >= s) & (df.index.year <= e)], n_members) for s, e in periods}
+    else:
+        tmys = {period: ([tmy], None) for period, tmy in iso_tmy_periods(df, periods).items()}
+    for (period_start, period_end), (members, table) in tmys.items():
+        filename = f"{lat}_{lon}_ISO_TMY_{period_start}_{period_end}"
+        for member, (final_df, typical_years) in enumerate(members, 1):
+            metadata = tmy_metadata("ISO", OPEN_METEO_SOURCE, period_start, period_end, lat=lat, lon=lon, typical_years=typical_years, member=member)
+            save_tmy(final_df, member_filename(filename, member), metadata, csv=csv)
+
+            if epw:
+                to_epw(final_df, df[(df.index.year >= period_start) & (df.index.year <= period_end)], member_filename(filename, member))
+        if table is not None:
+            table.to_csv(f"{filename}_candidates.csv")
+
+
+# The output files are cached, keyed by the arguments and the code. The current year
+# is still being updated by Open-Meteo, so periods including it are only reused within the same day
+filenames = [f"{lat}_{lon}_ISO_TMY_{period_start}_{period_end}" for period_start, period_end in periods]
+outputs = [f"{member_filename(f, m)}.{ext}" for f in filenames for m in range(1, n_members+1) for ext in ["parquet"] + (["csv"] if csv else []) + (["epw"] if epw else [])]
+if n_members > 1:
+    outputs += [f"{f}_candidates.csv" for f in filenames]
+key = hash_parts("om_iso_tmy", {k: v for k, v in vars(args).items() if k != "refresh_cache"}, periods, code_version(), str(date.today()) if end_year >= date.today().year else None)
+cached_files("om_iso_tmy", key, outputs, generate, refresh=refresh_cache)
@@ -1,14 +1,17 @@
 import pandas as pd
 import argparse
-import numpy as np
-import argparse
-import scipy
 import math
 import sys
+from datetime import date
 sys.path.append('../../epw_compiler')
 from header_compiler.header_compiler import compile_header
 from epw_data_compiler import compile_epw_data
 from generate_epw import convert_to_epw
+from open_meteo_client import fetch_archive
+from artifact_cache import code_version, hash_parts, cached_files
+sys.path.append('..')
+from tmy_artifacts import OPEN_METEO_SOURCE, tmy_metadata, save_tmy
+from mean_tmy import mean_tmy
 
 
 parser = argparse.ArgumentParser()
@@ -17,6 +20,7 @@ parser.add_argument("--lon", help="Longitude", type=float, required=True)
 parser.add_argument("--start_year", help="Start year", type=int, required=True)
 parser.add_argument("--end_year", help="End year", type=int, required=True)
 parser.add_argument("--epw", help="Flag to output TMY file in EPW format", action="store_true")
+parser.add_argument("--csv", help="Flag to output TMY file in csv format", action="store_true")
 parser.add_argument("--city", help="City", default="Unknown")
 parser.add_argument(
     "--country", help="Country code (e.g. ITA)", default="Unknown")
@@ -35,9 +39,15 @@ parser.add_argument(
     "--comment1", help="1st comment line (optional)", default="")
 parser.add_argument(
     "--comment2", help="2nd comment line (optional)", default="")
+parser.add_argument(
+    "--local_design_conditions", help="Compute the design conditions from the downloaded history instead of using the closest ASHRAE station", action="store_true")
+parser.add_argument(
+    "--ground_model", help="Compute the ground temperatures with the soil temperature model instead of Open-Meteo data", action="store_true")
+parser.add_argument("--refresh_cache", help="Regenerate the TMY files, even if their inputs did not change", action="store_true")
 args = parser.parse_args()
 
-lat, lon, start_year, end_year, epw, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2 = args.lat, args.lon, args.start_year, args.end_year, args.epw, args.city, args.country, args.state, args.source, args.leap, args.dst_start_date, args.dst_end_date, args.start_weekday, args.comment1, args.comment2
+lat, lon, start_year, end_year, epw, city, country, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2, local_design_conditions, ground_model = args.lat, args.lon, args.start_year, args.end_year, args.epw, args.city, args.country, args.state, args.source, args.leap, args.dst_start_date, args.dst_end_date, args.start_weekday, args.comment1, args.comment2, args.local_design_conditions, args.ground_model
+csv, refresh_cache = args.csv, args.refresh_cache
 
 
 def abs_humidity_from_T_and_rh(T, rh):
@@ -52,12 +62,29 @@ def compute_rain_type(prec_total):
         return 61
     
 
-def to_epw(df):
+TMY_COLUMNS = [
+    "v_air[m/s]",
+    "wind_dir[o]",
+    "T_db[C]",
+    "T_dp[C]",
+    "RH[%]",
+    "P_atm[hPa]",
+    "rain[mm]",
+    "GHI[W/m2]",
+    "soil_temperature_0_to_7cm (°C)",
+    "soil_temperature_7_to_28cm (°C)",
+    "soil_temperature_28_to_100cm (°C)",
+    "soil_temperature_100_to_255cm (°C)"
+]
+
+
+def to_epw(df, df_history):
     df['abs_humidity[g/m3]'] = [abs_humidity_from_T_and_rh(T, rh) for T, rh in zip(df['T_db[C]'], df['RH[%]'])]
     df['rain_type[int]'] = [compute_rain_type(prec_total) for prec_total in df['rain[mm]']]
 
     header = compile_header(
-        df, city, country, lat, lon, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2, use_source_for_ground=True
+        df, city, country, lat, lon, state, source, leap, dst_start_date, dst_end_date, start_weekday, comment1, comment2,
+        design_conditions_df=df_history if local_design_conditions else None, use_source_for_ground=True, use_model_for_ground=ground_model
     )
 
     convert_to_epw(
@@ -67,17 +94,8 @@ def to_epw(df):
     )
 
 
-def mode_std(x):
-    mode_array = scipy.stats.mode(x, keepdims=True)[0]
-    if len(mode_array) == 0:
-        return np.nan
-    elif np.isnan(mode_array):
-        return np.nan
-    else:
-        return mode_array[0]
-
 def scrape_om(lat, lon, start_year, end_year):
-    df = pd.read_csv(f"https://archive-api.open-meteo.com/v1/archive?latitude={lat}&longitude={lon}&start_date={start_year}-01-01&end_date={end_year}-12-31&hourly=temperature_2m,relativehumidity_2m,dewpoint_2m,precipitation,pressure_msl,windspeed_10m,winddirection_10m,soil_temperature_0_to_7cm,soil_temperature_7_to_28cm,soil_temperature_28_to_100cm,soil_temperature_100_to_255cm,diffuse_radiation&windspeed_unit=ms&format=csv", header=2)
+    df = fetch_archive(lat, lon, start_year, end_year)
 
     df['T_db[C]'] = df['temperature_2m (°C)']
     df['RH[%]'] = df['relativehumidity_2m (%)']
@@ -88,42 +106,23 @@ def scrape_om(lat, lon, start_year, end_year):
     df['rain[mm]'] = df['precipitation (mm)']
     df['GHI[W/m2]'] = df['diffuse_radiation (W/m²)']
     
-    df.drop(columns=['time', 'temperature_2m (°C)', 'relativehumidity_2m (%)', 'windspeed_10m (m/s)', 'winddirection_10m (°)', 'dewpoint_2m (°C)', 'pressure_msl (hPa)', 'precipitation (mm)', 'diffuse_radiation (W/m²)'], inplace=True)
+    df = df.rename_axis('timestamp')
+    df.drop(columns=['temperature_2m (°C)', 'relativehumidity_2m (%)', 'windspeed_10m (m/s)', 'winddirection_10m (°)', 'dewpoint_2m (°C)', 'pressure_msl (hPa)', 'precipitation (mm)', 'diffuse_radiation (W/m²)'], inplace=True)
     return df
 
-df = scrape_om(lat, lon, start_year, end_year)
-
-if (start_year < 1970):
-    start_date = f'1970-01-01 00:00:00'
-    end_date = f'{end_year+(1970-start_year)}-12-31 23:59:59'
-else:
-    start_date = f'{start_year}-01-01 00:00:00'
-    end_date = f'{end_year}-12-31 23:59:59'
-
-df.index = pd.date_range(start=start_date, end=end_date, freq='H')
-df.index = df.index.tz_localize(None)
-df = df.rename_axis('timestamp')
-
-df.drop(df.index[df.index.month.isin([2]) & df.index.day.isin([29])], inplace=True)
-
-resample_dict = {
-    "v_air[m/s]": "mean",
-    "wind_dir[o]": lambda x: mode_std(x),
-    "T_db[C]": "mean",
-    "T_dp[C]": "mean",
-    "RH[%]": "mean",
-    "P_atm[hPa]": "mean",
-    "rain[mm]": "mean",
-    "GHI[W/m2]": "mean",
-    "soil_temperature_0_to_7cm (°C)": "mean",
-    "soil_temperature_7_to_28cm (°C)": "mean",
-    "soil_temperature_28_to_100cm (°C)": "mean",
-    "soil_temperature_100_to_255cm (°C)": "mean"
-}
-df = df.groupby('{:%m-%d %H}'.format).agg(resample_dict)
-
-df.index = pd.to_datetime(df.index.map(lambda x: "1970-" + x + ":00:00"))
-df.to_csv(f"{lat}_{lon}_mean_TMY_{start_year}_{end_year}.csv", index=True)
-
-if epw:
-    to_epw(df)
\ No newline at end of file
+def generate():
+    df_history = scrape_om(lat, lon, start_year, end_year)
+
+    df = mean_tmy(df_history, TMY_COLUMNS)
+    save_tmy(df, f"{lat}_{lon}_mean_TMY_{start_year}_{end_year}", tmy_metadata("mean", OPEN_METEO_SOURCE, start_year, end_year, lat=lat, lon=lon), csv=csv)
+
+    if epw:
+        to_epw(df, df_history)
+
+
+# The output files are cached, keyed by the arguments and the code. The current year
+# is still being updated by Open-Meteo, so periods including it are only reused within the same day
+filename = f"{lat}_{lon}_mean_TMY_{start_year}_{end_year}"
+outputs = [f"{filename}.parquet"] + ([f"{filename}.csv"] if csv else []) + ([f"{filename}.epw"] if epw else [])
+key = hash_parts("om_mean_tmy", {k: v for k, v in vars(args).items() if k != "refresh_cache"}, code_version(), str(date.today()) if end_year >= date.today().year else None)
+cached_files("om_mean_tmy", key, outputs, generate, refresh=refresh_cache)
@@ -0,0 +1,128 @@
+import glob
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+METADATA_KEY = b"tmy"
+OPEN_METEO_SOURCE = "OpenMeteo"
+
+
+def tmy_metadata(method, source, start_year, end_year, station_id=None, lat=None, lon=None, typical_years=None, member=None):
+    """Build the metadata embedded in a TMY artifact.
+
+    :param method: Generation method ("ISO" or "mean")
+    :type method: str
+    :param source: Data source (bucket name)
+    :type source: str
+    :param start_year: Start year of the reference period
+    :type start_year: int
+    :param end_year: End year of the reference period (included)
+    :type end_year: int
+    :param station_id: Weather station ID, defaults to None
+    :type station_id: str, optional
+    :param lat: Latitude, defaults to None
+    :type lat: float, optional
+    :param lon: Longitude, defaults to None
+    :type lon: float, optional
+    :param typical_years: Typical year of each month (ISO method), defaults to None
+    :type typical_years: list, optional
+    :param member: Rank of the alternative TMY in an ensemble (2 and above), defaults to None
+    :type member: int, optional
+    :return: Metadata
+    :rtype: dict
+    """
+    return {
+        "method": method,
+        "source": source,
+        "start_year": int(start_year),
+        "end_year": int(end_year),
+        "station_id": station_id,
+        "lat": lat,
+        "lon": lon,
+        "typical_years": None if typical_years is None else [int(y) for y in typical_years],
+        "member": None if member is None or member == 1 else int(member),
+    }
+
+
+def member_filename(filename, member):
+    # The first member of an ensemble is the TMY itself
+    return filename if member == 1 else f"{filename}_member{member}"
+
+
+def save_tmy(df, filename, metadata, csv=False):
+    """Save a TMY as a Parquet file with its metadata embedded in the schema.
+
+    :param df: TMY DataFrame with a timestamp index
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param filename: Filename without extension
+    :type filename: str
+    :param metadata: Metadata, as returned by tmy_metadata
+    :type metadata: dict
+    :param csv: Flag to also export the TMY in csv format, defaults to False
+    :type csv: bool, optional
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    table = table.replace_schema_metadata({**table.schema.metadata, METADATA_KEY: json.dumps(metadata)})
+    # The files are written under a temporary name and then renamed, so that
+    # a crashed or concurrent run never leaves a truncated artifact behind
+    pq.write_table(table, f"{filename}.parquet.tmp")
+    os.replace(f"{filename}.parquet.tmp", f"{filename}.parquet")
+    if csv:
+        df.to_csv(f"{filename}.csv.tmp", index=True)
+        os.replace(f"{filename}.csv.tmp", f"{filename}.csv")
+
+
+def read_metadata(path):
+    # Only the file footer is read
+    if not path.endswith(".parquet"):
+        return {}
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[METADATA_KEY]) if METADATA_KEY in metadata else {}
+
+
+def load_tmy(path):
+    """Load a TMY file, either a Parquet artifact or a csv file (which has no metadata).
+
+    :param path: Path of the TMY file
+    :type path: str
+    :return: Tuple made of (TMY DataFrame with a timestamp index, metadata)
+    :rtype: tuple
+    """
+    if path.endswith(".parquet"):
+        table = pq.read_table(path, memory_map=True)
+        metadata = table.schema.metadata or {}
+        return table.to_pandas(), json.loads(metadata[METADATA_KEY]) if METADATA_KEY in metadata else {}
+    df = pd.read_csv(path)
+    df.index = pd.to_datetime(df.pop("timestamp"))
+    return df, {}
+
+
+def find_tmy(directory=".", **criteria):
+    """Find the TMY artifacts in a directory whose metadata match all the
+    given criteria (e.g. station_id="ITORINO123", method="ISO"). The
+    alternative members of an ensemble are only matched if the member is given.
+
+    :param directory: Directory to be searched, defaults to "."
+    :type directory: str, optional
+    :return: Paths of the matching artifacts, the most recent first
+    :rtype: list
+    """
+    criteria.setdefault("member", None)
+    paths = sorted(glob.glob(f"{directory}/*.parquet"), key=os.path.getmtime, reverse=True)
+    metadata = {p: read_metadata(p) for p in paths}
+    return [p for p in paths if all(metadata[p].get(k) == v for k, v in criteria.items())]
+
+
+def open_tmy(directory=".", **criteria):
+    """Load the most recent TMY artifact whose metadata match the given criteria.
+
+    :return: Tuple made of (TMY DataFrame with a timestamp index, metadata)
+    :rtype: tuple
+    """
+    paths = find_tmy(directory, **criteria)
+    if not paths:
+        raise FileNotFoundError(f"No TMY file in {directory} matching {criteria}")
+    return load_tmy(paths[0])
@@ -1,12 +1,12 @@
 from influxdb_client import InfluxDBClient
-from math import sin, cos, sqrt, atan2,radians
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import ast
 import argparse
 import os
 from dotenv import load_dotenv
+from station_cube import query_cube, time_sums, haversine
 
 
 load_dotenv()
@@ -16,79 +16,78 @@ INFLUXDB_URL = os.getenv('INFLUXDB_URL')
 WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--radius", help="Urban area radius [km]", type=float, required=True)
-parser.add_argument("--lat", help="Latitude of urban area center point", type=float, required=True)
-parser.add_argument("--lon", help="Longitude of urban area center point", type=float, required=True)
+parser.add_argument("--radius", help="Space separated urban area radii [km]", type=float, nargs='+', required=True)
+parser.add_argument("--lat", help="Space separated latitudes of the urban area center points", type=float, nargs='+', required=True)
+parser.add_argument("--lon", help="Space separated longitudes of the urban area center points", type=float, nargs='+', required=True)
 parser.add_argument("--start_year", help="Start year", type=int, required=True)
 parser.add_argument("--end_year", help="End year", type=int, required=True)
+parser.add_argument("--csv", help="Flag to save the radius x hour and radius x month deltas of each center point in csv format", action="store_true")
 args = parser.parse_args()
+if len(args.lat) != len(args.lon):
+    parser.error("--lat and --lon must have the same number of values")
 
-radius, center_lat, center_lon, start_year, end_year = args.radius, args.lat, args.lon, args.start_year, args.end_year
+radii, centers, start_year, end_year, csv = sorted(args.radius), list(zip(args.lat, args.lon)), args.start_year, args.end_year, args.csv
 
 client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 query_api = client.query_api()
 
-query = f'from(bucket:"{WEATHER_UNDERGROUND_BUCKET_NAME}")\
-    |> range(start: {start_year-1}-12-31T23:59:00Z, stop: {end_year}-12-31T23:59:59Z)\
-    |> filter(fn: (r) => r["_field"] == "T_db[C]")\
-    |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)\
-    |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-
-df = query_api.query_data_frame(query)
-
-df['lat'] = df.apply(lambda row: ast.literal_eval(row.coords)[0], axis=1)
-df['lon'] = df.apply(lambda row: ast.literal_eval(row.coords)[1], axis=1)
-df.index = pd.to_datetime(df['_time'])
-df.sort_index(inplace=True)
-df.drop(columns=['result', 'table', '_start', '_stop', '_time', 'coords'], inplace=True)
-
-def filter_inner(row, lat2, lon2, max):
-    if getDist(row['lat'], row['lon'], lat2, lon2) <= max:
-        return True
-    else:
-        return False
-    
-def filter_outer(row, lat2, lon2, min):
-    if getDist(row['lat'], row['lon'], lat2, lon2) > min:
-        return True
-    else:
-        return False
-    
-def getDist(lat1, lon1, lat2, lon2):
-  R = 6373.0
-
-  lat1 = radians(lat1)
-  lon1 = radians(lon1)
-  lat2 = radians(lat2)
-  lon2 = radians(lon2)
-
-  dlon = lon2 - lon1
-  dlat = lat2 - lat1
-
-  a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-  c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-  return R * c
-
-df_inner = df[df.apply(filter_inner, args=(center_lat, center_lon, radius), axis=1)]
-df_outer = df[df.apply(filter_outer, args=(center_lat, center_lon, radius), axis=1)]
-
-inner_by_month = df_inner.groupby(df_inner.index.month)['T_db[C]'].mean()
-outer_by_month = df_outer.groupby(df_outer.index.month)['T_db[C]'].mean()
-
-inner_by_hour = df_inner.groupby(df_inner.index.hour)['T_db[C]'].mean()
-outer_by_hour = df_outer.groupby(df_outer.index.hour)['T_db[C]'].mean()
-
-plt.figure()
-plt.plot(inner_by_hour - outer_by_hour)
-plt.title(f"Hourly temperature gap between urban and sub-urban WSs")
-plt.xlabel("Hour of day")
-plt.ylabel("deltaT [°C]")
-
-plt.figure()
-plt.plot(inner_by_month - outer_by_month)
-plt.title("Monthly temperature gap between urban and sub-urban WSs")
-plt.xlabel("Month of year")
-plt.ylabel("deltaT [°C]")
-
-plt.show()
\ No newline at end of file
+# One station x hour cube instead of a long frame with the station tags repeated on every row
+cube = query_cube(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, pd.Timestamp(year=start_year, month=1, day=1), pd.Timestamp(year=end_year+1, month=1, day=1), ["T_db[C]"])
+
+def radius_deltas(dist, sums, counts, radii):
+    """Compute the difference between the mean temperature of the stations
+    within each radius and that of the stations outside it, from cumulative
+    sums over the stations sorted by distance.
+
+    :param dist: Distance of each station from the center point [km]
+    :type dist: class:`numpy.ndarray`
+    :param sums: Sum of the values of each station and key, with shape (stations, keys)
+    :type sums: class:`numpy.ndarray`
+    :param counts: Number of values of each station and key, with shape (stations, keys)
+    :type counts: class:`numpy.ndarray`
+    :param radii: Sorted radii [km]
+    :type radii: list
+    :return: Inner minus outer mean, with shape (radii, keys), NaN where one side has no data
+    :rtype: class:`numpy.ndarray`
+    """
+    order = np.argsort(dist, kind="stable")
+    # Prepending a row of zeros, row k holds the totals of the k closest stations
+    cum_sums = np.vstack([np.zeros(sums.shape[1]), np.cumsum(sums[order], axis=0)])
+    cum_counts = np.vstack([np.zeros(counts.shape[1]), np.cumsum(counts[order], axis=0)])
+    n_inner = np.searchsorted(dist[order], radii, side="right")
+    inner_sums, inner_counts = cum_sums[n_inner], cum_counts[n_inner]
+    outer_sums, outer_counts = cum_sums[-1] - inner_sums, cum_counts[-1] - inner_counts
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return inner_sums / inner_counts - outer_sums / outer_counts
+
+
+# The hourly and monthly aggregates of each station are computed only once for all the radii
+# and center points, then each radius only moves stations between the inner and outer sums
+times = pd.DatetimeIndex(cube["times"])
+hour_sums, hour_counts = (a[:, :, 0] for a in time_sums(cube, times.hour.values, 24))
+month_sums, month_counts = (a[:, :, 0] for a in time_sums(cube, times.month.values - 1, 12))
+
+for center_lat, center_lon in centers:
+    dist = haversine(cube["lat"], cube["lon"], center_lat, center_lon)
+    index = pd.Index(radii, name="radius[km]")
+    by_hour = pd.DataFrame(radius_deltas(dist, hour_sums, hour_counts, radii), index=index, columns=pd.RangeIndex(24, name="hour"))
+    by_month = pd.DataFrame(radius_deltas(dist, month_sums, month_counts, radii), index=index, columns=pd.RangeIndex(1, 13, name="month"))
+    if csv:
+        by_hour.to_csv(f"uhi_deltas_{center_lat}_{center_lon}_hourly.csv")
+        by_month.to_csv(f"uhi_deltas_{center_lat}_{center_lon}_monthly.csv")
+
+    plt.figure()
+    plt.plot(by_hour.T, label=[f"{r} km" for r in radii])
+    plt.title(f"Hourly temperature gap between urban and sub-urban WSs ({center_lat}, {center_lon})")
+    plt.xlabel("Hour of day")
+    plt.ylabel("deltaT [°C]")
+    plt.legend()
+
+    plt.figure()
+    plt.plot(by_month.T, label=[f"{r} km" for r in radii])
+    plt.title(f"Monthly temperature gap between urban and sub-urban WSs ({center_lat}, {center_lon})")
+    plt.xlabel("Month of year")
+    plt.ylabel("deltaT [°C]")
+    plt.legend()
+
+plt.show()
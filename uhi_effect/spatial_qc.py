@@ -0,0 +1,182 @@
+from influxdb_client import InfluxDBClient, Point
+from influxdb_client.client.write_api import SYNCHRONOUS
+import warnings
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import sys
+from dotenv import load_dotenv
+from station_cube import query_cube, haversine
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../epw_compiler")
+from influx_loader import QC_PREFIX
+from gap_filler import gap_lengths
+
+
+QC_OUTLIER = 1  # Too far from the neighbours' robust estimate
+QC_FLATLINE = 2  # Stuck sensor, repeating the same value
+N_NEIGHBOURS = 8
+MAX_DISTANCE = 20  # km
+MIN_NEIGHBOURS = 3
+Z_MAX = 4.0
+MIN_SCALE = 0.5  # Lower bound of the neighbours' spread, in the unit of the variable
+FLAT_HOURS = 6
+CHUNK_HOURS = 24 * 31
+
+
+def neighbour_graph(lat, lon, n_neighbours=N_NEIGHBOURS, max_distance=MAX_DISTANCE):
+    """Find the closest neighbours of every station.
+
+    :param lat: Latitude of each station
+    :type lat: class:`numpy.ndarray`
+    :param lon: Longitude of each station
+    :type lon: class:`numpy.ndarray`
+    :param n_neighbours: Maximum number of neighbours, defaults to 8
+    :type n_neighbours: int, optional
+    :param max_distance: Maximum distance of a neighbour [km], defaults to 20
+    :type max_distance: float, optional
+    :return: Index of the neighbours of each station with shape (stations, n_neighbours), -1 where there are fewer
+    :rtype: class:`numpy.ndarray`
+    """
+    dist = haversine(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+    np.fill_diagonal(dist, np.inf)
+    dist[dist > max_distance] = np.inf
+    order = np.argsort(dist, axis=1, kind="stable")[:, :n_neighbours]
+    return np.where(np.isfinite(np.take_along_axis(dist, order, axis=1)), order, -1)
+
+
+def outlier_flags(values, mask, graph, z_max=Z_MAX, min_scale=MIN_SCALE, min_neighbours=MIN_NEIGHBOURS, chunk_hours=CHUNK_HOURS):
+    """Flag the values whose robust z-score with respect to their neighbours,
+    (value - median) / (1.4826 * MAD), exceeds z_max. The medians and MADs of
+    all the stations are computed together, a chunk of hours at a time.
+
+    :param values: Values with shape (stations, hours)
+    :type values: class:`numpy.ndarray`
+    :param mask: Availability of the values with the same shape
+    :type mask: class:`numpy.ndarray`
+    :param graph: Neighbours of each station, as returned by neighbour_graph
+    :type graph: class:`numpy.ndarray`
+    :return: Boolean array with shape (stations, hours)
+    :rtype: class:`numpy.ndarray`
+    """
+    # A row of NaN is appended, so that the missing neighbours (-1) read NaN
+    x = np.vstack([np.where(mask, values, np.nan), np.full((1, values.shape[1]), np.nan, dtype=values.dtype)])
+    flags = np.zeros(values.shape, dtype=bool)
+    with warnings.catch_warnings():
+        # Hours without any neighbour give all-NaN slices
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for t0 in range(0, values.shape[1], chunk_hours):
+            t = slice(t0, t0 + chunk_hours)
+            nb = x[graph, t]
+            median = np.nanmedian(nb, axis=1)
+            mad = np.nanmedian(np.abs(nb - median[:, None]), axis=1)
+            n = (~np.isnan(nb)).sum(axis=1)
+            z = np.abs(x[:-1, t] - median) / np.maximum(1.4826 * mad, min_scale)
+            flags[:, t] = mask[:, t] & (n >= min_neighbours) & (z > z_max)
+    return flags
+
+
+def flatline_flags(values, mask, flat_hours=FLAT_HOURS, tolerance=1e-3):
+    """Flag the runs of at least flat_hours consecutive available values which
+    do not change.
+
+    :param values: Values with shape (stations, hours)
+    :type values: class:`numpy.ndarray`
+    :param mask: Availability of the values with the same shape
+    :type mask: class:`numpy.ndarray`
+    :return: Boolean array with shape (stations, hours)
+    :rtype: class:`numpy.ndarray`
+    """
+    same = mask[:, 1:] & mask[:, :-1] & (np.abs(np.diff(values, axis=1)) <= tolerance)
+    # A run of n unchanged steps spans n+1 values
+    flat = gap_lengths(same.T).T + 1 >= flat_hours
+    flags = np.zeros(values.shape, dtype=bool)
+    flags[:, 1:] |= flat
+    flags[:, :-1] |= flat
+    return flags
+
+
+def spatial_qc(cube, variable, graph=None, z_max=Z_MAX, min_scale=MIN_SCALE, flat_hours=FLAT_HOURS):
+    """Run the neighbour and flatline checks on a variable of a cube.
+
+    :param cube: Cube, as returned by station_cube.build_cube
+    :type cube: dict
+    :param variable: Variable to be checked
+    :type variable: str
+    :param graph: Neighbours of each station, computed from the cube coordinates if not given
+    :type graph: class:`numpy.ndarray`, optional
+    :return: Quality flags with shape (stations, times): 0 if good, otherwise a
+        combination of QC_OUTLIER and QC_FLATLINE
+    :rtype: class:`numpy.ndarray`
+    """
+    if graph is None:
+        graph = neighbour_graph(cube["lat"], cube["lon"])
+    i = cube["variables"].index(variable)
+    values, mask = cube["values"][:, :, i], cube["mask"][:, :, i]
+    flags = np.zeros(values.shape, dtype=np.uint8)
+    flags[outlier_flags(values, mask, graph, z_max, min_scale)] |= QC_OUTLIER
+    flags[flatline_flags(values, mask, flat_hours)] |= QC_FLATLINE
+    return flags
+
+
+def apply_qc(cube, variable, flags):
+    # Mask the flagged values, as query_cube does with the stored flags
+    i = cube["variables"].index(variable)
+    cube["mask"][:, :, i] &= flags == 0
+    cube["values"][:, :, i][flags != 0] = 0
+    return cube
+
+
+def upload_flags(writer, bucket, org, cube, variable, flags):
+    """Store the flags of every checked value next to the data, as the
+    qc_<variable> field of the same station. Each flag is written in the
+    middle of the window its value was aggregated from, [t, t+freq), so that
+    it is aggregated with its value.
+    """
+    i = cube["variables"].index(variable)
+    station_idx, time_idx = np.nonzero(cube["mask"][:, :, i])
+    times = pd.DatetimeIndex(cube["times"][time_idx]) + pd.Timedelta(cube["freq"]) / 2
+    dataPoints = [
+        Point(cube["stations"][s]).tag('coords', (cube["lat"][s], cube["lon"][s])).field(f"{QC_PREFIX}{variable}", int(flags[s, t])).time(ts.tz_localize('UTC'))
+            for s, t, ts in zip(station_idx, time_idx, times)
+    ]
+    writer.write(bucket=bucket, org=org, record=dataPoints)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    INFLUXDB_ORG = os.getenv('INFLUXDB_ORG')
+    INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
+    INFLUXDB_URL = os.getenv('INFLUXDB_URL')
+    WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start_year", help="Start year", type=int, required=True)
+    parser.add_argument("--end_year", help="End year", type=int, required=True)
+    parser.add_argument("--variables", help="Space separated fields to be checked (default=T_db[C])", nargs='+', default=["T_db[C]"])
+    parser.add_argument("--z_max", help="Maximum robust z-score with respect to the neighbours (default=4)", type=float, default=Z_MAX)
+    parser.add_argument("--min_scale", help="Minimum spread of the neighbours, in the unit of the variable (default=0.5)", type=float, default=MIN_SCALE)
+    parser.add_argument("--flat_hours", help="Minimum length in hours of a run of unchanged values to be flagged (default=6)", type=int, default=FLAT_HOURS)
+    parser.add_argument("--dry_run", help="Flag to only print the summary, without storing the flags", action="store_true")
+    args = parser.parse_args()
+
+    client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+    query_api = client.query_api()
+    writer = client.write_api(write_options=SYNCHRONOUS)
+
+    start, end = pd.Timestamp(year=args.start_year, month=1, day=1), pd.Timestamp(year=args.end_year+1, month=1, day=1)
+    # The stored flags are not applied, so that every value is checked (and its flag rewritten) again
+    cube = query_cube(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, start, end, args.variables, qc=False)
+    # The neighbour graph is built once and shared by all the variables
+    graph = neighbour_graph(cube["lat"], cube["lon"])
+    print(f"{len(cube['stations'])} stations, {np.mean((graph >= 0).sum(axis=1)):.1f} neighbours per station on average")
+
+    for variable in args.variables:
+        i = cube["variables"].index(variable)
+        flags = spatial_qc(cube, variable, graph, args.z_max, args.min_scale, args.flat_hours)
+        n_values = cube["mask"][:, :, i].sum()
+        print(f"{variable}: {((flags & QC_OUTLIER) > 0).sum() / max(n_values, 1):.2%} outliers, {((flags & QC_FLATLINE) > 0).sum() / max(n_values, 1):.2%} flatlines")
+        flagged = pd.Series((flags != 0).sum(axis=1) / np.maximum(cube["mask"][:, :, i].sum(axis=1), 1), index=cube["stations"])
+        print(flagged[flagged > 0].sort_values(ascending=False).head(10).to_string(float_format="{:.1%}".format))
+        if not args.dry_run:
+            upload_flags(writer, WEATHER_UNDERGROUND_BUCKET_NAME, INFLUXDB_ORG, cube, variable, flags)
@@ -0,0 +1,246 @@
+import ast
+import os
+import warnings
+import sys
+import numpy as np
+import pandas as pd
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../epw_compiler")
+from influx_loader import QC_PREFIX
+
+
+def query_cube(query_api, bucket, start, end, fields, every="1h", qc=True):
+    """Query the hourly (or any other window) means of some fields of all the
+    stations in a bucket, and build a cube from them. Each window is labelled
+    by its start, so the time step t of the cube holds the data in [t, t+every).
+    Unless qc is False, the values flagged by the spatial quality control are masked.
+
+    :param query_api: InfluxDB query API
+    :type query_api: class:`influxdb_client.QueryApi`
+    :param bucket: Bucket name
+    :type bucket: str
+    :param start: Start of the range
+    :type start: class:`pandas.Timestamp`
+    :param end: End of the range (excluded)
+    :type end: class:`pandas.Timestamp`
+    :param fields: Fields to be queried (e.g. ["T_db[C]"])
+    :type fields: list
+    :param every: Aggregation window, defaults to "1h"
+    :type every: str, optional
+    :param qc: Flag to mask the values flagged by the quality control, defaults to True
+    :type qc: bool, optional
+    :return: Cube, as returned by build_cube
+    :rtype: dict
+    """
+    field_filter = " or ".join(f'r["_field"] == "{f}"' for f in fields + ([f"{QC_PREFIX}{f}" for f in fields] if qc else []))
+    query = f'from(bucket:"{bucket}")\
+            |> range(start: {start:%Y-%m-%dT%H:%M:%SZ}, stop: {end:%Y-%m-%dT%H:%M:%SZ})\
+            |> filter(fn: (r) => {field_filter})\
+            |> aggregateWindow(every: {every}, fn: mean, createEmpty: false, timeSrc: "_start")\
+            |> keep(columns: ["_time", "_value", "_field", "_measurement", "coords"])'
+
+    df = query_api.query_data_frame(query)
+    if isinstance(df, list):
+        df = pd.concat(df, ignore_index=True)
+    return build_cube(df, start, end, variables=fields, freq=pd.Timedelta(every))
+
+
+def build_cube(df, start, end, variables=None, freq=pd.Timedelta(hours=1)):
+    """Lay out a long-format query result (one row per station, time and
+    field) as a dense station x time x variable cube.
+
+    The values are stored as float32, with the missing values set to 0 and
+    flagged in a boolean mask, so that sums and counts over any axis are plain
+    array reductions. The values whose quality flag (qc_<field> rows) is
+    positive are masked.
+
+    :param df: DataFrame with _time (start of the aggregation window), _value,
+        _field, _measurement and coords columns
+    :type df: class:`pandas.core.frame.DataFrame`
+    :param start: Start of the time axis
+    :type start: class:`pandas.Timestamp`
+    :param end: End of the time axis (excluded)
+    :type end: class:`pandas.Timestamp`
+    :param variables: Variables (fields) of the cube, defaults to the fields in df
+    :type variables: list, optional
+    :param freq: Time step, defaults to 1 hour
+    :type freq: class:`pandas.Timedelta`, optional
+    :return: Cube as a dict with the "stations", "lat", "lon", "times" (start of
+        each step) and "variables" labels, the "freq" time step, the "values" array
+        with shape (stations, times, variables) and the "mask" array (True where a
+        value is available)
+    :rtype: dict
+    """
+    times = pd.date_range(start, end, freq=freq, inclusive="left")
+    if df.empty:
+        variables = list(variables or [])
+        return {
+            "stations": np.array([], dtype=object),
+            "lat": np.array([]),
+            "lon": np.array([]),
+            "times": times.values,
+            "freq": freq,
+            "variables": variables,
+            "values": np.zeros((0, len(times), len(variables)), dtype=np.float32),
+            "mask": np.zeros((0, len(times), len(variables)), dtype=bool),
+        }
+
+    station_idx, stations = pd.factorize(df["_measurement"], sort=True)
+    variables = list(variables) if variables is not None else sorted(f for f in df["_field"].unique() if not f.startswith(QC_PREFIX))
+    var_idx = pd.Index(variables).get_indexer(df["_field"])
+    qc_idx = pd.Index([f"{QC_PREFIX}{v}" for v in variables]).get_indexer(df["_field"])
+    offset = pd.to_datetime(df["_time"]).dt.tz_localize(None).values - times.values[0]
+    time_idx, remainder = np.divmod(offset, np.timedelta64(freq))
+    on_axis = (remainder == np.timedelta64(0)) & (time_idx >= 0) & (time_idx < len(times))
+    # Rows off the axis would be windows labelled by their stop, or not aligned with start
+    if not on_axis.all():
+        warnings.warn(f"{(~on_axis).sum()} rows are not on the {freq} time axis starting at {start} and were dropped")
+    valid = (var_idx >= 0) & on_axis
+    flagged = (qc_idx >= 0) & on_axis & (df["_value"].values > 0)
+
+    values = np.zeros((len(stations), len(times), len(variables)), dtype=np.float32)
+    mask = np.zeros(values.shape, dtype=bool)
+    values[station_idx[valid], time_idx[valid], var_idx[valid]] = df["_value"].values[valid]
+    mask[station_idx[valid], time_idx[valid], var_idx[valid]] = True
+    mask[station_idx[flagged], time_idx[flagged], qc_idx[flagged]] = False
+    mask &= ~np.isnan(values)
+    values[~mask] = 0
+
+    # The coordinates of each station are parsed only once, from its first row
+    first = np.unique(station_idx, return_index=True)[1]
+    coords = np.array([ast.literal_eval(c) for c in df["coords"].values[first]], dtype=float).reshape(-1, 2)
+    return {
+        "stations": np.asarray(stations, dtype=object),
+        "lat": coords[:, 0],
+        "lon": coords[:, 1],
+        "times": times.values,
+        "freq": freq,
+        "variables": variables,
+        "values": values,
+        "mask": mask,
+    }
+
+
+def select(cube, stations=None, start=None, end=None, variables=None):
+    """Slice a cube by station, time range and variable. Time ranges and
+    single variables are sliced as views, without copying the values.
+
+    :param stations: Station IDs or boolean mask over the stations, defaults to all
+    :type stations: list, optional
+    :param start: Start of the time range, defaults to the start of the cube
+    :type start: class:`pandas.Timestamp`, optional
+    :param end: End of the time range (excluded), defaults to the end of the cube
+    :type end: class:`pandas.Timestamp`, optional
+    :param variables: Variables, defaults to all
+    :type variables: list, optional
+    :return: Sliced cube
+    :rtype: dict
+    """
+    if stations is None:
+        s = slice(None)
+    elif np.asarray(stations).dtype == bool:
+        s = np.asarray(stations)
+    else:
+        s = pd.Index(cube["stations"]).get_indexer(stations)
+    t = slice(
+        None if start is None else np.searchsorted(cube["times"], np.datetime64(pd.Timestamp(start))),
+        None if end is None else np.searchsorted(cube["times"], np.datetime64(pd.Timestamp(end)))
+    )
+    v = slice(None) if variables is None else [cube["variables"].index(var) for var in variables]
+    if isinstance(v, list) and len(v) == 1:
+        v = slice(v[0], v[0] + 1)
+    return {
+        "stations": cube["stations"][s],
+        "lat": cube["lat"][s],
+        "lon": cube["lon"][s],
+        "times": cube["times"][t],
+        "freq": cube["freq"],
+        "variables": cube["variables"] if variables is None else list(variables),
+        "values": cube["values"][s][:, t][:, :, v],
+        "mask": cube["mask"][s][:, t][:, :, v],
+    }
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great-circle distance [km], vectorized over arrays of coordinates
+    R = 6373.0
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def station_attributes(cube):
+    # One row per station, to be extended with any attribute used for grouping (e.g. distance)
+    return pd.DataFrame({"lat": cube["lat"], "lon": cube["lon"]}, index=pd.Index(cube["stations"], name="station"))
+
+
+def group_sums(cube, labels):
+    """Sum the values and count the available ones over the stations of each
+    group, with a single matrix product.
+
+    :param labels: Group label of each station (e.g. a column of station_attributes)
+    :type labels: array-like
+    :return: Tuple made of (groups, sums, counts), the arrays with shape (groups, times, variables)
+    :rtype: tuple
+    """
+    group_idx, groups = pd.factorize(np.asarray(labels), sort=True)
+    membership = np.zeros((len(groups), len(group_idx)))
+    membership[group_idx, np.arange(len(group_idx))] = 1
+    n_stations, n_times, n_vars = cube["values"].shape
+    sums = membership @ cube["values"].reshape(n_stations, -1).astype(np.float64)
+    counts = membership @ cube["mask"].reshape(n_stations, -1)
+    return groups, sums.reshape(len(groups), n_times, n_vars), counts.reshape(len(groups), n_times, n_vars)
+
+
+def group_mean(cube, labels):
+    """Mean of the available values over the stations of each group.
+
+    :param labels: Group label of each station
+    :type labels: array-like
+    :return: Dict mapping each variable to a DataFrame with a time index and one column per group
+    :rtype: dict
+    """
+    groups, sums, counts = group_sums(cube, labels)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    index = pd.DatetimeIndex(cube["times"], name="timestamp")
+    return {var: pd.DataFrame(means[:, :, i].T, index=index, columns=groups) for i, var in enumerate(cube["variables"])}
+
+
+def spatial_mean(cube, weights=None):
+    """Weighted mean of the available values over all the stations.
+
+    :param weights: Weight of each station, defaults to equal weights
+    :type weights: class:`numpy.ndarray`, optional
+    :return: DataFrame with a time index and one column per variable
+    :rtype: class:`pandas.core.frame.DataFrame`
+    """
+    w = np.ones(len(cube["stations"])) if weights is None else np.asarray(weights, dtype=float)
+    sums = np.einsum("s,stv->tv", w, cube["values"], dtype=np.float64)
+    norm = np.einsum("s,stv->tv", w, cube["mask"], dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame(sums / norm, index=pd.DatetimeIndex(cube["times"], name="timestamp"), columns=cube["variables"])
+
+
+def time_sums(cube, keys, n_keys):
+    """Sum the values and count the available ones of each station over the
+    time steps sharing the same key (e.g. hour of day or month).
+
+    :param keys: Integer key of each time step, from 0 to n_keys-1
+    :type keys: class:`numpy.ndarray`
+    :param n_keys: Number of keys
+    :type n_keys: int
+    :return: Tuple made of (sums, counts), with shape (stations, n_keys, variables)
+    :rtype: tuple
+    """
+    onehot = np.zeros((len(keys), n_keys))
+    onehot[np.arange(len(keys)), keys] = 1
+    sums = np.einsum("stv,tk->skv", cube["values"], onehot, dtype=np.float64)
+    counts = np.einsum("stv,tk->skv", cube["mask"], onehot, dtype=np.float64)
+    return sums, counts
+
+
+def to_frame(cube, variable):
+    # Wide DataFrame of a variable, with a time index, one column per station and NaN where missing
+    i = cube["variables"].index(variable)
+    values = np.where(cube["mask"][:, :, i], cube["values"][:, :, i], np.nan)
+    return pd.DataFrame(values.T, index=pd.DatetimeIndex(cube["times"], name="timestamp"), columns=pd.Index(cube["stations"], name="station"))
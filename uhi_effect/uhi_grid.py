@@ -0,0 +1,265 @@
+from influxdb_client import InfluxDBClient
+from scipy.spatial import cKDTree
+import scipy.sparse
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import hashlib
+import argparse
+import shutil
+import os
+import sys
+from dotenv import load_dotenv
+from station_cube import query_cube
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../epw_compiler")
+from artifact_cache import CACHE_DIR
+
+
+KM_PER_DEGREE = 111.32
+RESOLUTION = 0.5  # km
+MARGIN = 2  # km around the stations
+POWER = 2
+N_NEIGHBOURS = 8
+MAX_DISTANCE = 10  # km
+LENGTH_SCALE = 5  # km
+NOISE = 0.1  # Share of the signal variance due to the noise of the stations
+CHUNK_STEPS = 24 * 7
+RANGE_COLOR = (-10, 40)  # °C, as in uhi_map.py
+TILE_CACHE_DIR = f"{CACHE_DIR}/uhi_tiles"
+
+
+def make_grid(lat, lon, resolution=RESOLUTION, margin=MARGIN):
+    """Build a regular grid covering the stations.
+
+    :param lat: Latitude of each station
+    :type lat: class:`numpy.ndarray`
+    :param lon: Longitude of each station
+    :type lon: class:`numpy.ndarray`
+    :param resolution: Size of a cell [km], defaults to 0.5
+    :type resolution: float, optional
+    :param margin: Margin around the stations [km], defaults to 2
+    :type margin: float, optional
+    :return: Grid as a dict with the "lat" (from north to south) and "lon" (from west to east) axes
+    :rtype: dict
+    """
+    lat0 = np.mean(lat)
+    dlat = resolution / KM_PER_DEGREE
+    dlon = resolution / (KM_PER_DEGREE * np.cos(np.radians(lat0)))
+    m_lat, m_lon = margin / resolution * dlat, margin / resolution * dlon
+    return {
+        "lat": np.arange(np.max(lat) + m_lat, np.min(lat) - m_lat, -dlat),
+        "lon": np.arange(np.min(lon) - m_lon, np.max(lon) + m_lon, dlon),
+    }
+
+
+def to_km(grid, lat, lon):
+    # Local equirectangular projection, accurate enough at the scale of a city
+    lat0 = np.mean(grid["lat"])
+    return np.column_stack([
+        (np.asarray(lon) - grid["lon"][0]) * KM_PER_DEGREE * np.cos(np.radians(lat0)),
+        (np.asarray(lat) - grid["lat"][-1]) * KM_PER_DEGREE,
+    ])
+
+
+def grid_points(grid):
+    lon, lat = np.meshgrid(grid["lon"], grid["lat"])
+    return to_km(grid, lat.ravel(), lon.ravel())
+
+
+def idw_weights(grid, lat, lon, power=POWER, n_neighbours=N_NEIGHBOURS, max_distance=MAX_DISTANCE):
+    """Precompute the inverse-distance weights of the closest stations of
+    every cell, so that interpolating a time step is a sparse matrix-vector
+    product. The weights are not normalized, so that the missing stations of
+    each time step can be left out by interpolate.
+
+    :param grid: Grid, as returned by make_grid
+    :type grid: dict
+    :param lat: Latitude of each station
+    :type lat: class:`numpy.ndarray`
+    :param lon: Longitude of each station
+    :type lon: class:`numpy.ndarray`
+    :param power: Power of the distance, defaults to 2
+    :type power: float, optional
+    :param n_neighbours: Maximum number of stations per cell, defaults to 8
+    :type n_neighbours: int, optional
+    :param max_distance: Maximum distance of a station from a cell [km], defaults to 10
+    :type max_distance: float, optional
+    :return: Sparse matrix with shape (cells, stations)
+    :rtype: class:`scipy.sparse.csr_matrix`
+    """
+    k = min(n_neighbours, len(lat))
+    dist, idx = cKDTree(to_km(grid, lat, lon)).query(grid_points(grid), k=k, distance_upper_bound=max_distance)
+    dist, idx = dist.reshape(-1, k), idx.reshape(-1, k)
+    found = np.isfinite(dist)
+    # A station on a cell centre gets the whole weight of the cell
+    weights = 1 / np.maximum(dist[found], 1e-3)**power
+    rows = np.broadcast_to(np.arange(dist.shape[0])[:, None], dist.shape)[found]
+    return scipy.sparse.csr_matrix((weights, (rows, idx[found])), shape=(dist.shape[0], len(lat)))
+
+
+def gp_weights(grid, lat, lon, available, length_scale=LENGTH_SCALE, noise=NOISE):
+    """Precompute the weights of a Gaussian process regression (simple kriging
+    around the mean of the stations) with a squared exponential kernel, for a
+    set of available stations. The mean removal is folded into the weights, so
+    that interpolating a time step is still a single matrix-vector product.
+
+    :param grid: Grid, as returned by make_grid
+    :type grid: dict
+    :param lat: Latitude of each station
+    :type lat: class:`numpy.ndarray`
+    :param lon: Longitude of each station
+    :type lon: class:`numpy.ndarray`
+    :param available: Boolean mask of the stations with a value
+    :type available: class:`numpy.ndarray`
+    :param length_scale: Correlation length [km], defaults to 5
+    :type length_scale: float, optional
+    :param noise: Share of the variance due to the noise of the stations, defaults to 0.1
+    :type noise: float, optional
+    :return: Matrix with shape (cells, stations), whose rows sum to 1 and with zero columns for the missing stations
+    :rtype: class:`numpy.ndarray`
+    """
+    xy = to_km(grid, lat, lon)[available]
+    d2 = ((xy[:, None, :] - xy[None, :, :])**2).sum(axis=-1)
+    d2_cells = ((grid_points(grid)[:, None, :] - xy[None, :, :])**2).sum(axis=-1)
+    K = np.exp(-d2 / (2 * length_scale**2)) + noise * np.eye(len(xy))
+    K_cells = np.exp(-d2_cells / (2 * length_scale**2))
+    # K is symmetric positive definite, so the weights are solved for all the cells at once
+    w = np.linalg.solve(K, K_cells.T).T
+    w += (1 - w.sum(axis=1, keepdims=True)) / max(len(xy), 1)
+    weights = np.zeros((w.shape[0], len(lat)))
+    weights[:, available] = w
+    return weights
+
+
+def interpolate(weights, values, mask):
+    """Interpolate one or several time steps on the grid, using only the
+    available stations of each time step.
+
+    :param weights: Weights, as returned by idw_weights or gp_weights
+    :type weights: class:`scipy.sparse.csr_matrix` or class:`numpy.ndarray`
+    :param values: Values with shape (stations,) or (stations, times)
+    :type values: class:`numpy.ndarray`
+    :param mask: Availability of the values with the same shape
+    :type mask: class:`numpy.ndarray`
+    :return: Fields with shape (cells,) or (cells, times), NaN where no station is close enough
+    :rtype: class:`numpy.ndarray`
+    """
+    # Values and availability are stacked, so that both sums are a single product
+    n = values.shape[1] if values.ndim == 2 else 1
+    stacked = np.hstack([np.where(mask, values, 0).reshape(len(mask), n), mask.reshape(len(mask), n)]).astype(np.float64)
+    sums = weights @ stacked
+    with np.errstate(invalid="ignore", divide="ignore"):
+        field = sums[:, :n] / sums[:, n:]
+    return field.reshape(-1) if values.ndim == 1 else field
+
+
+def interpolate_cube(cube, variable, grid, method="idw", **kwargs):
+    """Interpolate every time step of a variable of a cube.
+
+    The IDW weights are computed once for the stations of the cube, while the
+    GP weights are computed once per distinct set of available stations.
+
+    :param cube: Cube, as returned by station_cube.build_cube
+    :type cube: dict
+    :param variable: Variable to be interpolated
+    :type variable: str
+    :param grid: Grid, as returned by make_grid
+    :type grid: dict
+    :param method: "idw" or "gp", defaults to "idw"
+    :type method: str, optional
+    :return: Fields with shape (times, lat, lon), NaN where no station is close enough
+    :rtype: class:`numpy.ndarray`
+    """
+    i = cube["variables"].index(variable)
+    values, mask = cube["values"][:, :, i], cube["mask"][:, :, i]
+    fields = np.full((len(cube["times"]), len(grid["lat"]), len(grid["lon"])), np.nan, dtype=np.float32)
+    if method == "idw":
+        weights = idw_weights(grid, cube["lat"], cube["lon"], **kwargs)
+        # The time steps are interpolated a chunk at a time, to bound the memory of the intermediate products
+        for t0 in range(0, len(fields), CHUNK_STEPS):
+            t = slice(t0, t0 + CHUNK_STEPS)
+            fields[t] = interpolate(weights, values[:, t], mask[:, t]).T.reshape(-1, *fields.shape[1:])
+        return fields
+    patterns, pattern_idx = np.unique(mask.T, axis=0, return_inverse=True)
+    for p, available in enumerate(patterns):
+        if not available.any():
+            continue
+        t = pattern_idx.ravel() == p
+        weights = gp_weights(grid, cube["lat"], cube["lon"], available, **kwargs)
+        fields[t] = interpolate(weights, values[:, t], mask[:, t]).T.reshape(-1, *fields.shape[1:])
+    return fields
+
+
+def grid_corners(grid):
+    # Outer corners of the grid (clockwise from the north-west one) as [lon, lat] pairs, e.g. for a mapbox image layer
+    dlat, dlon = abs(grid["lat"][1] - grid["lat"][0]) / 2, abs(grid["lon"][1] - grid["lon"][0]) / 2
+    north, south = grid["lat"][0] + dlat, grid["lat"][-1] - dlat
+    west, east = grid["lon"][0] - dlon, grid["lon"][-1] + dlon
+    return [[west, north], [east, north], [east, south], [west, south]]
+
+
+def render_tile(field, range_color=RANGE_COLOR, cmap="RdBu_r"):
+    """Render a field as a PNG image, reusing the image rendered for the same
+    field (and colour scale) when found in the tile cache.
+
+    :param field: Field with shape (lat, lon)
+    :type field: class:`numpy.ndarray`
+    :return: Path of the PNG image
+    :rtype: str
+    """
+    key = hashlib.sha256(f"{range_color}|{cmap}|{field.shape}".encode())
+    key.update(np.ascontiguousarray(field, dtype=np.float32).tobytes())
+    path = f"{TILE_CACHE_DIR}/{key.hexdigest()}.png"
+    if not os.path.exists(path):
+        os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+        # Cells without a close enough station are left transparent
+        plt.imsave(f"{path}.{os.getpid()}.tmp.png", np.ma.masked_invalid(field), cmap=cmap, vmin=range_color[0], vmax=range_color[1])
+        os.replace(f"{path}.{os.getpid()}.tmp.png", path)
+    return path
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    INFLUXDB_ORG = os.getenv('INFLUXDB_ORG')
+    INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
+    INFLUXDB_URL = os.getenv('INFLUXDB_URL')
+    WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start_ts", help="Start timestamp (e.g. 2023-01-01T00:00:00Z)", required=True)
+    parser.add_argument("--end_ts", help="End timestamp, excluded (e.g. 2023-02-01T00:00:00Z)", required=True)
+    parser.add_argument("--freq", help="Time step of the fields, hourly or daily (default=1h)", choices=["1h", "1d"], default="1h")
+    parser.add_argument("--method", help="Interpolation method, inverse-distance weighting or Gaussian process (default=idw)", choices=["idw", "gp"], default="idw")
+    parser.add_argument("--resolution", help="Size of a grid cell in km (default=0.5)", type=float, default=RESOLUTION)
+    parser.add_argument("--power", help="Power of the distance for inverse-distance weighting (default=2)", type=float, default=POWER)
+    parser.add_argument("--length_scale", help="Correlation length in km for the Gaussian process (default=5)", type=float, default=LENGTH_SCALE)
+    parser.add_argument("--out_dir", help="Folder where the images of the fields are saved (default=uhi_grid)", default="uhi_grid")
+    parser.add_argument("--csv", help="Flag to also save the fields in csv format (one row per time step and cell)", action="store_true")
+    args = parser.parse_args()
+
+    client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+    query_api = client.query_api()
+
+    start = pd.to_datetime(args.start_ts, utc=True).tz_localize(None)
+    end = pd.to_datetime(args.end_ts, utc=True).tz_localize(None)
+    if start != start.floor(args.freq) or end != end.floor(args.freq):
+        # The windows are aligned to the UTC epoch, so the range must start and end on a window boundary
+        parser.error(f"--start_ts and --end_ts must be multiples of {args.freq} (e.g. midnight UTC for 1d)")
+    cube = query_cube(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, start, end, ["T_db[C]"], every=args.freq)
+    grid = make_grid(cube["lat"], cube["lon"], args.resolution)
+    kwargs = {"power": args.power} if args.method == "idw" else {"length_scale": args.length_scale}
+    fields = interpolate_cube(cube, "T_db[C]", grid, args.method, **kwargs)
+    print(f"{len(cube['stations'])} stations, {len(cube['times'])} time steps on a {len(grid['lat'])} x {len(grid['lon'])} grid")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for ts, field in zip(pd.DatetimeIndex(cube["times"]), fields):
+        shutil.copyfile(render_tile(field), f"{args.out_dir}/T_db_{ts:%Y%m%dT%H%M}.png")
+
+    if args.csv:
+        lon, lat = np.meshgrid(grid["lon"], grid["lat"])
+        pd.DataFrame({
+            "timestamp": np.repeat(cube["times"], lat.size),
+            "lat": np.tile(lat.ravel(), len(fields)),
+            "lon": np.tile(lon.ravel(), len(fields)),
+            "T_db[C]": fields.reshape(-1),
+        }).dropna().to_csv(f"{args.out_dir}/T_db_{args.method}.csv", index=False)
@@ -1,14 +1,26 @@
 from influxdb_client import InfluxDBClient
-from datetime import timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+import time
 
-from dash import Dash, dcc, html, Input, Output, State
+from dash import Dash, dcc, html, Input, Output, State, Patch
 import plotly.express as px
 
+import numpy as np
 import pandas as pd
-import ast
+import base64
+import hashlib
+import json
 import argparse
 import os
+import sys
 from dotenv import load_dotenv
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../epw_compiler")
+from artifact_cache import CACHE_DIR, code_version, hash_parts, influx_watermark, save_frame, load_frame
+from station_cube import query_cube
+from uhi_grid import make_grid, idw_weights, interpolate, grid_corners, render_tile
 
 
 load_dotenv()
@@ -17,62 +29,329 @@ INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
 INFLUXDB_URL = os.getenv('INFLUXDB_URL')
 MAPBOX_TOKEN = os.getenv('MAPBOX_TOKEN')
 WEATHER_UNDERGROUND_BUCKET_NAME = os.getenv('WEATHER_UNDERGROUND_BUCKET_NAME')
+FIGURE_CACHE_SIZE = 64  # Rendered figures kept in memory and on disk
+DAY_CACHE_SIZE = 128  # Days of station data kept in memory
+PREFETCH_DAYS = 2  # Days loaded in the background before and after the selected one
+WATERMARK_TTL = 60  # Seconds the watermark of a day is reused before asking InfluxDB again
+CHUNK_DAYS = 31  # Days sent to the browser at a time in the client-side mode
+DAY_CACHE_DIR = f"{CACHE_DIR}/uhi_days/{WEATHER_UNDERGROUND_BUCKET_NAME}"
+FIGURE_CACHE_DIR = f"{CACHE_DIR}/uhi_map"
+MARKER_SIZE = 30
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--start_ts", help="Start timestamp (e.g. 2023-01-01T00:00:00Z)", required=True)
 parser.add_argument("--end_ts", help="End timestamp (e.g. 2023-01-31T23:59:59Z)", required=True)
+parser.add_argument("--raster", help="Flag to draw the temperature field interpolated between the stations under the markers (server side mode only)", action="store_true")
+parser.add_argument("--clientside", help="Flag to send the data to the browser in chunks of days, and update the map without server round trips within the loaded chunks", action="store_true")
 args = parser.parse_args()
 
-start_ts, end_ts = args.start_ts, args.end_ts
+start_ts, end_ts, clientside, raster = args.start_ts, args.end_ts, args.clientside, args.raster
 
 client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 query_api = client.query_api()
 
-query = f'from(bucket:"{WEATHER_UNDERGROUND_BUCKET_NAME}")\
-    |> range(start: {start_ts}, stop: {end_ts})\
-    |> filter(fn: (r) => r["_field"] == "T_db[C]")\
-    |> aggregateWindow(every: 1d, fn: mean, createEmpty: false)\
-    |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+# The slider covers every day of the range, the data of each day is only queried when needed
+DAYS = pd.date_range(pd.to_datetime(start_ts, utc=True).floor('D'), pd.to_datetime(end_ts, utc=True), freq='D')
+VERSION = code_version()
 
-df = query_api.query_data_frame(query)
 
-df['lat'] = df.apply(lambda row: ast.literal_eval(row.coords)[0], axis=1)
-df['lon'] = df.apply(lambda row: ast.literal_eval(row.coords)[1], axis=1)
-df.index = pd.to_datetime(df['_time'])
-df.sort_index(inplace=True)
-df.drop(columns=['result', 'table', '_start', '_stop', '_time', 'coords'], inplace=True)
+def query_day(day):
+    # Daily mean of the hourly means which passed the spatial quality control, over the 24 hours of the day
+    cube = query_cube(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, day.tz_localize(None), (day + pd.Timedelta(days=1)).tz_localize(None), ["T_db[C]"])
+    counts = cube["mask"][:, :, 0].sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        temp = cube["values"][:, :, 0].sum(axis=1, dtype=np.float64) / counts
+    valid = counts > 0
+    return pd.DataFrame({
+        'lat': cube["lat"][valid],
+        'lon': cube["lon"][valid],
+        'T_db[C]': temp[valid].round(1)
+    })
+
+
+def day_complete(day):
+    return day + pd.Timedelta(days=1) <= pd.Timestamp.utcnow()
+
+
+def fetch_day(selected_ts, key):
+    """Read the daily mean temperature of every station on a day, from the
+    disk cache shared by all the server processes or from InfluxDB. Only the
+    days before the current one are cached on disk, as they are complete.
+
+    :param selected_ts: Slider position
+    :type selected_ts: int
+    :param key: Cache key of the day, as returned by day_key (None to query InfluxDB directly)
+    :type key: str
+    :return: Tuple made of (latitudes, longitudes, temperatures) arrays
+    :rtype: tuple
+    """
+    day = DAYS[selected_ts]
+    if key is None:
+        df = query_day(day)
+        return df['lat'].to_numpy(), df['lon'].to_numpy(), df['T_db[C]'].to_numpy()
+    day_dir = f"{DAY_CACHE_DIR}/{day:%Y-%m-%d}"
+    path = f"{day_dir}/{key}.parquet"
+    if os.path.exists(path):
+        df = load_frame(path)
+    else:
+        df = query_day(day)
+        save_frame(df, path)
+        # Only the latest version of a day is kept
+        for entry in os.scandir(day_dir):
+            if entry.path != path and entry.name.endswith(".parquet"):
+                os.remove(entry.path)
+    return df['lat'].to_numpy(), df['lon'].to_numpy(), df['T_db[C]'].to_numpy()
+
+
+# Bounded LRU of the days being loaded or loaded, keyed by (slider position, cache key) and shared by the callbacks
+# and the prefetcher, and the cache keys of the complete days with the time they were computed
+day_futures = OrderedDict()
+day_keys = {}
+day_lock = threading.Lock()
+loader = ThreadPoolExecutor(max_workers=PREFETCH_DAYS * 2)
+
+
+def day_key(selected_ts):
+    """Cache key of the data of a complete day, made of a watermark of the
+    day's data in InfluxDB (so back-filled points and new quality flags are
+    picked up) and of the code version. The key is reused for WATERMARK_TTL
+    seconds, so that moving the slider over loaded days does not query InfluxDB.
+
+    :param selected_ts: Slider position
+    :type selected_ts: int
+    :return: Cache key, None for the current day, whose data is still changing
+    :rtype: str
+    """
+    day = DAYS[selected_ts]
+    if not day_complete(day):
+        return None
+    with day_lock:
+        cached = day_keys.get(selected_ts)
+    if cached is not None and time.monotonic() - cached[0] < WATERMARK_TTL:
+        return cached[1]
+    watermark = influx_watermark(query_api, WEATHER_UNDERGROUND_BUCKET_NAME, None, day.tz_localize(None), (day + pd.Timedelta(days=1)).tz_localize(None))
+    key = hash_parts('uhi_day', watermark, VERSION)
+    with day_lock:
+        day_keys[selected_ts] = (time.monotonic(), key)
+    return key
+
+
+def day_future(selected_ts, key):
+    with day_lock:
+        if (selected_ts, key) in day_futures:
+            day_futures.move_to_end((selected_ts, key))
+        else:
+            # The data of an older watermark of the day is dropped
+            for stale in [k for k in day_futures if k[0] == selected_ts]:
+                del day_futures[stale]
+            day_futures[(selected_ts, key)] = loader.submit(fetch_day, selected_ts, key)
+            if len(day_futures) > DAY_CACHE_SIZE:
+                day_futures.popitem(last=False)
+        return day_futures[(selected_ts, key)]
+
+
+def prefetch_day(selected_ts):
+    day_future(selected_ts, day_key(selected_ts))
+
+
+def load_day(selected_ts, key):
+    future = day_future(selected_ts, key)
+    # The neighbouring days are prefetched in the background, as the slider is usually moved by one step
+    for offset in range(1, PREFETCH_DAYS + 1):
+        for neighbour in (selected_ts + offset, selected_ts - offset):
+            if 0 <= neighbour < len(DAYS):
+                loader.submit(prefetch_day, neighbour)
+    try:
+        result = future.result()
+    except Exception:
+        # Failed queries are not cached, so the day is queried again on the next view
+        forget_day(selected_ts, key, future)
+        raise
+    if key is None:
+        # The current day is still changing, so it is queried again on every view
+        forget_day(selected_ts, key, future)
+    return result
+
+
+def forget_day(selected_ts, key, future):
+    with day_lock:
+        if day_futures.get((selected_ts, key)) is future:
+            del day_futures[(selected_ts, key)]
+
+
+def render_figure(lat, lon, temp):
+    fig = px.scatter_mapbox(
+        lat=lat,
+        lon=lon,
+        size=[MARKER_SIZE]*len(temp),
+        color=temp,
+        color_continuous_scale=px.colors.diverging.RdBu_r,
+        range_color=[-10, 40],
+        zoom=10,
+        size_max=MARKER_SIZE,
+        opacity=0.9,
+        mapbox_style="dark",
+    )
+
+    fig.update_layout(
+        transition_duration=500,
+        coloraxis_colorbar_title_text = 'Dry-Bulb Air Temperature [°C]',
+        coloraxis_colorbar_orientation = 'h',
+        hoverlabel=dict(
+            bgcolor="white",
+            font_size=12,
+        )
+    )
+
+    fig.update_traces(hovertemplate='%{marker.color} °C')
+
+    if raster and not clientside and len(temp):
+        # The interpolated field is drawn as an image layer, taken from the shared tile cache
+        grid = make_grid(lat, lon)
+        field = interpolate(idw_weights(grid, lat, lon), temp, ~np.isnan(temp)).reshape(len(grid["lat"]), len(grid["lon"]))
+        with open(render_tile(field), "rb") as f:
+            image = base64.b64encode(f.read()).decode()
+        fig.update_layout(mapbox_layers=[{
+            "sourcetype": "image",
+            "source": f"data:image/png;base64,{image}",
+            "coordinates": grid_corners(grid),
+            "opacity": 0.6,
+            "below": "traces",
+        }])
+
+    return fig
+
+
+def station_matrix(days):
+    """Lay out the daily means of all the days as a day x station matrix.
+
+    :param days: List of (latitudes, longitudes, temperatures) tuples, one per day
+    :type days: list
+    :return: Tuple made of (station coordinates with shape (stations, 2), float32 temperature matrix, NaN where missing)
+    :rtype: tuple
+    """
+    coords = np.column_stack([np.concatenate([d[0] for d in days]), np.concatenate([d[1] for d in days])])
+    stations, station_idx = np.unique(coords, axis=0, return_inverse=True)
+    matrix = np.full((len(days), len(stations)), np.nan, dtype=np.float32)
+    day_idx = np.repeat(np.arange(len(days)), [len(d[2]) for d in days])
+    matrix[day_idx, station_idx.ravel()] = np.concatenate([d[2] for d in days])
+    return stations, matrix
+
+
+def load_chunk(chunk):
+    # Days of the chunk, read concurrently through the shared day cache
+    days = range(chunk * CHUNK_DAYS, min((chunk + 1) * CHUNK_DAYS, len(DAYS)))
+    return station_matrix(list(loader.map(lambda ts: fetch_day(ts, day_key(ts)), days)))
+
+
+def encode_chunk(stations, matrix):
+    """Encode a chunk of days for the browser.
+
+    :param stations: Station coordinates with shape (stations, 2)
+    :type stations: class:`numpy.ndarray`
+    :param matrix: Float32 day x station temperature matrix
+    :type matrix: class:`numpy.ndarray`
+    :return: Dict with the station coordinates, the shape of the matrix and
+        the matrix as base64 encoded float32 (little-endian)
+    :rtype: dict
+    """
+    return {
+        "lat": stations[:, 0].tolist(),
+        "lon": stations[:, 1].tolist(),
+        "shape": list(matrix.shape),
+        "data": base64.b64encode(matrix.tobytes()).decode(),
+    }
+
+
+# The browser decodes each chunk of days once, then places and colours the markers of the selected day
+UPDATE_FIGURE_JS = """
+function(selected_ts, chunks, figure) {
+    const c = Math.floor(selected_ts / %d);
+    const chunk = chunks[c];
+    if (!chunk) {
+        return window.dash_clientside.no_update;
+    }
+    window.uhiChunks = window.uhiChunks || {};
+    if (!window.uhiChunks[c]) {
+        const bytes = Uint8Array.from(atob(chunk.data), ch => ch.charCodeAt(0));
+        window.uhiChunks[c] = new Float32Array(bytes.buffer);
+    }
+    const n = chunk.shape[1];
+    const i = selected_ts - c * %d;
+    const row = window.uhiChunks[c].subarray(i * n, (i + 1) * n);
+    const trace = Object.assign({}, figure.data[0], {lat: chunk.lat, lon: chunk.lon, text: Array.from(row, v => v.toFixed(1))});
+    trace.marker = Object.assign({}, trace.marker, {
+        color: Array.from(row, v => isNaN(v) ? null : v),
+        size: Array.from(row, v => isNaN(v) ? 0 : %d)
+    });
+    return Object.assign({}, figure, {data: [trace]});
+}
+""" % (CHUNK_DAYS, CHUNK_DAYS, MARKER_SIZE)
+
+# The chunk of the selected day and its neighbours are requested if the browser does not have them yet,
+# as the slider is usually moved by one step
+REQUEST_CHUNKS_JS = """
+function(selected_ts, chunks) {
+    const c = Math.floor(selected_ts / %d);
+    const missing = [c, c + 1, c - 1].filter(i => i >= 0 && i < %d && !(i in chunks));
+    return missing.length ? missing : window.dash_clientside.no_update;
+}
+""" % (CHUNK_DAYS, -(-len(DAYS) // CHUNK_DAYS))
+
+UPDATE_MARKS_JS = """
+function(selected_ts, marks) {
+    const updated = {};
+    for (const k in marks) {
+        const display = Number(k) === selected_ts ? "block" : "none";
+        updated[k] = Object.assign({}, marks[k], {style: Object.assign({}, marks[k].style, {display: display})});
+    }
+    return updated;
+}
+"""
 
 
 px.set_mapbox_access_token(MAPBOX_TOKEN)
 
 app = Dash(__name__)
 
+if clientside:
+    # Only the first chunk of days is loaded at startup, the others are added to the store when the slider reaches them
+    stations, matrix = load_chunk(0)
+    base_figure = render_figure(stations[:, 0], stations[:, 1], matrix[0])
+    base_figure.update_traces(hovertemplate='%{text} °C')
+    data_components = [
+        dcc.Graph(id='graph-with-slider', figure=base_figure, style=dict(height="90vh")),
+        dcc.Store(id='temps', data={"0": encode_chunk(stations, matrix)}),
+        dcc.Store(id='chunk-request', data=None),
+    ]
+else:
+    data_components = [
+        dcc.Graph(id='graph-with-slider', style=dict(height="90vh")),
+        dcc.Store(id='shown-mark', data=None),
+    ]
+
 app.layout = html.Div(
     [
-        dcc.Graph(
-            id='graph-with-slider', 
-            style=dict(
-                height="90vh",
-            ),
-        ),
+        data_components[0],
         dcc.Slider(
             0,
-            len(df.index.unique())-1,
+            len(DAYS)-1,
             step=None,
             value=0,
             marks={
                 str(i): {
-                    "label": (ts - timedelta(hours=24)).strftime("%Y-%m-%d"),
+                    "label": ts.strftime("%Y-%m-%d"),
                     "style": {
                         "display": "none",
                         "font-size": "16px",
                         "font-weight": "500",
                         "white-space": "nowrap",
                     },
-                } for i, ts in enumerate(df.index.unique())
+                } for i, ts in enumerate(DAYS)
             },
             id='ts-slider',
-        )
+        ),
+        *data_components[1:],
     ], 
     style=dict(
         width="90%",
@@ -81,56 +360,108 @@ app.layout = html.Div(
 )
 
 
-@app.callback(
-    Output('graph-with-slider', 'figure'),
-    Input('ts-slider', 'value')
-)
-def update_figure(selected_ts):
-    filtered_df = df[df.index == df.index.unique()[selected_ts]]
-    filtered_df = filtered_df.round({'T_db[C]': 1})
-    marker_size = 30
+@lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def cached_figure(selected_ts, key):
+    """Return the figure of a day as a dict, rendering it only if no server
+    process has rendered it yet for the same data. The figures are kept in
+    memory by the cache key of the day, so new data renders them again. The
+    least recently used figures are removed from the disk cache when it holds
+    more than FIGURE_CACHE_SIZE of them.
 
-    fig = px.scatter_mapbox(
-        filtered_df,
-        lat="lat",
-        lon="lon",
-        size=[marker_size]*len(filtered_df),
-        color="T_db[C]",
-        color_continuous_scale=px.colors.diverging.RdBu_r,
-        range_color=[-10, 40],
-        zoom=10,
-        size_max=marker_size,
-        opacity=0.9,
-        mapbox_style="dark",
-    )
+    :param selected_ts: Slider position
+    :type selected_ts: int
+    :param key: Cache key of the day, as returned by day_key
+    :type key: str
+    :return: Plotly figure
+    :rtype: dict
+    """
+    lat, lon, temp = load_day(selected_ts, key)
+    data_hash = hashlib.sha256(f"{VERSION}|{raster}".encode())
+    for a in (lat, lon, temp):
+        data_hash.update(a.tobytes())
+    path = f"{FIGURE_CACHE_DIR}/{data_hash.hexdigest()}.json"
+    try:
+        with open(path) as f:
+            figure = json.load(f)
+        os.utime(path)
+        return figure
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
 
-    fig.update_layout(
-        transition_duration=500,
-        coloraxis_colorbar_title_text = 'Dry-Bulb Air Temperature [°C]',
-        coloraxis_colorbar_orientation = 'h',
-        hoverlabel=dict(
-            bgcolor="white",
-            font_size=12,
-        )
-    )
+    fig_json = render_figure(lat, lon, temp).to_json()
+    os.makedirs(FIGURE_CACHE_DIR, exist_ok=True)
+    with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+        f.write(fig_json)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
 
-    fig.update_traces(hovertemplate='%{marker.color} °C')
+    entries = [e for e in os.scandir(FIGURE_CACHE_DIR) if e.name.endswith(".json")]
+    for e in sorted(entries, key=lambda e: e.stat().st_mtime)[:-FIGURE_CACHE_SIZE]:
+        try:
+            os.remove(e.path)
+        except FileNotFoundError:
+            pass
+    return json.loads(fig_json)
 
-    return fig
 
+if clientside:
+    app.clientside_callback(
+        UPDATE_FIGURE_JS,
+        Output('graph-with-slider', 'figure'),
+        Input('ts-slider', 'value'),
+        Input('temps', 'data'),
+        State('graph-with-slider', 'figure'),
+    )
+    app.clientside_callback(
+        REQUEST_CHUNKS_JS,
+        Output('chunk-request', 'data'),
+        Input('ts-slider', 'value'),
+        State('temps', 'data'),
+    )
+    app.clientside_callback(
+        UPDATE_MARKS_JS,
+        Output("ts-slider", "marks"),
+        Input("ts-slider", "value"),
+        State("ts-slider", "marks"),
+    )
+
+    @app.callback(
+        Output('temps', 'data'),
+        Input('chunk-request', 'data'),
+        prevent_initial_call=True,
+    )
+    def add_chunks(chunks):
+        # The requested chunks are added to the store, the ones already in the browser are not sent again
+        temps = Patch()
+        for chunk in chunks:
+            temps[str(chunk)] = encode_chunk(*load_chunk(chunk))
+        return temps
+else:
+    @app.callback(
+        Output('graph-with-slider', 'figure'),
+        Input('ts-slider', 'value')
+    )
+    def update_figure(selected_ts):
+        key = day_key(selected_ts)
+        if key is None:
+            # The figure of the current day is not cached, as its data is still changing
+            return render_figure(*load_day(selected_ts, None))
+        return cached_figure(selected_ts, key)
 
-@app.callback(
-    Output("ts-slider", "marks"),
-    Input("ts-slider", "value"),
-    State("ts-slider", "marks"),
-)
-def update_slider_marks(slider_value, current_marks):
-    for k, v in current_marks.items():
-        v["style"]["display"] = "block" if slider_value == int(k) else "none"
-        current_marks[k] = v
+    @app.callback(
+        Output("ts-slider", "marks"),
+        Output("shown-mark", "data"),
+        Input("ts-slider", "value"),
+        State("shown-mark", "data"),
+    )
+    def update_slider_marks(slider_value, shown_mark):
+        # Only the labels of the previous and the new position are updated
+        marks = Patch()
+        if shown_mark is not None:
+            marks[str(shown_mark)]["style"]["display"] = "none"
+        marks[str(slider_value)]["style"]["display"] = "block"
 
-    return current_marks
+        return marks, slider_value
 
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    app.run_server(debug=True)